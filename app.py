@@ -1,12 +1,32 @@
 import sqlite3
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Response, jsonify, render_template, request
 from datetime import datetime
+from src import config
 from src.database_setup import DB_PATH
+from src.db import get_connection, run_with_busy_retry
+from src.events import start_change_feed, stream_events, subscribe
+from src.logging_setup import configure_logging
+from src.metrics import CONTENT_TYPE, Gauge, register_collector, render
+from src.stats import get_dashboard_stats
+from src.wakeups import notify_worker
+
+# --- Dashboard settings (override any of these in src/config.py) ---
+# Shipments returned per page when the client doesn't ask for a size, and the most it may ask for.
+SHIPMENTS_PAGE_SIZE = getattr(config, 'SHIPMENTS_PAGE_SIZE', 50)
+SHIPMENTS_MAX_PAGE_SIZE = getattr(config, 'SHIPMENTS_MAX_PAGE_SIZE', 200)
+
+# Statuses a shipment passes through before 'complete', counted for /metrics.
+IN_PROGRESS_STATUSES = ('quoting', 'awaiting_initial_quotes', 'awaiting_final_offers')
 
 app = Flask(__name__)
+configure_logging()
+
+SHIPMENTS_BY_STATUS = Gauge('shipments', "Shipments currently in each status.", ['status'])
+OUTBOX_DEPTH = Gauge('outbox_depth', "Outbox messages waiting to be sent (pending) or being sent (sending).", ['status'])
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+    """Borrows a pooled connection; close() hands it back."""
+    conn = get_connection(DB_PATH)
     conn.row_factory = sqlite3.Row # This allows accessing columns by name
     return conn
 
@@ -17,27 +37,74 @@ def index():
 
 @app.route('/api/shipments', methods=['GET'])
 def get_shipments():
-    """API endpoint to get all shipments."""
+    """
+    API endpoint to get one page of shipments, newest first.
+
+    Query parameters (all optional):
+      limit   - page size, up to SHIPMENTS_MAX_PAGE_SIZE
+      cursor  - the `next_cursor` of the previous page
+      status  - only shipments with this status
+      carrier - only shipments won by this carrier
+      id      - only this shipment
+
+    Pages are keyset-paginated on shipment_id, so every page costs the same
+    no matter how deep into the history it is.
+    """
+    limit = min(max(request.args.get('limit', SHIPMENTS_PAGE_SIZE, type=int), 1), SHIPMENTS_MAX_PAGE_SIZE)
+    cursor = request.args.get('cursor', type=int)
+    shipment_id = request.args.get('id', type=int)
+    status = request.args.get('status')
+    carrier = request.args.get('carrier')
+
+    conditions, params = [], []
+    if cursor is not None:
+        conditions.append("shipment_id < ?")
+        params.append(cursor)
+    if shipment_id is not None:
+        conditions.append("shipment_id = ?")
+        params.append(shipment_id)
+    if status:
+        conditions.append("status = ?")
+        params.append(status)
+    if carrier:
+        conditions.append("final_winner = ?")
+        params.append(carrier)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    # One extra row tells us whether there is a next page.
     conn = get_db_connection()
-    shipments = conn.execute('SELECT * FROM shipments ORDER BY shipment_id DESC').fetchall()
+    shipments = conn.execute(
+        f"SELECT * FROM shipments {where} ORDER BY shipment_id DESC LIMIT ?", (*params, limit + 1)
+    ).fetchall()
     conn.close()
-    return jsonify([dict(row) for row in shipments])
+
+    has_more = len(shipments) > limit
+    shipments = shipments[:limit]
+    return jsonify({
+        "shipments": [dict(row) for row in shipments],
+        "next_cursor": shipments[-1]['shipment_id'] if has_more else None,
+    })
 
 @app.route('/api/shipments', methods=['POST'])
 def add_shipment():
     """API endpoint to log a new shipment."""
     data = request.json
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
-        conn.execute(
-            "INSERT INTO shipments (request_date, spots, weight, destination_zip, status) VALUES (?, ?, ?, ?, ?)",
-            (datetime.now().isoformat(), data['spots'], data['weight'], data['destination_zip'], 'quoting')
-        )
-        conn.commit()
-        conn.close()
+        run_with_busy_retry(conn, _insert_shipment, data)
+        notify_worker('new_shipments')
         return jsonify({"success": True, "message": "Shipment logged."}), 201
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 400
+    finally:
+        conn.close()
+
+def _insert_shipment(conn, data):
+    conn.execute(
+        "INSERT INTO shipments (request_date, spots, weight, destination_zip, status) VALUES (?, ?, ?, ?, ?)",
+        (datetime.now().isoformat(), data['spots'], data['weight'], data['destination_zip'], 'quoting')
+    )
+    conn.commit()
 
 @app.route('/api/quotes/<int:shipment_id>', methods=['GET'])
 def get_quotes(shipment_id):
@@ -49,43 +116,58 @@ def get_quotes(shipment_id):
 
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
-    """API endpoint to get dashboard summary statistics."""
+    """API endpoint to get dashboard summary statistics, read from the precomputed rollups."""
     conn = get_db_connection()
-    total_shipments = conn.execute('SELECT COUNT(*) FROM shipments').fetchone()[0]
-    in_progress = conn.execute("SELECT COUNT(*) FROM shipments WHERE status NOT IN ('complete', 'failed')").fetchone()[0]
-
-    # Calculate savings from completed shipments
-    completed = conn.execute("SELECT final_price FROM shipments WHERE status = 'complete' AND final_price IS NOT NULL").fetchall()
-
-    total_savings = 0
-    # Find all completed shipments that have a final price
-    completed_shipments = conn.execute(
-        "SELECT shipment_id, final_price FROM shipments WHERE status = 'complete' AND final_price IS NOT NULL"
-    ).fetchall()
-
-    for shipment in completed_shipments:
-        shipment_id = shipment['shipment_id']
-        final_price = shipment['final_price']
-
-        # Find the lowest initial bid for that shipment
-        lowest_initial_bid_row = conn.execute(
-            "SELECT MIN(price) FROM quotes WHERE shipment_id = ? AND quote_type = 'initial' AND status = 'received'",
-            (shipment_id,)
-        ).fetchone()
-
-        if lowest_initial_bid_row and lowest_initial_bid_row[0] is not None:
-            lowest_initial_bid = lowest_initial_bid_row[0]
-            # Add the difference to total savings if we saved money
-            if lowest_initial_bid > final_price:
-                total_savings += (lowest_initial_bid - final_price)
-
+    stats = get_dashboard_stats(conn)
     conn.close()
+    return jsonify(stats)
+
+@app.route('/api/events', methods=['GET'])
+def get_events():
+    """
+    Server-Sent Events stream of shipment and quote changes. Each 'changes'
+    event carries the changed rows and fresh stats; on 'reset' the client
+    should re-fetch what it is showing.
+    """
+    start_change_feed(DB_PATH)
+    subscriber = subscribe() # Before the catch-up read, so nothing falls in between
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    return Response(
+        stream_events(subscriber, get_db_connection(), last_event_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+@register_collector
+def collect_queue_depths():
+    """
+    Refreshes the queue-depth gauges on each /metrics scrape. Only in-progress
+    shipments are counted, through the status index; the completed total
+    comes from the stats rollup, so a scrape costs the same however long the
+    history is.
+    """
+    conn = get_db_connection()
+    try:
+        placeholders = ','.join('?' * len(IN_PROGRESS_STATUSES))
+        counts = dict.fromkeys(IN_PROGRESS_STATUSES, 0)
+        counts.update(conn.execute(
+            f"SELECT status, COUNT(*) FROM shipments WHERE status IN ({placeholders}) GROUP BY status", IN_PROGRESS_STATUSES
+        ).fetchall())
+        completed = conn.execute("SELECT completed_shipments FROM shipment_stats WHERE stats_id = 1").fetchone()
+        counts['complete'] = completed[0] if completed else 0
+        SHIPMENTS_BY_STATUS.replace({(status,): count for status, count in counts.items()})
+
+        OUTBOX_DEPTH.replace({
+            (status,): conn.execute("SELECT COUNT(*) FROM outbox WHERE status = ?", (status,)).fetchone()[0]
+            for status in ('pending', 'sending')
+        })
+    finally:
+        conn.close()
 
-    return jsonify({
-        "total_shipments": total_shipments,
-        "in_progress": in_progress,
-        "total_savings": total_savings # Placeholder
-    })
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint: queue depths plus this process's timings and counters."""
+    return Response(render(), content_type=CONTENT_TYPE)
 
 @app.route('/health')
 def health_check():
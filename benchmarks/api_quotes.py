@@ -0,0 +1,60 @@
+# benchmarks/api_quotes.py
+"""
+Fans out API quote requests for a batch of shipments to several local mock
+carrier APIs with different response times, then reports throughput, the
+number of TCP connections each carrier saw, and p50/p99 latency per carrier.
+
+    python -m benchmarks.api_quotes [num_shipments]
+"""
+import contextlib
+import io
+import random
+import sys
+import time
+
+from benchmarks.fake_services import FakeCarrierAPI
+from src import quoting
+
+NUM_SHIPMENTS = 200
+# name: (mean latency in seconds, price per lb)
+MOCK_CARRIERS = {
+    "Fast API Freight": (0.02, 0.18),
+    "Steady Logistics": (0.05, 0.16),
+    "Slow Lines": (0.15, 0.14),
+}
+
+
+def run_benchmark(num_shipments):
+    rng = random.Random(7)
+    servers, carriers = [], {}
+    for name, (mean_latency, per_lb) in MOCK_CARRIERS.items():
+        server = FakeCarrierAPI(
+            latency=lambda mean=mean_latency: rng.expovariate(1 / mean),
+            price=lambda shipment, rate=per_lb: round(150 + shipment['weight'] * rate, 2),
+        ).start()
+        servers.append(server)
+        carriers[name] = {'type': 'api', 'url': server.url, 'timeout': 2}
+
+    shipments = [
+        {'shipment_id': i, 'spots': rng.randint(1, 12), 'weight': rng.randint(500, 15000), 'destination_zip': f"{rng.randint(501, 99950):05d}"}
+        for i in range(num_shipments)
+    ]
+
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = quoting.get_api_quotes(shipments, carriers)
+        elapsed = time.perf_counter() - start
+    finally:
+        for server in servers:
+            server.stop()
+
+    received = sum(price is not None for *_, price in results)
+    print(f"{len(results)} API quotes ({received} received) in {elapsed:.2f}s ({len(results) / elapsed:.0f} quotes/s)")
+    stats = quoting.get_api_latency_stats()
+    for (name, _), server in zip(MOCK_CARRIERS.items(), servers):
+        print(f"  {name:<18} p50 {stats[name]['p50_ms']:6.1f} ms   p99 {stats[name]['p99_ms']:6.1f} ms   {server.connections} connection(s)")
+
+
+if __name__ == '__main__':
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else NUM_SHIPMENTS)
@@ -0,0 +1,179 @@
+# benchmarks/db_concurrency.py
+"""
+N dashboard readers hit the Flask API while the worker writes, first with the
+old setup (a fresh default connection per request, rollback journal) and then
+with the shared src/db.py layer (WAL, tuned pragmas, pooled connections, busy
+retry). Reports reader throughput, latency and "database is locked" errors.
+
+    python -m benchmarks.db_concurrency [num_readers] [seconds]
+"""
+import contextlib
+import io
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import app
+import worker
+from benchmarks.worker_cycle import build_database
+from src import db
+
+NUM_READERS = 8
+DURATION_SECONDS = 10
+BASE_SHIPMENTS = 50_000
+WRITE_BATCH = 200 # New shipments the writer pushes through the pipeline per cycle
+
+
+def legacy_connect(path):
+    # What app.py and worker.py used to do.
+    return sqlite3.connect(path)
+
+
+def simulate_initial_replies(conn):
+    """Answers every pending initial quote with a random price, as the email parser would."""
+    pending = conn.execute(
+        "SELECT q.quote_id FROM shipments s JOIN quotes q ON q.shipment_id = s.shipment_id "
+        "WHERE s.status = 'awaiting_initial_quotes' AND q.quote_type = 'initial' AND q.status = 'pending'"
+    ).fetchall()
+    conn.executemany(
+        "UPDATE quotes SET price = ?, status = 'received' WHERE quote_id = ?",
+        [(round(random.uniform(500, 5000), 2), quote_id) for (quote_id,) in pending]
+    )
+    conn.commit()
+
+
+def simulate_final_replies(conn):
+    """Records a 5% better final offer from every carrier asked to negotiate."""
+    conn.execute("""
+        INSERT INTO quotes (shipment_id, carrier_name, quote_type, price, status)
+        SELECT q.shipment_id, q.carrier_name, 'final', ROUND(q.price * 0.95, 2), 'received'
+        FROM shipments s
+        JOIN quotes q ON q.shipment_id = s.shipment_id AND q.quote_type = 'initial' AND q.status = 'received'
+        WHERE s.status = 'awaiting_final_offers'
+          AND q.price > (SELECT MIN(l.price) FROM quotes l WHERE l.shipment_id = q.shipment_id AND l.quote_type = 'initial' AND l.status = 'received')
+          AND NOT EXISTS (SELECT 1 FROM quotes f WHERE f.shipment_id = q.shipment_id AND f.carrier_name = q.carrier_name AND f.quote_type = 'final')
+    """)
+    conn.commit()
+
+
+def add_shipments(conn):
+    conn.executemany(
+        "INSERT INTO shipments (request_date, spots, weight, destination_zip, status) VALUES (datetime('now'), 2, 800, '60601', 'quoting')",
+        [()] * WRITE_BATCH
+    )
+    conn.commit()
+
+
+def run_directly(conn, func, *args):
+    return func(conn, *args)
+
+
+def writer(path, connect, run_phase, stop, results):
+    conn = connect(path)
+    while not stop.is_set():
+        try:
+            run_phase(conn, add_shipments)
+            run_phase(conn, worker.start_new_shipments)
+            run_phase(conn, simulate_initial_replies)
+            run_phase(conn, worker.advance_to_negotiation)
+            run_phase(conn, simulate_final_replies)
+            run_phase(conn, worker.complete_shipments)
+            results['cycles'] += 1
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.rollback()
+            results['errors'] += 1
+            results['last_error'] = str(e)
+    conn.close()
+
+
+def reader(stop, latencies, errors):
+    client = app.app.test_client()
+    paths = ['/api/shipments?limit=50', '/api/stats', '/api/shipments?status=complete&limit=50', '/api/quotes/1']
+    while not stop.is_set():
+        path = random.choice(paths)
+        start = time.perf_counter()
+        response = client.get(path)
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            errors.append(path)
+
+
+def run_mode(label, path, connect_for_app, connect_for_worker, run_phase, num_readers, duration):
+    app.get_db_connection = connect_for_app
+    stop = threading.Event()
+    latencies, reader_errors = [], []
+    writer_results = {'cycles': 0, 'errors': 0, 'last_error': None}
+
+    threads = [threading.Thread(target=writer, args=(path, connect_for_worker, run_phase, stop, writer_results))]
+    threads += [threading.Thread(target=reader, args=(stop, latencies, reader_errors)) for _ in range(num_readers)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    latencies.sort()
+    p50 = 1000 * latencies[len(latencies) // 2] if latencies else 0
+    p99 = 1000 * latencies[int(len(latencies) * 0.99)] if latencies else 0
+    print(f"{label}")
+    print(f"  Readers: {len(latencies) / duration:8.0f} req/s  p50 {p50:6.1f} ms  p99 {p99:7.1f} ms  errors {len(reader_errors)}")
+    print(f"  Writer:  {writer_results['cycles'] * WRITE_BATCH / duration:8.0f} shipments/s  locked errors {writer_results['errors']}")
+    if writer_results['last_error']:
+        print(f"           last error: {writer_results['last_error']}")
+
+
+def run_benchmark(num_readers, duration):
+    workdir = tempfile.mkdtemp()
+    original_get_db_connection = app.get_db_connection
+    try:
+        template = os.path.join(workdir, "template.db")
+        print(f"Building synthetic database with {BASE_SHIPMENTS} shipments...")
+        with contextlib.redirect_stdout(io.StringIO()):
+            build_database(template, BASE_SHIPMENTS)
+            # Settle the open shipments first, so the timed writer only works on new ones.
+            conn = legacy_connect(template)
+            for phase in (worker.start_new_shipments, worker.advance_to_negotiation, worker.complete_shipments):
+                simulate_initial_replies(conn)
+                simulate_final_replies(conn)
+                phase(conn)
+            conn.close()
+
+        legacy_db = os.path.join(workdir, "legacy.db")
+        shared_db = os.path.join(workdir, "shared.db")
+        shutil.copy(template, legacy_db)
+        shutil.copy(template, shared_db)
+
+        def legacy_app_connection():
+            conn = legacy_connect(legacy_db)
+            conn.row_factory = sqlite3.Row
+            return conn
+
+        def shared_app_connection():
+            conn = db.get_connection(shared_db)
+            conn.row_factory = sqlite3.Row
+            return conn
+
+        print(f"{num_readers} readers, 1 writer, {duration}s per run\n")
+        run_mode("Per-request connections, rollback journal:", legacy_db,
+                 legacy_app_connection, legacy_connect, run_directly, num_readers, duration)
+        run_mode("Shared layer (WAL, pooled, busy retry):", shared_db,
+                 shared_app_connection, db.get_connection, db.run_with_busy_retry, num_readers, duration)
+    finally:
+        app.get_db_connection = original_get_db_connection
+        db.close_pools()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    run_benchmark(
+        int(sys.argv[1]) if len(sys.argv) > 1 else NUM_READERS,
+        float(sys.argv[2]) if len(sys.argv) > 2 else DURATION_SECONDS,
+    )
@@ -0,0 +1,349 @@
+# benchmarks/end_to_end.py
+"""
+Drives shipments through the whole negotiation pipeline: quoting,
+negotiation and completion. The real worker and sender loops run
+in-process against a local fake SMTP server, a fake IMAP inbox, fake email
+carriers that reply after a configurable delay, and a stub Gemini endpoint.
+Reports throughput, time-to-complete percentiles and per-stage latency.
+--newsletters mixes in non-carrier mail, to see what it costs the parser.
+Shipments are added the way the app adds them, notice to the worker
+included; --no-wakeups leaves the worker and sender to their polling.
+
+    python -m benchmarks.end_to_end [-n 200] [--carriers 3] [--reply-latency 1.0] [--rate 0] [--newsletters 0]
+
+As a regression gate, save a baseline once and compare later runs against
+it; the run exits with status 1 if throughput or p95 time-to-complete got
+worse by more than --tolerance:
+
+    python -m benchmarks.end_to_end --save-baseline e2e_baseline.json
+    python -m benchmarks.end_to_end --baseline e2e_baseline.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import sender
+import worker
+from benchmarks.fake_services import FakeEmailCarriers, FakeGeminiAPI, FakeIMAPServer, FakeSMTPServer
+from src import ai_parser, db, email_parser, email_utils, outbox, price_extractor, wakeups
+from src.config import POLLING_INTERVAL_SECONDS
+from src.database_setup import create_database
+from src.logging_setup import configure_logging
+
+NUM_SHIPMENTS = 200
+NUM_CARRIERS = 3
+REPLY_LATENCY_SECONDS = 1.0 # Mean carrier reply time; each reply takes 50-150% of it
+GEMINI_LATENCY_SECONDS = 0.3
+AMBIGUOUS_FRACTION = 0.2 # Share of initial quotes worded so they need the AI parser
+TIMEOUT_SECONDS = 300
+NEWSLETTER_BYTES = 50_000
+TOLERANCE = 0.15
+
+# Per-shipment milestones, in pipeline order. Each stage is the time between
+# consecutive milestones a shipment reached.
+MILESTONES = ['created', 'requested', 'quoted', 'quotes_read', 'negotiating', 'offers_in', 'offers_read', 'complete']
+STAGES = {
+    'requested': "Quote requests sent",
+    'quoted': "Carriers quote",
+    'quotes_read': "Quotes parsed and saved",
+    'negotiating': "Final offer requests sent",
+    'offers_in': "Carriers make final offers",
+    'offers_read': "Final offers parsed and saved",
+    'complete': "Shipment completed",
+}
+
+
+class Timeline:
+    """When each shipment reached each milestone (the last of its emails, where there are several)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shipments = {}
+        self.reply_uids = {}
+
+    def mark(self, shipment_id, milestone, at=None):
+        at = at or time.monotonic()
+        with self.lock:
+            milestones = self.shipments.setdefault(shipment_id, {})
+            milestones[milestone] = max(milestones.get(milestone, at), at)
+
+    def request_sent(self, message):
+        milestone = 'negotiating' if 'Final Offer Request' in message['data'] else 'requested'
+        shipment_id = int(message['data'].split('Shipment #', 1)[1].split()[0])
+        self.mark(shipment_id, milestone)
+
+    def reply_delivered(self, shipment_id, carrier, quote_type, uid, at):
+        with self.lock:
+            self.reply_uids[uid] = (shipment_id, quote_type)
+        self.mark(shipment_id, 'offers_in' if quote_type == 'final' else 'quoted', at)
+
+    def reply_read(self, uid, at):
+        with self.lock:
+            if uid not in self.reply_uids:
+                return # Not a carrier reply
+            shipment_id, quote_type = self.reply_uids[uid]
+        self.mark(shipment_id, 'offers_read' if quote_type == 'final' else 'quotes_read', at)
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    pick = lambda q: values[min(int(len(values) * q), len(values) - 1)]
+    return {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': values[-1]}
+
+
+def add_shipments(db_path, timeline, num_shipments, rate, rng, stop):
+    conn = db.connect(db_path)
+    for _ in range(num_shipments):
+        if stop.is_set():
+            break
+        shipment_id = conn.execute(
+            "INSERT INTO shipments (request_date, spots, weight, destination_zip, status) "
+            "VALUES (datetime('now'), ?, ?, ?, 'quoting') RETURNING shipment_id",
+            (rng.randint(1, 12), rng.randint(500, 15000), f"{rng.randint(501, 99950):05d}")
+        ).fetchone()[0]
+        conn.commit()
+        wakeups.notify_worker('new_shipments') # As app.add_shipment does
+        timeline.mark(shipment_id, 'created')
+        if rate:
+            time.sleep(1 / rate)
+    conn.close()
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def deliver_newsletters(imap_server, rate, stop):
+    """Drops `rate` large non-carrier emails per second into the inbox until stopped."""
+    body = ("Our latest deals and industry news.\r\n" * (NEWSLETTER_BYTES // 37)).encode()
+    sequence = 0
+    while not stop.wait(1 / rate):
+        sequence += 1
+        imap_server.deliver(b"From: news@freight-weekly.example.com\r\nSubject: Freight Weekly\r\n"
+                            + f"Message-ID: <news-{sequence}@freight-weekly.example.com>\r\n\r\n".encode() + body)
+
+
+def wait_for_completion(db_path, timeline, num_shipments, timeout):
+    conn = db.connect(db_path)
+    deadline = time.monotonic() + timeout
+    done = set()
+    while len(done) < num_shipments and time.monotonic() < deadline:
+        now = time.monotonic()
+        for (shipment_id,) in conn.execute("SELECT shipment_id FROM shipments WHERE status = 'complete'"):
+            if shipment_id not in done:
+                done.add(shipment_id)
+                timeline.mark(shipment_id, 'complete', now)
+        time.sleep(0.02)
+    conn.close()
+    return len(done)
+
+
+def summarize(timeline, num_shipments, completed):
+    shipments = list(timeline.shipments.values())
+    finished = [m for m in shipments if 'complete' in m and 'created' in m]
+    stages = {}
+    for milestone in MILESTONES[1:]:
+        durations = []
+        for m in shipments:
+            if milestone not in m:
+                continue
+            # Measure from the latest earlier milestone this shipment reached.
+            previous = next(m[p] for p in reversed(MILESTONES[:MILESTONES.index(milestone)]) if p in m)
+            durations.append(m[milestone] - previous)
+        stages[milestone] = percentiles(durations)
+
+    if finished:
+        first_created = min(m['created'] for m in finished)
+        last_complete = max(m['complete'] for m in finished)
+        throughput = len(finished) / max(last_complete - first_created, 1e-9)
+    else:
+        throughput = 0.0
+    return {
+        'shipments': num_shipments,
+        'completed': completed,
+        'throughput_per_second': throughput,
+        'time_to_complete': percentiles([m['complete'] - m['created'] for m in finished]),
+        'stages': stages,
+    }
+
+
+def run_benchmark(num_shipments, num_carriers, reply_latency, gemini_latency, ambiguous_fraction,
+                  rate, poll_seconds, timeout, seed, newsletters=0, use_wakeups=True):
+    rng = random.Random(seed)
+    timeline = Timeline()
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, "e2e.db")
+    contacts = {f"Carrier {i}": f"quotes@carrier{i}.example.com" for i in range(1, num_carriers + 1)}
+    carrier_rates = {name: rng.uniform(0.8, 1.2) for name in contacts}
+
+    imap_server = FakeIMAPServer(on_seen=timeline.reply_read).start()
+    carriers = FakeEmailCarriers(
+        imap_server, contacts,
+        latency=lambda: reply_latency * rng.uniform(0.5, 1.5),
+        price=lambda carrier, details: (150 + details['weight'] * 0.2 + details['spots'] * 60) * carrier_rates[carrier],
+        ambiguous_fraction=ambiguous_fraction, seed=seed, on_reply=timeline.reply_delivered,
+    ).start()
+
+    def on_message(message):
+        timeline.request_sent(message)
+        carriers.handle_request(message)
+    smtp_server = FakeSMTPServer(on_message=on_message).start()
+    gemini = FakeGeminiAPI(latency=lambda: gemini_latency).start()
+
+    # Point every external connection at the stand-ins, and the app at a scratch database.
+    saved = [
+        (worker, 'DB_PATH', db_path), (sender, 'DB_PATH', db_path),
+        (worker, 'CARRIERS', {name: {'type': 'email', 'contact': contact} for name, contact in contacts.items()}),
+        (worker, 'RETRAIN_CHECK_MINUTES', 0), (worker, 'POLLING_INTERVAL_SECONDS', poll_seconds),
+        (email_utils, 'SMTP_SERVER', '127.0.0.1'), (email_utils, 'SMTP_PORT', smtp_server.port),
+        (email_utils, 'SMTP_USE_SSL', False),
+        (email_parser, 'IMAP_SERVER', '127.0.0.1'), (email_parser, 'IMAP_PORT', imap_server.port),
+        (email_parser, 'IMAP_USE_SSL', False),
+        (ai_parser, 'GEMINI_BASE_URL', gemini.url), (ai_parser, '_client', None),
+        (ai_parser, 'AI_CACHE_PATH', os.path.join(workdir, "ai_cache.db")), (ai_parser, '_cache_conn', None),
+        # The per-domain politeness limit would dominate the run; it isn't what's being measured.
+        (outbox, 'OUTBOX_DOMAIN_RATE_PER_MINUTE', 10 ** 9),
+    ]
+    worker_port, sender_port = (free_udp_port(), free_udp_port()) if use_wakeups else (0, 0)
+    saved += [
+        (wakeups, 'WAKEUP_HOST', '127.0.0.1'),
+        (worker, 'WORKER_WAKEUP_PORT', worker_port), (wakeups, 'WORKER_WAKEUP_PORT', worker_port),
+        (sender, 'SENDER_WAKEUP_PORT', sender_port), (wakeups, 'SENDER_WAKEUP_PORT', sender_port),
+    ]
+    saved = [(module, name, getattr(module, name), value) for module, name, value in saved]
+    for module, name, _, value in saved:
+        setattr(module, name, value)
+
+    configure_logging() # Log lines go to stdout, where the run's ERROR lines are collected from
+    stop = threading.Event()
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            create_database(db_path)
+            threads = [
+                threading.Thread(target=worker.worker_loop, args=(stop,), daemon=True),
+                threading.Thread(target=sender.sender_loop, args=(stop,), daemon=True),
+                threading.Thread(target=add_shipments, args=(db_path, timeline, num_shipments, rate, rng, stop), daemon=True),
+            ]
+            if newsletters:
+                threads.append(threading.Thread(target=deliver_newsletters, args=(imap_server, newsletters, stop), daemon=True))
+            start = time.monotonic()
+            for thread in threads:
+                thread.start()
+            completed = wait_for_completion(db_path, timeline, num_shipments, timeout)
+            wall_seconds = time.monotonic() - start
+            stop.set()
+            for thread in threads:
+                thread.join(timeout=30)
+    finally:
+        stop.set()
+        for module, name, original, _ in saved:
+            setattr(module, name, original)
+        carriers.stop()
+        for server in (smtp_server, imap_server, gemini):
+            server.stop()
+        email_utils.close_smtp_pool()
+        db.close_pools()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = summarize(timeline, num_shipments, completed)
+    results['wall_seconds'] = wall_seconds
+    results['emails_sent'] = len(smtp_server.messages)
+    results['carrier_replies'] = carriers.replies
+    results['imap_logins'] = imap_server.logins
+    results['imap_bytes_fetched'] = imap_server.bytes_fetched
+    results['ai_requests'] = gemini.requests
+    results['ai_emails'] = gemini.emails
+    results['parser_tiers'] = {tier: price_extractor.PRICE_TIER_REPLIES.value(tier=tier) for tier in ('regex', 'ai')}
+    results['errors'] = [line for line in log.getvalue().splitlines() if 'ERROR' in line]
+    results['settings'] = {
+        'shipments': num_shipments, 'carriers': num_carriers, 'reply_latency': reply_latency,
+        'gemini_latency': gemini_latency, 'ambiguous_fraction': ambiguous_fraction, 'rate': rate,
+        'poll_seconds': poll_seconds, 'seed': seed, 'newsletters': newsletters, 'wakeups': use_wakeups,
+    }
+    return results
+
+
+def print_report(results):
+    ms = lambda seconds: f"{seconds * 1000:8.0f}" if seconds is not None else "       -"
+    print(f"Completed {results['completed']}/{results['shipments']} shipments in {results['wall_seconds']:.1f}s "
+          f"({results['throughput_per_second']:.2f} shipments/s)")
+    print(f"Emails sent {results['emails_sent']}, carrier replies {results['carrier_replies']}, "
+          f"IMAP logins {results['imap_logins']} ({results['imap_bytes_fetched'] / 1024:.0f} KiB fetched), "
+          f"AI requests {results['ai_requests']} "
+          f"for {results['ai_emails']} emails, parser tiers {results['parser_tiers']}")
+
+    print(f"\n{'':32}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    ttc = results['time_to_complete']
+    print(f"{'Time to complete':32}{ms(ttc['p50'])} {ms(ttc['p95'])} {ms(ttc['p99'])} {ms(ttc['max'])}")
+    for milestone, label in STAGES.items():
+        stage = results['stages'][milestone]
+        print(f"  {label:30}{ms(stage['p50'])} {ms(stage['p95'])} {ms(stage['p99'])} {ms(stage['max'])}")
+
+    if results['errors']:
+        print(f"\n⚠️ {len(results['errors'])} error(s) logged, e.g. {results['errors'][0]}")
+
+
+def check_regression(results, baseline, tolerance):
+    """Returns a list of the ways `results` is worse than `baseline` by more than `tolerance`."""
+    regressions = []
+    if baseline['settings'] != results['settings']:
+        print(f"⚠️ Baseline was recorded with different settings: {baseline['settings']}")
+    if results['completed'] < baseline['completed']:
+        regressions.append(f"completed {results['completed']} shipments, baseline {baseline['completed']}")
+    if results['throughput_per_second'] < baseline['throughput_per_second'] * (1 - tolerance):
+        regressions.append(f"throughput {results['throughput_per_second']:.2f}/s, baseline {baseline['throughput_per_second']:.2f}/s")
+    current_p95, baseline_p95 = results['time_to_complete']['p95'], baseline['time_to_complete']['p95']
+    if current_p95 is not None and baseline_p95 is not None and current_p95 > baseline_p95 * (1 + tolerance):
+        regressions.append(f"p95 time to complete {current_p95:.2f}s, baseline {baseline_p95:.2f}s")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end pipeline benchmark against local stand-in services.")
+    parser.add_argument('-n', '--shipments', type=int, default=NUM_SHIPMENTS)
+    parser.add_argument('--carriers', type=int, default=NUM_CARRIERS)
+    parser.add_argument('--reply-latency', type=float, default=REPLY_LATENCY_SECONDS, help="mean carrier reply time, seconds")
+    parser.add_argument('--gemini-latency', type=float, default=GEMINI_LATENCY_SECONDS, help="stub Gemini response time, seconds")
+    parser.add_argument('--ambiguous', type=float, default=AMBIGUOUS_FRACTION, help="share of quotes that need the AI parser")
+    parser.add_argument('--rate', type=float, default=0, help="new shipments per second (0: all at once)")
+    parser.add_argument('--newsletters', type=float, default=0, help="non-carrier emails arriving per second")
+    parser.add_argument('--poll-seconds', type=float, default=POLLING_INTERVAL_SECONDS, help="worker polling interval")
+    parser.add_argument('--no-wakeups', dest='wakeups', action='store_false', help="don't notify the worker and sender; they poll")
+    parser.add_argument('--timeout', type=float, default=TIMEOUT_SECONDS)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--save-baseline', help="write the results here as the new baseline")
+    parser.add_argument('--baseline', help="compare against this baseline and exit 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    results = run_benchmark(args.shipments, args.carriers, args.reply_latency, args.gemini_latency,
+                            args.ambiguous, args.rate, args.poll_seconds, args.timeout, args.seed, args.newsletters,
+                            args.wakeups)
+    print_report(results)
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = check_regression(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\n❌ Performance regression: " + "; ".join(regressions))
+            sys.exit(1)
+        print(f"\n✅ Within {args.tolerance:.0%} of the baseline.")
@@ -0,0 +1,525 @@
+# benchmarks/fake_services.py
+"""
+Local stand-ins for the external services the negotiator talks to, so the
+pipeline can be exercised and timed without touching real mail servers.
+"""
+import email
+import heapq
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough SMTP for smtplib: EHLO, AUTH, MAIL, RCPT, DATA, RSET, NOOP, QUIT."""
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        # Stands in for the TCP + TLS handshake a real server costs.
+        time.sleep(server.connect_delay)
+        self.reply("220 fake-smtp ready")
+
+        envelope = {}
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+
+            if verb in ('EHLO', 'HELO'):
+                self.reply("250-fake-smtp")
+                self.reply("250 AUTH PLAIN LOGIN")
+            elif verb == 'AUTH':
+                time.sleep(server.login_delay)
+                with server.lock:
+                    server.logins += 1
+                self.reply("235 Authentication successful")
+            elif verb == 'MAIL':
+                envelope = {'from': command, 'to': []}
+                self.reply("250 OK")
+            elif verb == 'RCPT':
+                envelope.setdefault('to', []).append(command.split(':', 1)[1].strip(' <>'))
+                self.reply("250 OK")
+            elif verb == 'DATA':
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line in (b".\r\n", b".\n"):
+                        break
+                    data.append(data_line.decode(errors='replace'))
+                time.sleep(server.send_delay)
+                message = {'to': envelope.get('to', []), 'data': ''.join(data)}
+                with server.lock:
+                    server.messages.append(message)
+                if server.on_message:
+                    server.on_message(message)
+                self.reply("250 Message accepted")
+            elif verb in ('RSET', 'NOOP'):
+                self.reply("250 OK")
+            elif verb == 'QUIT':
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    A plain-text SMTP server on localhost that records every message it accepts,
+    and hands each one to `on_message` if given. Point the app at it with
+    SMTP_SERVER = '127.0.0.1', SMTP_PORT = server.port and SMTP_USE_SSL = False.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, connect_delay=0.0, login_delay=0.0, send_delay=0.0, on_message=None):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.connect_delay = connect_delay
+        self.login_delay = login_delay
+        self.send_delay = send_delay
+        self.on_message = on_message
+        self.lock = threading.Lock()
+        self.messages = []
+        self.connections = 0
+        self.logins = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _CarrierAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like a real carrier API
+
+    def do_POST(self):
+        server = self.server
+        shipment = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        time.sleep(server.latency())
+        body = json.dumps({'price': server.price(shipment)}).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeCarrierAPI(ThreadingHTTPServer):
+    """
+    A carrier quoting API on localhost. `latency` and `price` are callables, so
+    a benchmark can give each fake carrier its own response time and pricing.
+    Counts the TCP connections it accepts, to check keep-alive reuse.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=lambda: 0.0, price=lambda shipment: 1000.0):
+        super().__init__(('127.0.0.1', 0), _CarrierAPIHandler)
+        self.latency = latency
+        self.price = price
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/quote"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _parse_uid_set(uid_set, max_uid):
+    """Expands an IMAP sequence set like '1,4:6,9:*' into a set of UIDs."""
+    uids = set()
+    for part in uid_set.split(','):
+        start, _, end = part.partition(':')
+        start = max_uid if start == '*' else int(start)
+        end = start if not end else max_uid if end == '*' else int(end)
+        uids.update(range(min(start, end), max(start, end) + 1))
+    return uids
+
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough IMAP4rev1 for imap_tools: CAPABILITY, LOGIN, SELECT,
+    STATUS, IDLE, UID SEARCH (ALL / UNSEEN / UID set), UID FETCH (whole
+    message or header only), UID STORE, EXPUNGE, NOOP, LOGOUT.
+    """
+
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock() # deliver() writes EXISTS from other threads
+
+    def send(self, line):
+        with self.write_lock:
+            self.wfile.write(line if isinstance(line, bytes) else f"{line}\r\n".encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        time.sleep(server.connect_delay)
+        self.send("* OK fake-imap ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, command = line.decode(errors='replace').strip().partition(' ')
+            verb, _, args = command.partition(' ')
+            verb = verb.upper()
+
+            if verb == 'CAPABILITY':
+                self.send("* CAPABILITY IMAP4rev1 UIDPLUS IDLE")
+            elif verb == 'LOGIN':
+                time.sleep(server.login_delay)
+                with server.lock:
+                    server.logins += 1
+            elif verb in ('SELECT', 'EXAMINE'):
+                with server.lock:
+                    self.send(f"* {len(server.mailbox)} EXISTS")
+                    self.send(f"* OK [UIDVALIDITY {server.uid_validity}] UIDs valid")
+                    self.send(f"* OK [UIDNEXT {server.next_uid}] Predicted next UID")
+                    self.send("* FLAGS (\\Seen \\Deleted)")
+            elif verb == 'STATUS':
+                folder = args.split(' ', 1)[0]
+                with server.lock:
+                    unseen = sum('\\Seen' not in message['flags'] for message in server.mailbox.values())
+                    self.send(f"* STATUS {folder} (MESSAGES {len(server.mailbox)} UIDNEXT {server.next_uid} "
+                              f"UIDVALIDITY {server.uid_validity} UNSEEN {unseen})")
+            elif verb == 'IDLE':
+                self.idle(tag)
+                continue
+            elif verb == 'UID':
+                sub_verb, _, sub_args = args.partition(' ')
+                self.handle_uid(tag, sub_verb.upper(), sub_args)
+                continue
+            elif verb == 'LOGOUT':
+                self.send("* BYE fake-imap logging out")
+                self.send(f"{tag} OK LOGOUT completed")
+                return
+            elif verb not in ('NOOP', 'EXPUNGE', 'UNSELECT', 'CLOSE'):
+                self.send(f"{tag} BAD Command not implemented")
+                continue
+            self.send(f"{tag} OK {verb} completed")
+
+    def idle(self, tag):
+        """Pushes '* n EXISTS' for every delivery until the client sends DONE."""
+        server = self.server
+        self.send("+ idling")
+        with server.lock:
+            server.idlers.add(self)
+        try:
+            self.rfile.readline() # DONE, or EOF if the client went away
+        finally:
+            with server.lock:
+                server.idlers.discard(self)
+        self.send(f"{tag} OK IDLE terminated")
+
+    def handle_uid(self, tag, verb, args):
+        server = self.server
+        if verb == 'SEARCH':
+            terms = args.upper().replace('(', ' ').replace(')', ' ').split()
+            with server.lock:
+                wanted = _parse_uid_set(terms[terms.index('UID') + 1], server.next_uid - 1) if 'UID' in terms else None
+                uids = [uid for uid, message in server.mailbox.items()
+                        if ('UNSEEN' not in terms or '\\Seen' not in message['flags'])
+                        and (wanted is None or uid in wanted)]
+            self.send(f"* SEARCH {' '.join(map(str, uids))}".rstrip())
+        elif verb == 'FETCH':
+            uid_set = args.split(' ', 1)[0]
+            headers_only = '[HEADER]' in args.upper()
+            with server.lock:
+                wanted = _parse_uid_set(uid_set, server.next_uid - 1)
+                sequence = {uid: number for number, uid in enumerate(server.mailbox, start=1)}
+                messages = [(uid, dict(message)) for uid, message in server.mailbox.items() if uid in wanted]
+            time.sleep(server.fetch_delay * len(messages))
+            for uid, message in messages:
+                flags = ' '.join(sorted(message['flags']))
+                size = len(message['raw'])
+                raw = message['raw'].split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n' if headers_only else message['raw']
+                section = 'BODY[HEADER]' if headers_only else 'BODY[]'
+                self.send(f"* {sequence[uid]} FETCH (UID {uid} FLAGS ({flags}) RFC822.SIZE {size} {section} {{{len(raw)}}}\r\n".encode())
+                self.send(raw + b")\r\n")
+                with server.lock:
+                    server.bytes_fetched += len(raw)
+        elif verb == 'STORE':
+            uid_set, mode, flags = args.split(' ', 2)
+            flags = set(flags.strip('()').split())
+            now = time.monotonic()
+            with server.lock:
+                changed = []
+                for uid in _parse_uid_set(uid_set, server.next_uid - 1):
+                    message = server.mailbox.get(uid)
+                    if message is None:
+                        continue
+                    if mode.startswith('+'):
+                        if '\\Seen' in flags and '\\Seen' not in message['flags']:
+                            changed.append(uid)
+                        message['flags'] |= flags
+                    else:
+                        message['flags'] -= flags
+            if server.on_seen:
+                for uid in changed:
+                    server.on_seen(uid, now)
+        else:
+            self.send(f"{tag} BAD UID {verb} not implemented")
+            return
+        self.send(f"{tag} OK UID {verb} completed")
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """
+    A plain-text IMAP server on localhost with a single INBOX. Messages are
+    added with deliver(), which also notifies sessions in IDLE; `on_seen(uid,
+    time)` is called when one is first flagged as read. `bytes_fetched` counts
+    the message data sent to clients. Point the app at it with IMAP_SERVER =
+    '127.0.0.1', IMAP_PORT = server.port and IMAP_USE_SSL = False.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, connect_delay=0.0, login_delay=0.0, fetch_delay=0.0, on_seen=None):
+        super().__init__(('127.0.0.1', 0), _IMAPHandler)
+        self.connect_delay = connect_delay
+        self.login_delay = login_delay
+        self.fetch_delay = fetch_delay
+        self.on_seen = on_seen
+        self.lock = threading.Lock()
+        self.mailbox = {} # uid -> {'raw': bytes, 'flags': set}, in UID order
+        self.uid_validity = 1
+        self.next_uid = 1
+        self.connections = 0
+        self.logins = 0
+        self.bytes_fetched = 0
+        self.idlers = set() # handlers currently in IDLE
+
+    def deliver(self, raw):
+        """Adds a message (bytes or str) to the INBOX, unread. Returns its UID."""
+        raw = raw.encode() if isinstance(raw, str) else raw
+        with self.lock:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.mailbox[uid] = {'raw': raw, 'flags': set()}
+            exists = len(self.mailbox)
+            idlers = list(self.idlers)
+        for handler in idlers:
+            handler.send(f"* {exists} EXISTS")
+        return uid
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+_EMAIL_PRICE = re.compile(r'\$?\s?(\d{1,3}(?:,\d{3})+|\d+)\.(\d{2})\b')
+_DECLINE = re.compile(r"\b(unable|cannot|can't|decline|pass)\b", re.IGNORECASE)
+
+
+def _answer_prompt(prompt):
+    """Reads the emails out of a parse prompt and answers the way the real model is asked to."""
+    def price_in(text):
+        if _DECLINE.search(text):
+            return None
+        match = _EMAIL_PRICE.search(text)
+        return float(match.group(1).replace(',', '') + '.' + match.group(2)) if match else None
+
+    emails = re.split(r'=== EMAIL (\d+) ===\n', prompt)
+    if len(emails) > 1:
+        return json.dumps([{'id': int(email_id), 'price': price_in(body)} for email_id, body in zip(emails[1::2], emails[2::2])])
+    body = prompt.split('Email content to analyze:', 1)[-1]
+    return json.dumps({'price': price_in(body)})
+
+
+class _GeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        prompt = ''.join(part.get('text', '') for content in request.get('contents', []) for part in content.get('parts', []))
+        start = time.monotonic()
+        time.sleep(server.latency())
+        body = json.dumps({
+            'candidates': [{'content': {'role': 'model', 'parts': [{'text': _answer_prompt(prompt)}]}, 'finishReason': 'STOP'}],
+        }).encode()
+        with server.lock:
+            server.requests += 1
+            server.emails += max(prompt.count('=== EMAIL '), 1)
+            server.seconds += time.monotonic() - start
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeGeminiAPI(ThreadingHTTPServer):
+    """
+    Answers generateContent requests like the Gemini model would for the
+    parser's prompts, after `latency()` seconds, by reading the price out of
+    each email with a regex. Point the parser at it with GEMINI_BASE_URL = api.url.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=lambda: 0.0):
+        super().__init__(('127.0.0.1', 0), _GeminiHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.emails = 0
+        self.seconds = 0.0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeEmailCarriers:
+    """
+    Carriers that answer the quote and final offer requests the app emails
+    them. Wire handle_request up as a FakeSMTPServer's on_message; after
+    `latency()` seconds each carrier's reply is delivered to the fake IMAP
+    inbox. `price(carrier, shipment_details)` sets initial quotes; a carrier
+    asked for a final offer undercuts the competing bid with probability
+    `negotiation_chance`, and otherwise declines. A share of replies
+    (`ambiguous_fraction`) is worded so the regex extractor passes them on to
+    the AI parser. `on_reply(shipment_id, carrier, quote_type, uid, time)` is
+    called for every delivered reply.
+    """
+
+    INITIAL_REPLIES = [
+        "Hi,\n\nOur quote for shipment #{shipment_id} is ${price:,.2f} all-in.\n\nThanks,\n{carrier}",
+        "Hello,\n\nThe total price to move this is ${price:,.2f}.\n\nRegards,\n{carrier}",
+    ]
+    AMBIGUOUS_INITIAL_REPLY = "Hi,\n\nWe can move this for {price:,.2f} plus fuel surcharge, which is included.\n\n{carrier}"
+    FINAL_REPLY = "Hello,\n\nOur best and final offer is ${price:,.2f}.\n\nThanks,\n{carrier}"
+    DECLINE_REPLY = "Hello,\n\nUnfortunately we are unable to go lower than our original quote.\n\n{carrier}"
+
+    def __init__(self, imap_server, contacts, latency=lambda: 0.0, price=None,
+                 negotiation_chance=0.6, ambiguous_fraction=0.0, seed=None, on_reply=None):
+        self.imap_server = imap_server
+        self.carriers_by_contact = {contact: name for name, contact in contacts.items()}
+        self.latency = latency
+        self.price = price or (lambda carrier, details: 150 + details['weight'] * 0.2 + details['spots'] * 60)
+        self.negotiation_chance = negotiation_chance
+        self.ambiguous_fraction = ambiguous_fraction
+        self.on_reply = on_reply
+        self.random = random.Random(seed)
+        self.condition = threading.Condition()
+        self.scheduled = [] # heap of (due time, sequence, reply)
+        self.sequence = 0
+        self.replies = 0
+        self.running = False
+
+    def handle_request(self, message):
+        """Reads one email the app sent and schedules the carrier's reply."""
+        parsed = email.message_from_string(message['data'])
+        carrier = self.carriers_by_contact.get((message['to'] or [''])[0])
+        shipment_match = re.search(r'#(\d+)', parsed.get('Subject', ''))
+        if not carrier or not shipment_match:
+            return
+        shipment_id = int(shipment_match.group(1))
+        body = parsed.get_payload(decode=True).decode(errors='replace')
+
+        with self.condition:
+            if 'Final Offer Request' in parsed['Subject']:
+                quote_type = 'final'
+                competing_bid = float(re.search(r'\$([\d,]+\.\d{2})', body).group(1).replace(',', ''))
+                if self.random.random() < self.negotiation_chance:
+                    text = self.FINAL_REPLY.format(price=competing_bid * self.random.uniform(0.95, 0.99), carrier=carrier)
+                else:
+                    text = self.DECLINE_REPLY.format(carrier=carrier)
+            else:
+                quote_type = 'initial'
+                details = {
+                    'spots': int(re.search(r'Spots\): (\d+)', body).group(1)),
+                    'weight': float(re.search(r'Weight \(lbs\): ([\d.]+)', body).group(1)),
+                    'destination_zip': re.search(r'Destination ZIP: (\S+)', body).group(1),
+                }
+                price = self.price(carrier, details) * self.random.uniform(0.9, 1.1)
+                template = (self.AMBIGUOUS_INITIAL_REPLY if self.random.random() < self.ambiguous_fraction
+                            else self.random.choice(self.INITIAL_REPLIES))
+                text = template.format(shipment_id=shipment_id, price=price, carrier=carrier)
+
+            contact = next(contact for contact, name in self.carriers_by_contact.items() if name == carrier)
+            self.sequence += 1
+            threading_headers = ''
+            if parsed['Message-ID']:
+                threading_headers = f"In-Reply-To: {parsed['Message-ID']}\r\nReferences: {parsed['Message-ID']}\r\n"
+            raw = (f"From: {contact}\r\nTo: {message['to'][0]}\r\nSubject: Re: {parsed['Subject']}\r\n"
+                   f"Message-ID: <reply-{self.sequence}@{contact.split('@')[-1]}>\r\n{threading_headers}\r\n{text}\r\n")
+            due = time.monotonic() + self.latency()
+            heapq.heappush(self.scheduled, (due, self.sequence, (shipment_id, carrier, quote_type, raw)))
+            self.condition.notify()
+
+    def _deliver_loop(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.scheduled or self.scheduled[0][0] > time.monotonic()):
+                    self.condition.wait(self.scheduled[0][0] - time.monotonic() if self.scheduled else None)
+                if not self.running:
+                    return
+                _, _, (shipment_id, carrier, quote_type, raw) = heapq.heappop(self.scheduled)
+            uid = self.imap_server.deliver(raw)
+            self.replies += 1
+            if self.on_reply:
+                self.on_reply(shipment_id, carrier, quote_type, uid, time.monotonic())
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._deliver_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
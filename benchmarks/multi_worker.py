@@ -0,0 +1,257 @@
+# benchmarks/multi_worker.py
+"""
+Runs several worker processes at once against one database, then checks that
+every shipment completed and that no email was queued or sent twice.
+
+The workers poll rather than wait for wakeup notices, so every worker runs
+every phase every --poll-seconds and they all compete for the same shipments.
+One of them is killed part-way through (--kill-after, 0 to keep them all), so
+the others have to take over its leases. Carriers are the usual fake email
+carriers replying through a fake IMAP inbox, plus one fake API carrier.
+
+    python -m benchmarks.multi_worker [-n 200] [--workers 4] [--rate 50]
+
+Exits with status 1 if anything was sent twice or a shipment didn't complete.
+"""
+import argparse
+import contextlib
+import email
+import io
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+NUM_SHIPMENTS = 200
+NUM_WORKERS = 4
+NUM_EMAIL_CARRIERS = 3
+TIMEOUT_SECONDS = 300
+
+
+def run_worker(settings):
+    """
+    Child process: one worker pointed at the parent's fake services, started
+    through worker.main() like `python worker.py`, until SIGTERM. Every worker
+    asks for the same metrics port, as they would on one host.
+    """
+    import worker
+    from src import ai_parser, email_parser, leases
+
+    for module, name, value in [
+        (worker, 'DB_PATH', settings['db_path']), (worker, 'CARRIERS', settings['carriers']),
+        (worker, 'RETRAIN_CHECK_MINUTES', 0), (worker, 'POLLING_INTERVAL_SECONDS', settings['poll_seconds']),
+        (worker, 'WORKER_WAKEUP_PORT', 0), (worker, 'WORKER_CLAIM_BATCH', settings['claim_batch']),
+        (worker, 'WORKER_METRICS_PORT', settings['metrics_port']),
+        (email_parser, 'IMAP_SERVER', '127.0.0.1'), (email_parser, 'IMAP_PORT', settings['imap_port']),
+        (email_parser, 'IMAP_USE_SSL', False),
+        (ai_parser, 'GEMINI_BASE_URL', settings['gemini_url']), (ai_parser, '_client', None),
+        (ai_parser, 'AI_CACHE_PATH', settings['ai_cache_path']), (ai_parser, '_cache_conn', None),
+        (leases, 'WORKER_LEASE_SECONDS', settings['lease_seconds']),
+        (leases, 'WORKER_HEARTBEAT_SECONDS', settings['lease_seconds'] / 4),
+    ]:
+        setattr(module, name, value)
+
+    worker.main()
+
+
+def free_tcp_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def add_shipments(db_path, num_shipments, rate, rng):
+    from src import db
+    conn = db.connect(db_path)
+    for _ in range(num_shipments):
+        conn.execute(
+            "INSERT INTO shipments (request_date, spots, weight, destination_zip, status) VALUES (?, ?, ?, ?, 'quoting')",
+            (time.strftime('%Y-%m-%dT%H:%M:%S'), rng.randint(1, 12), rng.randint(500, 15000), f"{rng.randint(501, 99950):05d}")
+        )
+        conn.commit()
+        if rate:
+            time.sleep(1 / rate)
+    conn.close()
+
+
+def count_completed(db_path):
+    from src import db
+    conn = db.connect(db_path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM shipments WHERE status = 'complete'").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def find_duplicates(db_path, smtp_messages):
+    """Returns (emails sent more than once, outbox messages queued more than once)."""
+    from src import db
+    sent = Counter()
+    for message in smtp_messages:
+        parsed = email.message_from_string(message['data'])
+        sent[(message['to'][0], parsed['Subject'])] += 1
+    conn = db.connect(db_path)
+    try:
+        queued = conn.execute(
+            "SELECT recipient, subject, COUNT(*) FROM outbox GROUP BY recipient, subject HAVING COUNT(*) > 1"
+        ).fetchall()
+    finally:
+        conn.close()
+    return {key: count for key, count in sent.items() if count > 1}, queued
+
+
+def run_check(num_shipments, num_workers, rate, poll_seconds, lease_seconds, kill_after, claim_batch, timeout, seed):
+    import sender
+    from benchmarks.fake_services import FakeCarrierAPI, FakeEmailCarriers, FakeGeminiAPI, FakeIMAPServer, FakeSMTPServer
+    from src import db, email_utils, outbox, wakeups
+    from src.database_setup import create_database
+
+    rng = random.Random(seed)
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, "multi_worker.db")
+    contacts = {f"Carrier {i}": f"quotes@carrier{i}.example.com" for i in range(1, NUM_EMAIL_CARRIERS + 1)}
+
+    imap_server = FakeIMAPServer().start()
+    carriers = FakeEmailCarriers(imap_server, contacts, latency=lambda: rng.uniform(0.2, 0.8), seed=seed).start()
+    smtp_server = FakeSMTPServer(on_message=carriers.handle_request).start()
+    gemini = FakeGeminiAPI().start()
+    carrier_api = FakeCarrierAPI(latency=lambda: rng.uniform(0.05, 0.3),
+                                 price=lambda shipment: round(150 + shipment['weight'] * 0.21, 2)).start()
+    carriers_config = {name: {'type': 'email', 'contact': contact} for name, contact in contacts.items()}
+    carriers_config["API Freight"] = {'type': 'api', 'url': carrier_api.url, 'timeout': 5}
+
+    saved = [
+        (sender, 'DB_PATH', db_path), (sender, 'SENDER_WAKEUP_PORT', 0), (wakeups, 'SENDER_WAKEUP_PORT', 0),
+        (email_utils, 'SMTP_SERVER', '127.0.0.1'), (email_utils, 'SMTP_PORT', smtp_server.port),
+        (email_utils, 'SMTP_USE_SSL', False), (outbox, 'OUTBOX_DOMAIN_RATE_PER_MINUTE', 10 ** 9),
+    ]
+    saved = [(module, name, getattr(module, name), value) for module, name, value in saved]
+    for module, name, _, value in saved:
+        setattr(module, name, value)
+
+    metrics_port = free_tcp_port()
+    workers, logs, killed = [], [], None
+    stop = threading.Event()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_database(db_path)
+        for index in range(num_workers):
+            settings = {
+                'db_path': db_path, 'carriers': carriers_config, 'poll_seconds': poll_seconds,
+                'claim_batch': claim_batch, 'lease_seconds': lease_seconds, 'imap_port': imap_server.port,
+                'gemini_url': gemini.url, 'ai_cache_path': os.path.join(workdir, f"ai_cache_{index}.db"),
+                'metrics_port': metrics_port,
+            }
+            log_file = open(os.path.join(workdir, f"worker_{index}.log"), 'w+')
+            logs.append(log_file)
+            workers.append(subprocess.Popen(
+                [sys.executable, '-m', 'benchmarks.multi_worker', '--run-worker', json.dumps(settings)],
+                stdout=log_file, stderr=subprocess.STDOUT,
+            ))
+
+        # Two senders, so the outbox claim is raced as well.
+        senders = [threading.Thread(target=sender.sender_loop, args=(stop,), daemon=True) for _ in range(2)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for thread in senders:
+                thread.start()
+            start = time.monotonic()
+            add_shipments(db_path, num_shipments, rate, rng)
+            completed = 0
+            while completed < num_shipments and time.monotonic() - start < timeout:
+                if kill_after and killed is None and time.monotonic() - start >= kill_after:
+                    killed = 0
+                    workers[killed].kill() # No chance to release its leases
+                time.sleep(0.2)
+                completed = count_completed(db_path)
+            wall_seconds = time.monotonic() - start
+            stop.set()
+            for thread in senders:
+                thread.join(timeout=30)
+    finally:
+        stop.set()
+        for process in workers:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for process in workers:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for module, name, original, _ in saved:
+            setattr(module, name, original)
+        carriers.stop()
+        for server in (smtp_server, imap_server, gemini, carrier_api):
+            server.stop()
+        email_utils.close_smtp_pool()
+        db.close_pools()
+
+    try:
+        duplicate_sends, duplicate_queued = find_duplicates(db_path, smtp_server.messages)
+        started, errors, exporters_disabled = [], [], 0
+        for log_file in logs:
+            log_file.seek(0)
+            lines = log_file.read().splitlines()
+            log_file.close()
+            started.append(sum(int(line.split(' for ')[1].split()[0]) for line in lines if 'Initial quote requests queued' in line))
+            errors += [line for line in lines if 'ERROR' in line or 'Traceback' in line]
+            exporters_disabled += any("exporter is disabled" in line for line in lines)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'shipments': num_shipments, 'completed': completed, 'wall_seconds': wall_seconds,
+        'workers': num_workers, 'killed_worker': killed, 'started_by_worker': started,
+        'emails_sent': len(smtp_server.messages), 'duplicate_sends': duplicate_sends,
+        'duplicate_queued': duplicate_queued, 'errors': errors, 'exporters_disabled': exporters_disabled,
+    }
+
+
+def print_report(results):
+    killed = results['killed_worker']
+    print(f"{results['workers']} workers{f', worker {killed} killed part-way' if killed is not None else ''}: "
+          f"completed {results['completed']}/{results['shipments']} shipments in {results['wall_seconds']:.1f}s")
+    print(f"Shipments started by each worker: {results['started_by_worker']}")
+    print(f"Workers running without a metrics exporter (port already taken): {results['exporters_disabled']}")
+    print(f"Emails sent {results['emails_sent']}, sent more than once {len(results['duplicate_sends'])}, "
+          f"queued more than once {len(results['duplicate_queued'])}")
+    for (recipient, subject), count in list(results['duplicate_sends'].items())[:10]:
+        print(f"  ❌ sent {count}x: {recipient} {subject}")
+    for recipient, subject, count in results['duplicate_queued'][:10]:
+        print(f"  ❌ queued {count}x: {recipient} {subject}")
+    if results['errors']:
+        print(f"\n{len(results['errors'])} error line(s) in the worker logs, e.g.:")
+        for line in results['errors'][:5]:
+            print(f"  {line}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--run-worker':
+        run_worker(json.loads(sys.argv[2]))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--shipments', type=int, default=NUM_SHIPMENTS)
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS)
+    parser.add_argument('--rate', type=float, default=50, help="new shipments per second (0: all at once)")
+    parser.add_argument('--poll-seconds', type=float, default=0.2, help="how often each worker runs every phase")
+    parser.add_argument('--lease-seconds', type=float, default=3, help="lease length; heartbeats come 4x as often")
+    parser.add_argument('--kill-after', type=float, default=2, help="seconds until one worker is killed (0: never)")
+    parser.add_argument('--claim-batch', type=int, default=10, help="new shipments a worker claims at a time")
+    parser.add_argument('--timeout', type=float, default=TIMEOUT_SECONDS)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    results = run_check(args.shipments, args.workers, args.rate, args.poll_seconds, args.lease_seconds,
+                        args.kill_after, args.claim_batch, args.timeout, args.seed)
+    print_report(results)
+    ok = not results['duplicate_sends'] and not results['duplicate_queued'] and results['completed'] == results['shipments']
+    print("\n✅ No email was sent twice." if ok else "\n❌ Check failed.")
+    sys.exit(0 if ok else 1)
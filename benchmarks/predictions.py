@@ -0,0 +1,82 @@
+# benchmarks/predictions.py
+"""
+Measures final-offer predictions per second: the old way (load the model file
+and build a one-row frame for every prediction), one-at-a-time with the model
+cache, and predict_final_offers_batch over all pairs at once.
+
+    python -m benchmarks.predictions [num_pairs]
+"""
+import contextlib
+import io
+import sys
+import tempfile
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import HistGradientBoostingRegressor
+
+from src import ml_model
+
+NUM_PAIRS = 20_000
+CARRIERS = ["Budget Freight", "Premium Express", "Regional Pro"]
+LEGACY_SAMPLE = 300 # The old path is slow; time a sample and extrapolate
+
+
+def synthetic_pairs(rng, n):
+    weight = rng.integers(500, 15000, n)
+    initial = 150 + weight * rng.uniform(0.14, 0.26, n)
+    return pd.DataFrame({
+        'carrier_name': rng.choice(CARRIERS, n),
+        'spots': rng.integers(1, 13, n),
+        'weight': weight,
+        'destination_zip': [f"{z:05d}" for z in rng.integers(501, 99950, n)],
+        'carrier_initial_bid': initial,
+        'lowest_competing_bid': initial * rng.uniform(0.85, 1.0, n),
+    })
+
+
+def train_models(rng):
+    for carrier_name in CARRIERS:
+        df = synthetic_pairs(rng, 2000)
+        model = HistGradientBoostingRegressor(max_iter=50)
+        model.fit(ml_model.build_features(df), df['lowest_competing_bid'] * 0.97)
+        joblib.dump(model, ml_model.get_model_path(carrier_name))
+
+
+def run_benchmark(num_pairs):
+    rng = np.random.default_rng(0)
+    ml_model.MODELS_DIR = tempfile.mkdtemp()
+    train_models(rng)
+    pairs = synthetic_pairs(rng, num_pairs)
+    rows = pairs.to_dict('records')
+
+    def one_at_a_time(row):
+        return ml_model.predict_final_offer(row['carrier_name'], row, row['carrier_initial_bid'], row['lowest_competing_bid'])
+
+    # Old behaviour: every prediction reloads the model from disk.
+    start = time.perf_counter()
+    for row in rows[:LEGACY_SAMPLE]:
+        ml_model._model_cache.clear()
+        one_at_a_time(row)
+    legacy_rate = LEGACY_SAMPLE / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for row in rows[:LEGACY_SAMPLE]:
+        one_at_a_time(row)
+    cached_rate = LEGACY_SAMPLE / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        predictions = ml_model.predict_final_offers_batch(pairs)
+    batch_rate = num_pairs / (time.perf_counter() - start)
+
+    print(f"Scored {predictions.notna().sum()} of {num_pairs} pairs.")
+    print(f"Reload per prediction: {legacy_rate:10,.0f} predictions/s")
+    print(f"Cached, one at a time: {cached_rate:10,.0f} predictions/s")
+    print(f"Batched:               {batch_rate:10,.0f} predictions/s ({batch_rate / legacy_rate:.0f}x)")
+
+
+if __name__ == '__main__':
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else NUM_PAIRS)
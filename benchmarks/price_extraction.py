@@ -0,0 +1,76 @@
+# benchmarks/price_extraction.py
+"""
+Measures the local price extractor against the labelled corpus in
+benchmarks/price_corpus.json: how many replies it answers on its own, how
+accurate those answers are, and how many emails per second it gets through.
+
+Pass --ai to also run every corpus email through the Gemini-only path (this
+makes real API calls) for an accuracy and latency comparison.
+
+    python -m benchmarks.price_extraction [--ai]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+from src import ai_parser
+from src.price_extractor import PRICE_EXTRACTOR_MIN_CONFIDENCE, extract_price
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), "price_corpus.json")
+THROUGHPUT_ROUNDS = 200
+
+
+def load_corpus():
+    with open(CORPUS_PATH) as f:
+        return json.load(f)
+
+
+def is_correct(price, expected):
+    if price is None or expected is None:
+        return price == expected
+    return abs(price - expected) < 0.01
+
+
+def benchmark_extractor(corpus):
+    confident = correct = 0
+    for case in corpus:
+        price, confidence = extract_price(case['body'])
+        if confidence >= PRICE_EXTRACTOR_MIN_CONFIDENCE:
+            confident += 1
+            correct += is_correct(price, case['price'])
+
+    start = time.perf_counter()
+    for _ in range(THROUGHPUT_ROUNDS):
+        for case in corpus:
+            extract_price(case['body'])
+    elapsed = time.perf_counter() - start
+    emails = THROUGHPUT_ROUNDS * len(corpus)
+
+    print("Local extractor:")
+    print(f"  Handled locally: {confident}/{len(corpus)} ({confident / len(corpus):.0%})")
+    print(f"  Accuracy when confident: {correct}/{confident}" if confident else "  Accuracy when confident: n/a")
+    print(f"  Throughput: {emails / elapsed:,.0f} emails/s ({1e6 * elapsed / emails:.1f} µs/email)")
+
+
+def benchmark_ai(corpus):
+    # A throwaway cache so every email really goes to the API.
+    ai_parser.AI_CACHE_PATH = os.path.join(tempfile.mkdtemp(), "cache.db")
+
+    correct = 0
+    start = time.perf_counter()
+    for case in corpus:
+        correct += is_correct(ai_parser.parse_quote_with_ai(case['body']), case['price'])
+    elapsed = time.perf_counter() - start
+
+    print("AI-only path:")
+    print(f"  Accuracy: {correct}/{len(corpus)}")
+    print(f"  Throughput: {len(corpus) / elapsed:,.2f} emails/s ({1000 * elapsed / len(corpus):.0f} ms/email)")
+
+
+if __name__ == '__main__':
+    corpus = load_corpus()
+    benchmark_extractor(corpus)
+    if '--ai' in sys.argv:
+        benchmark_ai(corpus)
@@ -0,0 +1,65 @@
+# benchmarks/smtp_pool.py
+"""
+Sends a batch of emails to a local fake SMTP server, once with a fresh
+connection and login per message (the old behaviour) and once through the
+pooled, parallel send_emails.
+
+    python -m benchmarks.smtp_pool [num_messages]
+"""
+import contextlib
+import io
+import smtplib
+import sys
+import time
+from email.message import EmailMessage
+
+from benchmarks.fake_services import FakeSMTPServer
+from src import email_utils
+
+NUM_MESSAGES = 200
+# Roughly what a TLS handshake and login cost against a real provider.
+CONNECT_DELAY = 0.03
+LOGIN_DELAY = 0.02
+SEND_DELAY = 0.005
+
+
+def send_unpooled(port, messages):
+    for recipient_email, subject, body in messages:
+        msg = EmailMessage()
+        msg.set_content(body)
+        msg['Subject'] = subject
+        msg['From'] = email_utils.SENDER_EMAIL
+        msg['To'] = recipient_email
+        server = smtplib.SMTP('127.0.0.1', port)
+        server.login(email_utils.SENDER_EMAIL, email_utils.SENDER_PASSWORD)
+        server.send_message(msg)
+        server.quit()
+
+
+def run_benchmark(num_messages):
+    server = FakeSMTPServer(CONNECT_DELAY, LOGIN_DELAY, SEND_DELAY).start()
+    email_utils.SMTP_SERVER, email_utils.SMTP_PORT, email_utils.SMTP_USE_SSL = '127.0.0.1', server.port, False
+    messages = [(f"carrier{i % 10}@example.com", f"Quote Request - Shipment #{i}", "Please quote.") for i in range(num_messages)]
+
+    try:
+        start = time.perf_counter()
+        send_unpooled(server.port, messages)
+        unpooled_time = time.perf_counter() - start
+        unpooled_logins = server.logins
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = email_utils.send_emails(messages)
+        pooled_time = time.perf_counter() - start
+        pooled_logins = server.logins - unpooled_logins
+        email_utils.close_smtp_pool()
+    finally:
+        server.stop()
+
+    print(f"Sent {num_messages} messages ({sum(results)} succeeded through the pool).")
+    print(f"Connection per message: {unpooled_time:.2f}s, {unpooled_logins} logins")
+    print(f"Pooled ({email_utils.SMTP_POOL_SIZE} sessions): {pooled_time:.2f}s, {pooled_logins} logins ({unpooled_time / pooled_time:.1f}x faster)")
+
+
+if __name__ == '__main__':
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else NUM_MESSAGES)
@@ -0,0 +1,167 @@
+# benchmarks/worker_cycle.py
+"""
+Compares one worker cycle of the set-based transition engine in worker.py with
+the original per-shipment loop on a synthetic database.
+
+Run from the project root:
+    python -m benchmarks.worker_cycle [num_shipments]
+"""
+import contextlib
+import io
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import worker
+from src.config import CARRIERS
+from src.database_setup import create_database
+
+NUM_SHIPMENTS = 100_000
+
+
+# --- The original per-shipment implementation, kept here as the baseline ---
+
+def legacy_start_new_shipments(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT shipment_id, spots, weight, destination_zip FROM shipments WHERE status = 'quoting'")
+    for shipment_id, spots, weight, destination_zip in cursor.fetchall():
+        cursor.execute("UPDATE shipments SET status = 'processing_initial' WHERE shipment_id = ?", (shipment_id,))
+        conn.commit()
+        for name in CARRIERS:
+            cursor.execute("INSERT INTO quotes (shipment_id, carrier_name, quote_type) VALUES (?, ?, ?)", (shipment_id, name, 'initial'))
+        cursor.execute("UPDATE shipments SET status = 'awaiting_initial_quotes' WHERE shipment_id = ?", (shipment_id,))
+        conn.commit()
+
+
+def legacy_advance_to_negotiation(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT s.shipment_id FROM shipments s
+        WHERE s.status = 'awaiting_initial_quotes' AND
+              (SELECT COUNT(*) FROM quotes q WHERE q.shipment_id = s.shipment_id AND q.quote_type = 'initial' AND q.status IN ('received', 'failed')) = ?
+    """, (len(CARRIERS),))
+    for (shipment_id,) in cursor.fetchall():
+        cursor.execute("SELECT carrier_name, price FROM quotes WHERE shipment_id = ? AND quote_type = 'initial' AND status = 'received' ORDER BY price ASC LIMIT 1", (shipment_id,))
+        result = cursor.fetchone()
+        if not result:
+            cursor.execute("UPDATE shipments SET status = 'complete', final_winner = 'No Bids' WHERE shipment_id = ?", (shipment_id,))
+            conn.commit()
+            continue
+        leader_carrier, lowest_bid = result
+        cursor.execute("SELECT carrier_name FROM quotes WHERE shipment_id = ? AND quote_type = 'initial' AND status = 'received' AND carrier_name != ?", (shipment_id, leader_carrier))
+        if not cursor.fetchall():
+            cursor.execute("UPDATE shipments SET status = 'complete', final_winner = ?, final_price = ? WHERE shipment_id = ?", (leader_carrier, lowest_bid, shipment_id))
+        else:
+            cursor.execute("UPDATE shipments SET status = 'awaiting_final_offers' WHERE shipment_id = ?", (shipment_id,))
+        conn.commit()
+
+
+def legacy_complete_shipments(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT shipment_id FROM shipments WHERE status = 'awaiting_final_offers'")
+    for (shipment_id,) in cursor.fetchall():
+        cursor.execute("""
+            SELECT COUNT(*) FROM quotes
+            WHERE shipment_id = ? AND quote_type = 'initial' AND status = 'received' AND
+                  price > (SELECT MIN(price) FROM quotes WHERE shipment_id = ? AND quote_type = 'initial' AND status = 'received')
+        """, (shipment_id, shipment_id))
+        expected_final_offers = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM quotes WHERE shipment_id = ? AND quote_type = 'final' AND status IN ('received', 'failed')", (shipment_id,))
+        if cursor.fetchone()[0] >= expected_final_offers:
+            cursor.execute("SELECT carrier_name, price FROM quotes WHERE shipment_id = ? AND quote_type = 'initial' AND status = 'received' ORDER BY price ASC LIMIT 1", (shipment_id,))
+            final_winner, final_price = cursor.fetchone()
+            cursor.execute("SELECT carrier_name, price FROM quotes WHERE shipment_id = ? AND quote_type = 'final' AND status = 'received' ORDER BY price ASC LIMIT 1", (shipment_id,))
+            best_final_offer = cursor.fetchone()
+            if best_final_offer and best_final_offer[1] < final_price:
+                final_winner, final_price = best_final_offer
+            cursor.execute("UPDATE shipments SET status = 'complete', final_winner = ?, final_price = ? WHERE shipment_id = ?", (final_winner, final_price, shipment_id))
+            conn.commit()
+
+
+# --- Synthetic data ---
+
+def build_database(path, num_shipments):
+    """Creates a database with shipments spread over every open state."""
+    create_database(path)
+    conn = sqlite3.connect(path)
+    rng = random.Random(42)
+    now = datetime.now().isoformat()
+    statuses = ['quoting', 'awaiting_initial_quotes', 'awaiting_initial_quotes', 'awaiting_final_offers']
+    carriers = list(CARRIERS)
+
+    shipments, quotes = [], []
+    for shipment_id in range(1, num_shipments + 1):
+        status = statuses[shipment_id % len(statuses)]
+        shipments.append((shipment_id, now, rng.randint(1, 12), rng.randint(500, 15000), f"{rng.randint(501, 99950):05d}", status))
+        if status == 'quoting':
+            continue
+
+        prices = {name: round(rng.uniform(500, 5000), 2) for name in carriers}
+        # Half of the initial rounds are still waiting on a reply.
+        initial_done = status == 'awaiting_final_offers' or shipment_id % 8 < 4
+        for name, price in prices.items():
+            if initial_done:
+                quotes.append((shipment_id, name, 'initial', price, 'received'))
+            else:
+                quotes.append((shipment_id, name, 'initial', None, 'pending'))
+        if status == 'awaiting_final_offers':
+            lowest = min(prices.values())
+            for name, price in prices.items():
+                if price > lowest:
+                    quotes.append((shipment_id, name, 'final', round(lowest * 0.97, 2), 'received'))
+
+    conn.executemany("INSERT INTO shipments (shipment_id, request_date, spots, weight, destination_zip, status) VALUES (?, ?, ?, ?, ?, ?)", shipments)
+    conn.executemany("INSERT INTO quotes (shipment_id, carrier_name, quote_type, price, status) VALUES (?, ?, ?, ?, ?)", quotes)
+    conn.commit()
+    conn.close()
+
+
+def status_snapshot(path):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT shipment_id, status, final_winner, final_price FROM shipments ORDER BY shipment_id").fetchall()
+    conn.close()
+    return rows
+
+
+def time_cycle(path, phases):
+    conn = sqlite3.connect(path)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for phase in phases:
+            phase(conn)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed
+
+
+def run_benchmark(num_shipments):
+    workdir = tempfile.mkdtemp()
+    try:
+        template = os.path.join(workdir, "template.db")
+        print(f"Building synthetic database with {num_shipments} shipments...")
+        build_database(template, num_shipments)
+
+        legacy_db = os.path.join(workdir, "legacy.db")
+        batched_db = os.path.join(workdir, "batched.db")
+        shutil.copy(template, legacy_db)
+        shutil.copy(template, batched_db)
+
+        legacy_time = time_cycle(legacy_db, [legacy_start_new_shipments, legacy_advance_to_negotiation, legacy_complete_shipments])
+        batched_time = time_cycle(batched_db, [worker.start_new_shipments, worker.advance_to_negotiation, worker.complete_shipments])
+
+        if status_snapshot(legacy_db) != status_snapshot(batched_db):
+            print("❌ The two implementations produced different shipment states!")
+
+        print(f"Per-shipment loop: {legacy_time:.2f}s")
+        print(f"Set-based engine:  {batched_time:.2f}s ({legacy_time / batched_time:.1f}x faster)")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else NUM_SHIPMENTS)
@@ -0,0 +1,218 @@
+# explain_queries.py
+"""
+Runs every query the Flask app, the worker and the outbox sender issue against a scratch database
+and prints SQLite's EXPLAIN QUERY PLAN for each one. Any plan that falls back to
+a full table scan of `shipments` or `quotes` is flagged, and the script exits
+with status 1 so it can be used as a CI check.
+
+    python explain_queries.py
+"""
+import contextlib
+import io
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime
+
+from src.database_setup import create_database
+
+HOT_TABLES = ('shipments', 'quotes')
+
+_real_connect = sqlite3.connect
+captured_queries = {}
+
+
+def _capture(statement):
+    """Trace callback: remembers one example of every distinct data query that gets executed."""
+    statement = ' '.join(re.sub(r'--[^\n]*', '', statement).split())
+    if re.match(r'(SELECT|WITH|INSERT|UPDATE|DELETE)\b', statement, re.IGNORECASE):
+        # Queries that only differ in their bound values share one plan.
+        shape = re.sub(r"'[^']*'|\b\d+(\.\d+)?\b", '?', statement)
+        captured_queries.setdefault(shape, statement)
+
+
+def _tracing_connect(*args, **kwargs):
+    conn = _real_connect(*args, **kwargs)
+    conn.set_trace_callback(_capture)
+    return conn
+
+
+class _FakeMessage:
+    def __init__(self, uid, from_, subject, text):
+        self.uid, self.from_, self.subject, self.text = uid, from_, subject, text
+        self.headers = {'message-id': (f'<{uid}@carrier.example>',), 'in-reply-to': (f'<request-{uid}@example.com>',)}
+
+
+class _FakeMailBox:
+    """Stands in for imap_tools.MailBox so the parser's queries run offline."""
+    messages = []
+
+    def __init__(self, *args, **kwargs):
+        self.folder = self
+        self.client = self
+
+    def login(self, *args, **kwargs):
+        return self
+
+    def logout(self):
+        pass
+
+    def noop(self):
+        pass
+
+    def status(self, *args, **kwargs):
+        return {'UIDVALIDITY': 1, 'UIDNEXT': 1}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def uids(self, *args, **kwargs):
+        return [message.uid for message in self.messages]
+
+    def fetch(self, *args, **kwargs):
+        return list(self.messages)
+
+    def flag(self, *args, **kwargs):
+        pass
+
+
+def seed_database(db_path, carriers):
+    """Puts a couple of shipments in every state the worker handles."""
+    conn = _real_connect(db_path)
+    now = datetime.now().isoformat()
+    names = list(carriers)
+    for status in ('quoting', 'awaiting_initial_quotes', 'awaiting_final_offers', 'complete'):
+        for copy in range(2):
+            shipment_id = conn.execute(
+                "INSERT INTO shipments (request_date, spots, weight, destination_zip, status) VALUES (?, 4, 1200, '10001', ?)",
+                (now, status)
+            ).lastrowid
+            if status == 'quoting':
+                continue
+            for offset, name in enumerate(names):
+                conn.execute(
+                    "INSERT INTO quotes (shipment_id, carrier_name, quote_type, price, status) VALUES (?, ?, 'initial', ?, 'received')",
+                    (shipment_id, name, 1000 + 100 * offset)
+                )
+            if status == 'awaiting_final_offers':
+                # One carrier and one whole shipment that have run out of time.
+                conn.execute(
+                    "INSERT INTO deadlines (shipment_id, phase, carrier_name, deadline_at) VALUES (?, ?, ?, '2000-01-01T00:00:00')",
+                    (shipment_id, status, '' if copy else names[-1])
+                )
+    conn.commit()
+    conn.close()
+
+
+def collect_queries(db_path):
+    """Drives the app endpoints and one worker cycle with all external services stubbed."""
+    import app
+    import sender
+    import worker
+    from src import deadlines, email_parser, events, leases, ml_model, outbox
+    from src.config import CARRIERS
+
+    app.DB_PATH = sender.DB_PATH = worker.DB_PATH = ml_model.DB_PATH = db_path
+    outbox.send_emails = lambda messages: [True] * len(messages)
+    email_parser.MailBox = _FakeMailBox
+    email_parser.parse_quotes = lambda bodies: [950.0] * len(bodies)
+
+    carrier_name, info = next(iter(CARRIERS.items()))
+    _FakeMailBox.messages = [
+        _FakeMessage('1', info.get('contact'), 'Re: Quote Request - Shipment #3', 'Our price is $950.'),
+        _FakeMessage('2', info.get('contact'), 'Re: Final Offer Request - Shipment #5', 'Best and final: $950.'),
+    ]
+
+    seed_database(db_path, CARRIERS)
+    sqlite3.connect = _tracing_connect
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            client = app.app.test_client()
+            client.get('/api/shipments')
+            client.get('/api/shipments?limit=5&cursor=3&status=complete')
+            client.get(f'/api/shipments?carrier={carrier_name}')
+            client.get('/api/shipments?id=1')
+            client.post('/api/shipments', json={'spots': 2, 'weight': 800, 'destination_zip': '60601'})
+            client.get('/api/quotes/1')
+            client.get('/api/stats')
+            client.get('/metrics')
+            conn = sqlite3.connect(db_path)
+            events.read_changes(conn, 0)
+            events.oldest_change_id(conn)
+            conn.close()
+
+            conn = worker.get_db_connection()
+            leases.register_worker(conn)
+            deadlines.schedule_missing_deadlines(conn)
+            email_parser.parse_incoming_quotes(conn, CARRIERS) # First sync: scans unread messages
+            worker.check_mail(conn) # Incremental, from the saved UID, under the inbox lease
+            worker.resume_abandoned_shipments(conn)
+            worker.start_new_shipments(conn)
+            worker.advance_to_negotiation(conn)
+            worker.complete_shipments(conn)
+            worker.timeout_stale_shipments(conn)
+            worker.seconds_until_next_deadline(conn)
+            leases.renew_leases(conn)
+            leases.release_leases(conn)
+            events.prune_change_log(conn)
+            conn.close()
+
+            conn = sender.get_db_connection()
+            outbox.release_stale_messages(conn)
+            outbox.drain_outbox(conn)
+            conn.close()
+
+            ml_model.prepare_training_data(carrier_name)
+            conn = sqlite3.connect(db_path)
+            ml_model.carriers_due_for_training(conn)
+            ml_model.get_model_registry(conn, carrier_name)
+            conn.close()
+    finally:
+        sqlite3.connect = _real_connect
+
+
+# An unfiltered scan that walks the table in primary key order and stops at a
+# LIMIT (the newest page of a keyset-paginated list) reads only LIMIT rows.
+_KEYSET_PAGE = re.compile(r'ORDER BY (shipment_id|quote_id)( DESC| ASC)? LIMIT \d+$', re.IGNORECASE)
+
+
+def find_full_scans(plan_rows, query=''):
+    """Returns the plan steps that read a hot table without using any index."""
+    details = [detail for _, _, _, detail in plan_rows]
+    if _KEYSET_PAGE.search(query) and ' WHERE ' not in query.upper() and not any('TEMP B-TREE FOR ORDER BY' in detail for detail in details):
+        return []
+    return [
+        detail for detail in details
+        if re.match(rf'SCAN ({"|".join(HOT_TABLES)})\b', detail) and 'INDEX' not in detail
+    ]
+
+
+def report(db_path):
+    conn = _real_connect(db_path)
+    flagged = 0
+    for query in captured_queries.values():
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+        scans = find_full_scans(plan, query)
+        flagged += bool(scans)
+
+        print(f"\n{'⚠️ ' if scans else '✅'} {query}")
+        for _, parent, _, detail in plan:
+            print(f"      {'  ' if parent else ''}{detail}")
+    conn.close()
+
+    print(f"\n{len(captured_queries)} queries checked, {flagged} with full table scans.")
+    return flagged
+
+
+if __name__ == '__main__':
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, 'explain.db')
+    with contextlib.redirect_stdout(io.StringIO()):
+        create_database(db_path)
+    collect_queries(db_path)
+    sys.exit(1 if report(db_path) else 0)
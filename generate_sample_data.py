@@ -1,14 +1,30 @@
 # generate_sample_data.py
-
-import pandas as pd
+"""
+Generates synthetic completed shipments with every carrier's initial and final
+quote, vectorized with NumPy so millions of rows take seconds. Rows are
+produced in chunks and streamed to CSV, Parquet (needs pyarrow) or straight
+into the SQLite database. The same seed and chunk size always give the same
+data.
+
+    python generate_sample_data.py                                  # 500 rows to sample_shipment_data.csv
+    python generate_sample_data.py -n 10000000 -o load_test.parquet --seed 7
+    python generate_sample_data.py -n 1000000 --carriers 8 --sqlite
+"""
+import argparse
+import time
 import numpy as np
-import random
-from datetime import datetime, timedelta
+import pandas as pd
+from datetime import datetime
 
 # --- Configuration ---
 NUM_SHIPMENTS = 500
-CARRIERS = ["Budget Freight", "Premium Express", "Regional Pro"]
 START_DATE = datetime(2024, 1, 1)
+# Request dates are one per day until there are more shipments than this, then
+# spread evenly over this many days.
+DATE_RANGE_DAYS = 3 * 365
+CHUNK_ROWS = 1_000_000
+OUTPUT_PATH = "sample_shipment_data.csv"
+FIRST_SHIPMENT_ID = 1000
 
 # Define carrier "personalities" for pricing and negotiation
 CARRIER_PROFILES = {
@@ -36,100 +52,177 @@ CARRIER_PROFILES = {
     }
 }
 
-def generate_initial_quote(carrier, weight, spots, zip_code):
-    """Calculates an initial quote based on carrier profile."""
-    profile = CARRIER_PROFILES[carrier]
-
-    # Base price calculation
-    price = profile["base_rate"] + (weight * profile["weight_rate"]) + (spots * profile["spot_rate"])
-
-    # Apply regional discount for Regional Pro
-    if carrier == "Regional Pro" and any(zip_code.startswith(p) for p in profile["preferred_zips"]):
-        price *= 0.85 # 15% discount for preferred region
-
-    # Add some random noise to make it realistic
-    price *= np.random.uniform(0.95, 1.05)
-
-    return round(price, 2)
-
-def generate_final_offer(carrier, initial_quote, lowest_bid, zip_code):
-    """Calculates if a carrier will negotiate and what their final offer is."""
-    profile = CARRIER_PROFILES[carrier]
-
-    # Don't negotiate if you already have the lowest bid
-    if initial_quote == lowest_bid:
-        return initial_quote
-
-    # Regional Pro is less likely to negotiate outside its preferred region
-    negotiation_chance = profile["negotiation_chance"]
-    if carrier == "Regional Pro" and not any(zip_code.startswith(p) for p in profile["preferred_zips"]):
-        negotiation_chance *= 0.5
-
-    # Decide if the carrier will negotiate
-    if random.random() < negotiation_chance:
-        # Final offer is a discount on the competitor's lowest bid
-        final_offer = lowest_bid * profile["negotiation_strength"]
-        final_offer *= np.random.uniform(0.99, 1.01) # Add slight variance
-        return round(final_offer, 2)
-    else:
-        # No negotiation, price stays the same
-        return initial_quote
-
-def generate_data(num_shipments):
-    """Generates the full dataset and saves it to a CSV."""
-    print(f"Generating {num_shipments} sample shipments...")
-    data = []
-
-    for i in range(num_shipments):
-        # 1. Generate base shipment details
-        shipment_date = START_DATE + timedelta(days=i)
-        spots = random.randint(1, 12)
-        weight = random.randint(500, 15000)
-        zip_code = str(random.randint(501, 99950)).zfill(5)
-
-        # 2. Get initial quotes from all carriers
-        initial_quotes = {
-            carrier: generate_initial_quote(carrier, weight, spots, zip_code)
-            for carrier in CARRIERS
-        }
-
-        # 3. Find the initial low bidder
-        lowest_initial_bid = min(initial_quotes.values())
-
-        # 4. Get final negotiated offers
-        final_offers = {
-            carrier: generate_final_offer(carrier, initial_quotes[carrier], lowest_initial_bid, zip_code)
-            for carrier in CARRIERS
+# Carriers with preferred_zips give this discount inside their region, and are
+# half as likely to negotiate outside it.
+REGIONAL_DISCOUNT = 0.85
+
+# Every possible destination zip as a string, so a chunk's zips are one lookup.
+_ZIP_STRINGS = np.char.zfill(np.arange(100_000).astype('U5'), 5)
+
+
+def build_carrier_profiles(num_carriers, seed=None):
+    """
+    Returns `num_carriers` profiles: the ones in CARRIER_PROFILES first, then
+    made-up "Carrier N" profiles with rates in the same ranges.
+    """
+    profiles = dict(list(CARRIER_PROFILES.items())[:num_carriers])
+    rng = np.random.default_rng(seed)
+    for number in range(len(profiles) + 1, num_carriers + 1):
+        profile = {
+            "base_rate": int(rng.integers(120, 320)),
+            "weight_rate": round(float(rng.uniform(0.12, 0.28)), 3),
+            "spot_rate": int(rng.integers(45, 80)),
+            "negotiation_chance": round(float(rng.uniform(0.2, 0.9)), 2),
+            "negotiation_strength": round(float(rng.uniform(0.95, 0.99)), 3),
         }
+        if rng.random() < 0.3:
+            profile["preferred_zips"] = [str(digit) for digit in rng.choice(10, size=2, replace=False)]
+        profiles[f"Carrier {number}"] = profile
+    return profiles
+
+
+def _in_region(zip_codes, prefixes):
+    """True where the zero-padded zip starts with any of the prefixes."""
+    in_region = np.zeros(len(zip_codes), dtype=bool)
+    for prefix in prefixes:
+        in_region |= zip_codes // 10 ** (5 - len(prefix)) == int(prefix)
+    return in_region
+
+
+def generate_initial_quotes(rng, profiles, weight, spots, zip_codes):
+    """Returns a (shipments, carriers) array of initial quotes."""
+    quotes = np.empty((len(weight), len(profiles)))
+    for column, profile in enumerate(profiles.values()):
+        # Base price calculation
+        price = profile["base_rate"] + weight * profile["weight_rate"] + spots * profile["spot_rate"]
+        # Apply the regional discount
+        if profile.get("preferred_zips"):
+            price = np.where(_in_region(zip_codes, profile["preferred_zips"]), price * REGIONAL_DISCOUNT, price)
+        # Add some random noise to make it realistic
+        price = price * rng.uniform(0.95, 1.05, len(price))
+        quotes[:, column] = np.round(price, 2)
+    return quotes
+
+
+def generate_final_offers(rng, profiles, initial_quotes, zip_codes):
+    """Returns a (shipments, carriers) array of final offers."""
+    lowest_bid = initial_quotes.min(axis=1)
+    offers = initial_quotes.copy()
+    for column, profile in enumerate(profiles.values()):
+        # Regional carriers are less likely to negotiate outside their region
+        negotiation_chance = profile["negotiation_chance"]
+        if profile.get("preferred_zips"):
+            negotiation_chance = np.where(_in_region(zip_codes, profile["preferred_zips"]), negotiation_chance, negotiation_chance * 0.5)
+
+        # Nobody negotiates against their own lowest bid; the others undercut it
+        # with probability negotiation_chance, otherwise keep their price.
+        negotiates = (initial_quotes[:, column] != lowest_bid) & (rng.random(len(lowest_bid)) < negotiation_chance)
+        final_offer = np.round(lowest_bid * profile["negotiation_strength"] * rng.uniform(0.99, 1.01, len(lowest_bid)), 2)
+        offers[:, column] = np.where(negotiates, final_offer, initial_quotes[:, column])
+    return offers
+
+
+def generate_chunk(rng, profiles, first_row, num_rows, num_shipments):
+    """Generates rows first_row .. first_row + num_rows - 1 of a num_shipments dataset."""
+    row = np.arange(first_row, first_row + num_rows)
+
+    # 1. Generate base shipment details
+    days = min(num_shipments, DATE_RANGE_DAYS)
+    dates = (np.datetime64(START_DATE.date()) + np.arange(days)).astype('U10')
+    spots = rng.integers(1, 13, num_rows)
+    weight = rng.integers(500, 15001, num_rows)
+    zip_codes = rng.integers(501, 99951, num_rows)
+
+    # 2. Get initial quotes from all carriers and 3. final negotiated offers
+    initial_quotes = generate_initial_quotes(rng, profiles, weight, spots, zip_codes)
+    final_offers = generate_final_offers(rng, profiles, initial_quotes, zip_codes)
+
+    # 4. Determine the final winner (the first carrier on a tie)
+    winner = final_offers.argmin(axis=1)
+
+    # The string columns are categoricals over small lookup tables, so no
+    # per-row Python strings are built.
+    chunk = {
+        "shipment_id": FIRST_SHIPMENT_ID + row,
+        "request_date": pd.Categorical.from_codes(row * days // num_shipments, dates),
+        "spots": spots,
+        "weight": weight,
+        "destination_zip": pd.Categorical.from_codes(zip_codes, _ZIP_STRINGS),
+        "lowest_initial_bid": initial_quotes.min(axis=1),
+    }
+    for column, carrier in enumerate(profiles):
+        chunk[f"{carrier.replace(' ', '_')}_initial"] = initial_quotes[:, column]
+        chunk[f"{carrier.replace(' ', '_')}_final"] = final_offers[:, column]
+    chunk["final_winner"] = pd.Categorical.from_codes(winner, list(profiles))
+    chunk["final_price"] = final_offers[np.arange(num_rows), winner]
+    return pd.DataFrame(chunk)
+
+
+def generate_chunks(num_shipments, seed=None, profiles=None, chunk_rows=CHUNK_ROWS):
+    """Yields the dataset as DataFrames of up to chunk_rows rows."""
+    profiles = profiles or CARRIER_PROFILES
+    rng = np.random.default_rng(seed)
+    for first_row in range(0, num_shipments, chunk_rows):
+        yield generate_chunk(rng, profiles, first_row, min(chunk_rows, num_shipments - first_row), num_shipments)
+
+
+def _write_csv(chunks, path):
+    for number, chunk in enumerate(chunks):
+        chunk.to_csv(path, mode='w' if number == 0 else 'a', header=number == 0, index=False)
+        yield chunk
+
+
+def _write_parquet(chunks, path):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("❌ Parquet output needs pyarrow: pip install pyarrow")
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+            yield chunk
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def generate_data(num_shipments, output_path=OUTPUT_PATH, seed=None, profiles=None, chunk_rows=CHUNK_ROWS):
+    """Generates the full dataset and streams it to a .csv or .parquet file."""
+    print(f"Generating {num_shipments} sample shipments...")
+    writer = _write_parquet if output_path.endswith('.parquet') else _write_csv
+    start = time.perf_counter()
+    for chunk in writer(generate_chunks(num_shipments, seed, profiles, chunk_rows), output_path):
+        print(f"  {chunk['shipment_id'].iloc[-1] - FIRST_SHIPMENT_ID + 1} rows ({time.perf_counter() - start:.1f}s)")
+    print(f"✅ Sample data saved to {output_path} in {time.perf_counter() - start:.1f}s")
 
-        # 5. Determine the final winner
-        final_price = min(final_offers.values())
-        final_winner = [carrier for carrier, price in final_offers.items() if price == final_price][0]
-
-        # 6. Append to our dataset
-        record = {
-            "shipment_id": 1000 + i,
-            "request_date": shipment_date.strftime('%Y-%m-%d'),
-            "spots": spots,
-            "weight": weight,
-            "destination_zip": zip_code,
-            "lowest_initial_bid": lowest_initial_bid
-        }
-        # Add initial and final quotes for each carrier
-        for carrier in CARRIERS:
-            record[f"{carrier.replace(' ', '_')}_initial"] = initial_quotes[carrier]
-            record[f"{carrier.replace(' ', '_')}_final"] = final_offers[carrier]
 
-        record["final_winner"] = final_winner
-        record["final_price"] = final_price
+def generate_into_database(num_shipments, seed=None, profiles=None, chunk_rows=CHUNK_ROWS, db_path=None):
+    """Generates the dataset and bulk-imports it straight into SQLite, without a file in between."""
+    from import_data import bulk_import
+    from src.database_setup import DB_PATH, create_database
 
-        data.append(record)
+    create_database(db_path or DB_PATH)
+    bulk_import(generate_chunks(num_shipments, seed, profiles, chunk_rows), db_path=db_path)
 
-    df = pd.DataFrame(data)
-    df.to_csv("sample_shipment_data.csv", index=False)
-    print("✅ Sample data saved to sample_shipment_data.csv")
-    print("\nFirst 5 rows of the generated data:")
-    print(df.head())
 
 if __name__ == "__main__":
-    generate_data(NUM_SHIPMENTS)
+    parser = argparse.ArgumentParser(description="Generate synthetic shipment history.")
+    parser.add_argument('-n', '--shipments', type=int, default=NUM_SHIPMENTS)
+    parser.add_argument('-o', '--output', default=OUTPUT_PATH, help="a .csv or .parquet file")
+    parser.add_argument('--seed', type=int, help="seed for reproducible data")
+    parser.add_argument('--carriers', type=int, default=len(CARRIER_PROFILES), help="number of carriers")
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--sqlite', nargs='?', const='', metavar='DB_PATH',
+                        help="import into the database (the app's by default) instead of writing a file")
+    args = parser.parse_args()
+
+    carrier_profiles = build_carrier_profiles(args.carriers, args.seed)
+    if args.sqlite is not None:
+        generate_into_database(args.shipments, args.seed, carrier_profiles, args.chunk_rows, args.sqlite or None)
+    else:
+        generate_data(args.shipments, args.output, args.seed, carrier_profiles, args.chunk_rows)
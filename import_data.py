@@ -1,40 +1,143 @@
+import sys
+import time
 import pandas as pd
-import sqlite3
+from src import config
 from src.database_setup import DB_PATH
+from src.db import connect
+from src.stats import rebuild_stats
 
-def import_csv_to_db(csv_file_path):
-    """Imports generated sample data into the SQLite database."""
-    df = pd.read_csv(csv_file_path)
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    print(f"Importing {len(df)} records into the database...")
-
-    for _, row in df.iterrows():
-        # Insert into shipments table
-        cursor.execute("""
-            INSERT INTO shipments (shipment_id, request_date, spots, weight, destination_zip, status, final_winner, final_price)
-            VALUES (?, ?, ?, ?, ?, 'complete', ?, ?)
-        """, (row['shipment_id'], row['request_date'], row['spots'], row['weight'], row['destination_zip'], row['final_winner'], row['final_price']))
-
-        # Insert initial quotes
-        for carrier in ["Budget Freight", "Premium Express", "Regional Pro"]:
-            carrier_col = carrier.replace(' ', '_')
-            cursor.execute("""
-                INSERT INTO quotes (shipment_id, carrier_name, quote_type, price, status)
-                VALUES (?, ?, 'initial', ?, 'received')
-            """, (row['shipment_id'], carrier, row[f'{carrier_col}_initial']))
-
-            # Insert final quotes if they are different from initial
-            if row[f'{carrier_col}_final'] != row[f'{carrier_col}_initial']:
-                cursor.execute("""
-                    INSERT INTO quotes (shipment_id, carrier_name, quote_type, price, status)
-                    VALUES (?, ?, 'final', ?, 'received')
-                """, (row['shipment_id'], carrier, row[f'{carrier_col}_final']))
+# --- Import settings (override any of these in src/config.py) ---
+# CSV rows read, inserted and committed at a time.
+IMPORT_CHUNK_ROWS = getattr(config, 'IMPORT_CHUNK_ROWS', 50_000)
 
+SHIPMENT_COLUMNS = ['shipment_id', 'request_date', 'spots', 'weight', 'destination_zip', 'final_winner', 'final_price']
+
+INSERT_SHIPMENT_SQL = """
+    INSERT INTO shipments (shipment_id, request_date, spots, weight, destination_zip, status, final_winner, final_price)
+    VALUES (?, ?, ?, ?, ?, 'complete', ?, ?)
+"""
+INSERT_QUOTE_SQL = """
+    INSERT INTO quotes (shipment_id, carrier_name, quote_type, price, status)
+    VALUES (?, ?, ?, ?, 'received')
+"""
+
+
+def discover_carriers(columns):
+    """
+    Returns {carrier name: (initial column, final column)} for every carrier
+    with a `<Carrier_Name>_initial` and `<Carrier_Name>_final` column pair.
+    """
+    carriers = {}
+    for column in columns:
+        if column.endswith('_initial') and f"{column[:-len('_initial')]}_final" in columns:
+            prefix = column[:-len('_initial')]
+            carriers[prefix.replace('_', ' ')] = (column, f"{prefix}_final")
+    return carriers
+
+
+def _quote_rows(chunk, carriers):
+    """Yields the initial and final quote rows for a chunk, one carrier column at a time."""
+    shipment_ids = chunk['shipment_id']
+    for carrier, (initial_column, final_column) in carriers.items():
+        initial = chunk[initial_column]
+        final = chunk[final_column]
+        has_initial = initial.notna()
+        for shipment_id, price in zip(shipment_ids[has_initial].tolist(), initial[has_initial].tolist()):
+            yield shipment_id, carrier, 'initial', price
+        # A final quote is only stored when the carrier actually moved its price.
+        negotiated = final.notna() & (final != initial)
+        for shipment_id, price in zip(shipment_ids[negotiated].tolist(), final[negotiated].tolist()):
+            yield shipment_id, carrier, 'final', price
+
+
+def _drop_schema_objects(conn, where):
+    """Drops the indexes and triggers matching `where`, returning the SQL to recreate them."""
+    objects = conn.execute(f"SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL AND {where}").fetchall()
+    for object_type, name, _ in objects:
+        conn.execute(f"DROP {object_type.upper()} {name}")
     conn.commit()
+    return [sql for _, _, sql in objects]
+
+
+def _drop_indexes(conn):
+    """Drops the secondary indexes on shipments and quotes, returning the SQL to recreate them."""
+    return _drop_schema_objects(conn, "type = 'index' AND tbl_name IN ('shipments', 'quotes')")
+
+
+def _drop_change_log_triggers(conn):
+    """Drops the triggers that log every shipment and quote change, returning the SQL to recreate them."""
+    return _drop_schema_objects(conn, "type = 'trigger' AND name GLOB 'trg_change_log_*'")
+
+
+def _recreate_schema_objects(conn, object_sql):
+    for sql in object_sql:
+        conn.execute(sql)
+    conn.commit()
+
+
+def _log_reset(conn):
+    """Logs one 'reset' change, telling open dashboards to re-fetch instead of replaying rows."""
+    conn.execute("INSERT INTO change_log (entity, entity_id, shipment_id) VALUES ('reset', 0, 0)")
+    conn.commit()
+
+
+def bulk_import(chunks, db_path=None, defer_indexes=True):
+    """
+    Bulk-inserts completed shipments and their quotes from an iterable of
+    DataFrames shaped like the sample CSV, one transaction per frame.
+
+    Carriers are whatever `<Carrier_Name>_initial` / `<Carrier_Name>_final`
+    column pairs the first frame has. With `defer_indexes`, the shipments and
+    quotes indexes are dropped for the load and rebuilt once at the end, which
+    is much cheaper than updating them row by row. The change_log triggers are
+    always dropped for the load, and a single 'reset' change is logged instead
+    of one per imported row. Both are restored even if the load fails; if the
+    process dies before that, create_database (run by the worker and sender at
+    startup) recreates them.
+    """
+    conn = connect(db_path or DB_PATH)
+    index_sql = _drop_indexes(conn) if defer_indexes else []
+    trigger_sql = _drop_change_log_triggers(conn)
+    start = time.perf_counter()
+    carriers = None
+    total_shipments = total_quotes = 0
+    try:
+        for chunk in chunks:
+            if carriers is None:
+                carriers = discover_carriers(chunk.columns.tolist())
+                print(f"Importing with carriers: {', '.join(carriers) or 'none'}...")
+            shipments = chunk[SHIPMENT_COLUMNS].astype(object).where(chunk[SHIPMENT_COLUMNS].notna(), None)
+            conn.executemany(INSERT_SHIPMENT_SQL, shipments.itertuples(index=False, name=None))
+            total_quotes += conn.executemany(INSERT_QUOTE_SQL, _quote_rows(chunk, carriers)).rowcount
+            conn.commit()
+
+            total_shipments += len(chunk)
+            elapsed = time.perf_counter() - start
+            print(f"  {total_shipments} shipments, {total_quotes} quotes ({total_shipments / elapsed:.0f} rows/s)")
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        if index_sql:
+            print("Rebuilding indexes...")
+            _recreate_schema_objects(conn, index_sql)
+        _recreate_schema_objects(conn, trigger_sql)
+        _log_reset(conn)
+
+    # The shipments were inserted already complete, before their quotes, so
+    # the stats triggers couldn't account for them.
+    rebuild_stats(conn)
     conn.close()
-    print("✅ Data import complete.")
+    elapsed = time.perf_counter() - start
+    print(f"✅ Data import complete: {total_shipments} shipments and {total_quotes} quotes "
+          f"in {elapsed:.1f}s ({total_shipments / elapsed:.0f} rows/s).")
+
+
+def import_csv_to_db(csv_file_path, chunk_rows=IMPORT_CHUNK_ROWS, defer_indexes=True):
+    """Bulk-imports a CSV of completed shipments, streaming it `chunk_rows` rows at a time."""
+    print(f"Reading {csv_file_path}...")
+    chunks = pd.read_csv(csv_file_path, chunksize=chunk_rows, dtype={'destination_zip': str})
+    bulk_import(chunks, defer_indexes=defer_indexes)
+
 
 if __name__ == '__main__':
-    import_csv_to_db('sample_shipment_data.csv')
+    import_csv_to_db(sys.argv[1] if len(sys.argv) > 1 else 'sample_shipment_data.csv')
@@ -7,8 +7,9 @@ DB_PATH = os.path.join("data", "shipping_quotes.db")
 
 def reset_database():
     """
-    Deletes all records from the shipments and quotes tables and resets
-    the auto-incrementing ID counters.
+    Deletes all records from the shipments and quotes tables, and everything
+    kept about them (emails, threads, deadlines, inbox progress, the change
+    log), in one transaction, and resets the auto-incrementing ID counters.
     """
     # ⚠️ Safety check to prevent accidental deletion
     print("⚠️ WARNING: This will permanently delete ALL shipment and quote data.")
@@ -32,10 +33,35 @@ def reset_database():
         print("Deleting records from 'shipments' table...")
         cursor.execute("DELETE FROM shipments;")
 
+        # Training rows are derived from the shipments, so they go too. Trained
+        # models and the model registry are kept.
+        print("Deleting materialized training features...")
+        cursor.execute("DELETE FROM training_features;")
+        cursor.execute("DELETE FROM feature_queue;")
+
+        print("Resetting dashboard stats...")
+        cursor.execute("DELETE FROM carrier_stats;")
+        cursor.execute("DELETE FROM savings_by_month;")
+        cursor.execute("UPDATE shipment_stats SET total_shipments = 0, in_progress = 0, completed_shipments = 0, total_savings = 0;")
+
+        # Everything the worker and sender keep about those shipments: queued
+        # emails, the threads replies are routed by, pending deadlines, and
+        # which inbox messages have been read.
+        print("Deleting outbox, email threads and deadlines...")
+        cursor.execute("DELETE FROM outbox;")
+        cursor.execute("DELETE FROM email_threads;")
+        cursor.execute("DELETE FROM deadlines;")
+        print("Forgetting processed emails and inbox sync state...")
+        cursor.execute("DELETE FROM processed_emails;")
+        cursor.execute("DELETE FROM imap_sync_state;")
+        # Every entry points at a shipment or quote that is gone now.
+        print("Clearing the change log...")
+        cursor.execute("DELETE FROM change_log;")
+
         # 2. Reset the auto-increment counters for the tables
         # SQLite stores these counters in a special table called 'sqlite_sequence'
         print("Resetting auto-increment IDs...")
-        cursor.execute("DELETE FROM sqlite_sequence WHERE name IN ('shipments', 'quotes');")
+        cursor.execute("DELETE FROM sqlite_sequence WHERE name IN ('shipments', 'quotes', 'outbox');")
 
         # Commit all changes to the database
         conn.commit()
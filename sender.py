@@ -0,0 +1,55 @@
+import logging
+import threading
+
+from src.database_setup import DB_PATH, create_database
+from src.db import get_connection
+from src.logging_setup import configure_logging
+from src.metrics import start_exporter
+from src.outbox import drain_outbox, release_stale_messages
+from src.wakeups import SENDER_WAKEUP_PORT, set_when, start_listener
+from src import config
+
+# How long the sender waits before checking again when the outbox is empty
+# (the worker also wakes it as soon as it queues emails).
+OUTBOX_POLL_SECONDS = getattr(config, 'OUTBOX_POLL_SECONDS', 2)
+# Port the sender serves its /metrics on (override in src/config.py; 0 turns it off).
+SENDER_METRICS_PORT = getattr(config, 'SENDER_METRICS_PORT', 9102)
+
+log = logging.getLogger('sender')
+
+def get_db_connection():
+    """Borrows a pooled connection to the database; close() hands it back."""
+    return get_connection(DB_PATH)
+
+def sender_loop(stop=None):
+    """
+    Drains the outbox table, sending queued emails as fast as rate limits
+    allow, until `stop` (a threading.Event) is set, or forever.
+    """
+    log.info("📤 Sender started. Waiting for queued emails...")
+    create_database(DB_PATH) # Brings an existing database up to the latest schema
+    stop = stop or threading.Event()
+    wakeup = threading.Event()
+    threading.Thread(target=set_when, args=(stop, wakeup), daemon=True).start()
+    start_listener(SENDER_WAKEUP_PORT, lambda topic: wakeup.set(), stop, name="sender-wakeups")
+    while not stop.is_set():
+        wakeup.clear() # Emails queued from here on trigger another pass
+        attempted = 0
+        try:
+            conn = get_db_connection()
+            try:
+                release_stale_messages(conn)
+                attempted = drain_outbox(conn)
+            finally:
+                conn.close()
+        except Exception as e:
+            log.error("SENDER ERROR: An error occurred: %s", e)
+
+        # Keep going straight away while there is a backlog.
+        if not attempted:
+            wakeup.wait(OUTBOX_POLL_SECONDS)
+
+if __name__ == '__main__':
+    configure_logging()
+    start_exporter(SENDER_METRICS_PORT)
+    sender_loop()
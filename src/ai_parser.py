@@ -1,21 +1,174 @@
 import google.genai as genai
 from google.genai import types
+import hashlib
 import json
+import logging
+import os
 import re
-from typing import Union
+import sqlite3
+import threading
+import time
+from typing import List, Union
+from src import config
 from src.config import GEMINI_API_KEY
+from src.database_setup import DATA_DIR
+from src.metrics import Counter, Histogram
+
+# --- Parse cache settings (override any of these in src/config.py) ---
+AI_CACHE_PATH = getattr(config, 'AI_CACHE_PATH', os.path.join(DATA_DIR, "ai_parse_cache.db"))
+AI_CACHE_TTL_HOURS = getattr(config, 'AI_CACHE_TTL_HOURS', 24 * 30)
+AI_CACHE_MAX_ENTRIES = getattr(config, 'AI_CACHE_MAX_ENTRIES', 50_000)
+
+# --- Batch parsing settings ---
+# How many emails are packed into one Gemini request.
+AI_BATCH_SIZE = getattr(config, 'AI_BATCH_SIZE', 20)
+# Each email is cut to this many characters in a prompt, batched or not;
+# prices are almost always near the top of a reply.
+AI_BATCH_MAX_CHARS = getattr(config, 'AI_BATCH_MAX_CHARS', 2000)
+
+GEMINI_MODEL = "models/gemini-2.5-flash"
+# Sends Gemini requests somewhere other than Google's endpoint, e.g. a local
+# stand-in while testing.
+GEMINI_BASE_URL = getattr(config, 'GEMINI_BASE_URL', None)
+
+# One client (and its HTTP connection pool) is shared by every parse, including
+# the ones running in parallel in the email pipeline.
+_client = None
+_client_lock = threading.Lock()
+
+_cache_conn = None
+_cache_lock = threading.Lock()
+
+log = logging.getLogger(__name__)
+
+AI_REQUEST_SECONDS = Histogram('ai_request_seconds', "Time for one Gemini request, by kind (single or batch).", ['kind'])
+AI_CACHE_LOOKUPS = Counter('ai_cache_lookups_total', "Parse cache lookups by result (hit or miss).", ['result'])
+AI_CACHE_EVICTIONS = Counter('ai_cache_evictions_total', "Parse cache entries dropped for being expired or least recently used.")
+AI_PARSE_ERRORS = Counter('ai_parse_errors_total', "Gemini requests whose answer could not be used, by kind.", ['kind'])
+
+# The line Outlook-style clients put above an unprefixed copy of the email
+# being answered; everything after it is the old thread.
+_FORWARDED_HEADER = re.compile(r'^-+\s*Original Message\s*-+$', re.IGNORECASE)
+# The line that introduces a '>'-quoted copy. Text after the quote is kept,
+# since some carriers answer below it.
+_QUOTE_HEADER = re.compile(r'^On .+ wrote:$', re.IGNORECASE)
+
+
+def get_client():
+    """Returns the shared Gemini client, creating it on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            http_options = types.HttpOptions(base_url=GEMINI_BASE_URL) if GEMINI_BASE_URL else None
+            _client = genai.Client(api_key=GEMINI_API_KEY, http_options=http_options)
+        return _client
+
+
+def normalize_email_body(email_body: str) -> str:
+    """
+    Strips the quoted reply chain and collapses whitespace, so re-deliveries and
+    replies that only differ in what they quote look the same to the cache and
+    the local extractor. The AI is given the body as it came.
+    """
+    lines = []
+    for line in (email_body or "").splitlines():
+        line = line.strip()
+        if lines and _FORWARDED_HEADER.match(line):
+            break
+        if line.startswith('>') or _QUOTE_HEADER.match(line):
+            continue
+        lines.append(' '.join(line.split()))
+    return '\n'.join(line for line in lines if line)
+
+
+def _get_cache_conn():
+    global _cache_conn
+    if _cache_conn is None:
+        os.makedirs(os.path.dirname(AI_CACHE_PATH), exist_ok=True)
+        _cache_conn = sqlite3.connect(AI_CACHE_PATH, check_same_thread=False)
+        _cache_conn.executescript("""
+            CREATE TABLE IF NOT EXISTS parse_cache (
+                body_hash TEXT PRIMARY KEY,
+                price REAL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_parse_cache_last_used ON parse_cache (last_used_at);
+        """)
+    return _cache_conn
+
+
+def cache_lookup(body_hash):
+    """Returns (True, price) for a fresh cached parse, or (False, None) on a miss."""
+    with _cache_lock:
+        conn = _get_cache_conn()
+        now = time.time()
+        row = conn.execute(
+            "SELECT price FROM parse_cache WHERE body_hash = ? AND created_at >= ?",
+            (body_hash, now - AI_CACHE_TTL_HOURS * 3600)
+        ).fetchone()
+        if row is None:
+            AI_CACHE_LOOKUPS.inc(result='miss')
+            return False, None
+
+        conn.execute("UPDATE parse_cache SET last_used_at = ? WHERE body_hash = ?", (now, body_hash))
+        conn.commit()
+        AI_CACHE_LOOKUPS.inc(result='hit')
+        return True, row[0]
+
+
+def cache_store(body_hash, price):
+    """Saves a parse result, evicting expired and least recently used entries."""
+    with _cache_lock:
+        conn = _get_cache_conn()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO parse_cache (body_hash, price, created_at, last_used_at) VALUES (?, ?, ?, ?)",
+            (body_hash, price, now, now)
+        )
+        evicted = conn.execute("DELETE FROM parse_cache WHERE created_at < ?", (now - AI_CACHE_TTL_HOURS * 3600,)).rowcount
+        evicted += conn.execute("""
+            DELETE FROM parse_cache WHERE body_hash IN (
+                SELECT body_hash FROM parse_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (AI_CACHE_MAX_ENTRIES,)).rowcount
+        conn.commit()
+        AI_CACHE_EVICTIONS.inc(evicted)
+
+
+def _generate(prompt, kind='single'):
+    with AI_REQUEST_SECONDS.time(kind=kind):
+        return get_client().models.generate_content(
+            model=GEMINI_MODEL,
+            contents=prompt,
+            config=types.GenerateContentConfig(
+                    thinking_config=types.ThinkingConfig(thinking_budget=0)
+            ),
+        )
+
+
+def _decode_json(text):
+    clean_text = re.sub(r'```json\n(.*?)\n```', r'\1', text, flags=re.DOTALL).strip()
+    return json.loads(clean_text)
 
 
 def parse_quote_with_ai(email_body: str) -> Union[float, None]:
     """
     Uses the Gemini API via the genai.Client to parse the quote from an email body,
     aligning with the official documentation.
+
+    Results are cached by a hash of the normalized body, so duplicate and
+    re-delivered emails are answered without calling the API. The prompt gets
+    the body as it came, cut to AI_BATCH_MAX_CHARS.
     """
+    body_hash = hashlib.sha256(normalize_email_body(email_body).encode('utf-8')).hexdigest()
+
+    found, price = cache_lookup(body_hash)
+    if found:
+        return price
+
     response = None
-    clean_text = ""
     try:
-        client = genai.Client(api_key=GEMINI_API_KEY)
-
         # A more direct prompt to ensure only JSON is returned.
         prompt = f"""
         Analyze the following email content and extract the total price quote.
@@ -27,32 +180,119 @@ def parse_quote_with_ai(email_body: str) -> Union[float, None]:
 
         Email content to analyze:
         ---
-        {email_body}
+        {(email_body or "")[:AI_BATCH_MAX_CHARS]}
         ---
         """
 
-        response = client.models.generate_content(
-            model="models/gemini-2.5-flash",
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                    thinking_config=types.ThinkingConfig(thinking_budget=0)
-            ),
-        )
+        response = _generate(prompt)
         if response and response.text:
-            clean_text = re.sub(r'```json\n(.*?)\n```', r'\1', response.text, flags=re.DOTALL).strip()
-            json_response = json.loads(clean_text)
+            json_response = _decode_json(response.text)
 
             price = json_response.get("price")
-            return float(price) if price is not None else None
+            price = float(price) if price is not None else None
+            # Only answers the model actually gave are cached, never errors.
+            cache_store(body_hash, price)
+            return price
         else:
-            print("GEMINI PARSER ERROR: Received an empty response from the API.")
+            AI_PARSE_ERRORS.inc(kind='single')
+            log.error("GEMINI PARSER ERROR: Received an empty response from the API.")
             return None
 
 
     except json.JSONDecodeError:
         raw_response = response.text if response else "No response object"
-        print(f"GEMINI PARSER ERROR: Failed to decode JSON. Raw response was: '{raw_response}'")
+        AI_PARSE_ERRORS.inc(kind='single')
+        log.error("GEMINI PARSER ERROR: Failed to decode JSON. Raw response was: '%s'", raw_response)
         return None
     except Exception as e:
-        print(f"GEMINI PARSER ERROR: An unexpected error occurred: {e}")
+        AI_PARSE_ERRORS.inc(kind='single')
+        log.error("GEMINI PARSER ERROR: An unexpected error occurred: %s", e)
         return None
+
+
+def _parse_batch_response(response, email_ids):
+    """Maps a JSON-array batch answer back to {email id: price}, or raises ValueError if it doesn't fit."""
+    if not response or not response.text:
+        raise ValueError("empty response")
+
+    items = _decode_json(response.text)
+    if not isinstance(items, list):
+        raise ValueError("response is not a JSON array")
+
+    prices = {}
+    for item in items:
+        email_id, price = item.get("id"), item.get("price")
+        if email_id not in email_ids or email_id in prices:
+            raise ValueError(f"unexpected email id {email_id!r}")
+        prices[email_id] = float(price) if price is not None else None
+
+    if set(prices) != set(email_ids):
+        raise ValueError("response does not cover every email")
+    return prices
+
+
+def parse_quotes_with_ai_batch(email_bodies: List[str]) -> List[Union[float, None]]:
+    """
+    Parses the quotes from several email bodies with as few Gemini requests as
+    possible. Emails are answered from the cache where they can be; the rest are
+    truncated and packed AI_BATCH_SIZE to a prompt, with a JSON array answer
+    mapped back to each email by its position. If a batch answer is malformed,
+    the emails in it are parsed one by one instead.
+
+    Returns one price (or None) per input body, in the same order.
+    """
+    results = [None] * len(email_bodies)
+    to_parse = {} # normalized body hash -> (first raw body, [indexes into email_bodies])
+
+    for index, email_body in enumerate(email_bodies):
+        body = email_body or ""
+        body_hash = hashlib.sha256(normalize_email_body(body).encode('utf-8')).hexdigest()
+        if body_hash in to_parse:
+            to_parse[body_hash][1].append(index) # Duplicate within this batch
+            continue
+
+        found, price = cache_lookup(body_hash)
+        if found:
+            results[index] = price
+        else:
+            to_parse[body_hash] = (body, [index])
+
+    pending = list(to_parse.items())
+    for start in range(0, len(pending), AI_BATCH_SIZE):
+        chunk = pending[start:start + AI_BATCH_SIZE]
+        emails = "\n".join(
+            f"=== EMAIL {email_id} ===\n{body[:AI_BATCH_MAX_CHARS]}"
+            for email_id, (_, (body, _)) in enumerate(chunk)
+        )
+        prompt = f"""
+        Analyze each of the following {len(chunk)} emails and extract the total price quote from each one.
+        Your response MUST be only a valid JSON array with exactly one object per email, in order.
+        Do not include any other text, greetings, or explanations.
+
+        Each object must look like this: {{"id": 0, "price": 1234.56}}
+        If an email does not mention a price quote, use: {{"id": 0, "price": null}}
+
+        {emails}
+        """
+
+        response = None
+        try:
+            response = _generate(prompt, kind='batch')
+            prices = _parse_batch_response(response, range(len(chunk)))
+        except Exception as e:
+            raw_response = response.text if response else "No response object"
+            AI_PARSE_ERRORS.inc(kind='batch')
+            log.error("GEMINI PARSER ERROR: Batch of %d could not be used (%s). Raw response was: '%s'. Parsing individually.",
+                      len(chunk), e, raw_response)
+            for body_hash, (body, indexes) in chunk:
+                price = parse_quote_with_ai(body)
+                for index in indexes:
+                    results[index] = price
+            continue
+
+        for email_id, (body_hash, (_, indexes)) in enumerate(chunk):
+            cache_store(body_hash, prices[email_id])
+            for index in indexes:
+                results[index] = prices[email_id]
+
+    return results
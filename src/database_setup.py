@@ -1,3 +1,4 @@
+import re
 import sqlite3
 import os
 import sys
@@ -20,15 +21,13 @@ DB_PATH = os.path.join(BASE_PATH, "data", "shipping_quotes.db")
 DATA_DIR = os.path.join(BASE_PATH, "data")
 
 
-def create_database():
-    """Creates the database and tables if they don't exist."""
-    os.makedirs(DATA_DIR, exist_ok=True)
-
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    # (Your CREATE TABLE statements remain unchanged)
-    cursor.execute("""
+# --- Schema migrations ---
+# Each entry upgrades the schema by one version. The version a database is at is
+# kept in SQLite's built-in `user_version` pragma, so existing database files are
+# upgraded in place by only running the migrations they haven't seen yet.
+# Never edit a migration that has shipped; append a new one instead.
+MIGRATIONS = [
+    ("Create shipments and quotes tables", """
     CREATE TABLE IF NOT EXISTS shipments (
         shipment_id INTEGER PRIMARY KEY AUTOINCREMENT,
         request_date TEXT NOT NULL,
@@ -39,23 +38,350 @@ def create_database():
         final_winner TEXT,
         final_price REAL
     );
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS quotes (
-            quote_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            shipment_id INTEGER NOT NULL,
-            carrier_name TEXT NOT NULL,
-            quote_type TEXT NOT NULL,
-            price REAL,
-            received_at TEXT,
-            status TEXT NOT NULL DEFAULT 'pending',
-            FOREIGN KEY (shipment_id) REFERENCES shipments (shipment_id)
-        );
-        """)
-
-    conn.commit()
+    CREATE TABLE IF NOT EXISTS quotes (
+        quote_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        shipment_id INTEGER NOT NULL,
+        carrier_name TEXT NOT NULL,
+        quote_type TEXT NOT NULL,
+        price REAL,
+        received_at TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        FOREIGN KEY (shipment_id) REFERENCES shipments (shipment_id)
+    );
+    """),
+    ("Index the columns the app, worker and ML queries filter on", """
+    -- Worker phases and dashboard counts filter shipments by status.
+    CREATE INDEX IF NOT EXISTS idx_shipments_status ON shipments (status);
+    -- Savings stats only ever look at completed shipments with a price.
+    CREATE INDEX IF NOT EXISTS idx_shipments_completed ON shipments (shipment_id, final_price)
+        WHERE status = 'complete' AND final_price IS NOT NULL;
+    -- Per-shipment quote lookups (quote details, worker joins).
+    CREATE INDEX IF NOT EXISTS idx_quotes_shipment ON quotes (shipment_id, quote_type, status);
+    -- Lowest received initial bid per shipment, used by the worker and stats.
+    CREATE INDEX IF NOT EXISTS idx_quotes_received_initial ON quotes (shipment_id, price)
+        WHERE quote_type = 'initial' AND status = 'received';
+    -- Training data is pulled per carrier.
+    CREATE INDEX IF NOT EXISTS idx_quotes_carrier ON quotes (carrier_name, quote_type, status);
+    """),
+    ("Track which carrier emails have already been applied", """
+    CREATE TABLE IF NOT EXISTS processed_emails (
+        message_key TEXT PRIMARY KEY,
+        shipment_id INTEGER,
+        processed_at TEXT NOT NULL
+    );
+    """),
+    ("Add the outbound email outbox", """
+    CREATE TABLE IF NOT EXISTS outbox (
+        outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        shipment_id INTEGER,
+        recipient TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        body TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL,
+        next_attempt_at TEXT NOT NULL,
+        claimed_at TEXT,
+        sent_at TEXT
+    );
+    -- The sender only ever looks for due messages that haven't gone out yet.
+    CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at) WHERE status = 'pending';
+    CREATE INDEX IF NOT EXISTS idx_outbox_sending ON outbox (claimed_at) WHERE status = 'sending';
+    """),
+    ("Add the training feature store and model registry", """
+    -- Completed shipments whose training rows haven't been materialized yet.
+    -- Filled by triggers, so every path that completes a shipment is covered.
+    CREATE TABLE IF NOT EXISTS feature_queue (
+        shipment_id INTEGER PRIMARY KEY
+    );
+    CREATE TRIGGER IF NOT EXISTS trg_feature_queue_completed AFTER UPDATE OF status ON shipments
+        WHEN NEW.status = 'complete' AND OLD.status <> 'complete'
+    BEGIN
+        INSERT OR IGNORE INTO feature_queue (shipment_id) VALUES (NEW.shipment_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_feature_queue_imported AFTER INSERT ON shipments
+        WHEN NEW.status = 'complete'
+    BEGIN
+        INSERT OR IGNORE INTO feature_queue (shipment_id) VALUES (NEW.shipment_id);
+    END;
+    INSERT OR IGNORE INTO feature_queue (shipment_id) SELECT shipment_id FROM shipments WHERE status = 'complete';
+
+    -- One cleaned training row per (completed shipment, carrier that bid).
+    CREATE TABLE IF NOT EXISTS training_features (
+        shipment_id INTEGER NOT NULL,
+        carrier_name TEXT NOT NULL,
+        spots INTEGER NOT NULL,
+        weight REAL NOT NULL,
+        destination_zip TEXT NOT NULL,
+        carrier_initial_bid REAL NOT NULL,
+        lowest_competing_bid REAL NOT NULL,
+        final_offer REAL NOT NULL,
+        materialized_at TEXT NOT NULL,
+        PRIMARY KEY (shipment_id, carrier_name)
+    );
+    CREATE INDEX IF NOT EXISTS idx_training_features_carrier ON training_features (carrier_name, shipment_id);
+
+    -- Every trained model version; the active one is also published to the carrier's model file.
+    CREATE TABLE IF NOT EXISTS model_registry (
+        model_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        carrier_name TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        model_file TEXT NOT NULL,
+        training_rows INTEGER NOT NULL,
+        validation_rows INTEGER NOT NULL,
+        validation_mae REAL,
+        trained_at TEXT NOT NULL,
+        is_active INTEGER NOT NULL DEFAULT 0,
+        UNIQUE (carrier_name, version)
+    );
+    CREATE INDEX IF NOT EXISTS idx_model_registry_active ON model_registry (carrier_name) WHERE is_active = 1;
+    """),
+    ("Index shipments by winning carrier for the dashboard filter", """
+    -- Like every secondary index this one ends in shipment_id (the rowid), so
+    -- a carrier's shipments come back already in keyset order.
+    CREATE INDEX IF NOT EXISTS idx_shipments_winner ON shipments (final_winner);
+    """),
+    ("Add dashboard stats rollups maintained by triggers", """
+    -- What each completed shipment saved: its lowest initial bid minus the
+    -- final price, never below zero.
+    CREATE VIEW IF NOT EXISTS completed_shipment_savings AS
+    SELECT s.shipment_id, s.request_date, s.final_winner,
+           COALESCE(MAX((
+               SELECT MIN(q.price) FROM quotes q
+               WHERE q.shipment_id = s.shipment_id AND q.quote_type = 'initial' AND q.status = 'received'
+           ) - s.final_price, 0), 0) AS savings
+    FROM shipments s
+    WHERE s.status = 'complete';
+
+    -- Dashboard totals, always a single row.
+    CREATE TABLE IF NOT EXISTS shipment_stats (
+        stats_id INTEGER PRIMARY KEY CHECK (stats_id = 1),
+        total_shipments INTEGER NOT NULL DEFAULT 0,
+        in_progress INTEGER NOT NULL DEFAULT 0,
+        completed_shipments INTEGER NOT NULL DEFAULT 0,
+        total_savings REAL NOT NULL DEFAULT 0
+    );
+    -- Completed shipments each carrier bid on and won, and the savings on the ones it won.
+    CREATE TABLE IF NOT EXISTS carrier_stats (
+        carrier_name TEXT PRIMARY KEY,
+        shipments_bid INTEGER NOT NULL DEFAULT 0,
+        shipments_won INTEGER NOT NULL DEFAULT 0,
+        total_savings REAL NOT NULL DEFAULT 0
+    );
+    -- Completed shipments and savings by the month they were requested in.
+    CREATE TABLE IF NOT EXISTS savings_by_month (
+        period TEXT PRIMARY KEY,
+        completed_shipments INTEGER NOT NULL DEFAULT 0,
+        total_savings REAL NOT NULL DEFAULT 0
+    );
+
+    INSERT INTO shipment_stats (stats_id, total_shipments, in_progress, completed_shipments, total_savings)
+    SELECT 1,
+           (SELECT COUNT(*) FROM shipments),
+           (SELECT COUNT(*) FROM shipments WHERE status NOT IN ('complete', 'failed')),
+           COUNT(*), COALESCE(SUM(savings), 0)
+    FROM completed_shipment_savings;
+    INSERT INTO carrier_stats (carrier_name, shipments_bid, shipments_won, total_savings)
+    SELECT q.carrier_name, COUNT(*), SUM(q.carrier_name = c.final_winner),
+           SUM(CASE WHEN q.carrier_name = c.final_winner THEN c.savings ELSE 0 END)
+    FROM completed_shipment_savings c
+    JOIN quotes q ON q.shipment_id = c.shipment_id AND q.quote_type = 'initial' AND q.status = 'received'
+    GROUP BY q.carrier_name;
+    INSERT INTO savings_by_month (period, completed_shipments, total_savings)
+    SELECT substr(request_date, 1, 7), COUNT(*), SUM(savings)
+    FROM completed_shipment_savings
+    GROUP BY substr(request_date, 1, 7);
+
+    CREATE TRIGGER IF NOT EXISTS trg_stats_shipment_added AFTER INSERT ON shipments
+    BEGIN
+        UPDATE shipment_stats SET
+            total_shipments = total_shipments + 1,
+            in_progress = in_progress + (NEW.status NOT IN ('complete', 'failed'))
+        WHERE stats_id = 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_stats_status_changed AFTER UPDATE OF status ON shipments
+        WHEN OLD.status IS NOT NEW.status
+    BEGIN
+        UPDATE shipment_stats SET
+            in_progress = in_progress + (NEW.status NOT IN ('complete', 'failed')) - (OLD.status NOT IN ('complete', 'failed'))
+        WHERE stats_id = 1;
+    END;
+    -- Everything that depends on the outcome is added once, when the shipment completes.
+    CREATE TRIGGER IF NOT EXISTS trg_stats_shipment_completed AFTER UPDATE OF status ON shipments
+        WHEN NEW.status = 'complete' AND OLD.status <> 'complete'
+    BEGIN
+        UPDATE shipment_stats SET
+            completed_shipments = completed_shipments + 1,
+            total_savings = total_savings + (SELECT savings FROM completed_shipment_savings WHERE shipment_id = NEW.shipment_id)
+        WHERE stats_id = 1;
+        INSERT INTO savings_by_month (period, completed_shipments, total_savings)
+        SELECT substr(request_date, 1, 7), 1, savings FROM completed_shipment_savings WHERE shipment_id = NEW.shipment_id
+        ON CONFLICT (period) DO UPDATE SET
+            completed_shipments = completed_shipments + 1,
+            total_savings = total_savings + excluded.total_savings;
+        INSERT INTO carrier_stats (carrier_name, shipments_bid, shipments_won, total_savings)
+        SELECT q.carrier_name, 1, q.carrier_name = c.final_winner,
+               CASE WHEN q.carrier_name = c.final_winner THEN c.savings ELSE 0 END
+        FROM completed_shipment_savings c
+        JOIN quotes q ON q.shipment_id = c.shipment_id AND q.quote_type = 'initial' AND q.status = 'received'
+        WHERE c.shipment_id = NEW.shipment_id
+        ON CONFLICT (carrier_name) DO UPDATE SET
+            shipments_bid = shipments_bid + 1,
+            shipments_won = shipments_won + excluded.shipments_won,
+            total_savings = total_savings + excluded.total_savings;
+    END;
+    """),
+    ("Log shipment and quote changes for the dashboard event stream", """
+    -- Which rows changed, in order. The app streams the current version of
+    -- each changed row to open dashboards; the worker trims old entries.
+    CREATE TABLE IF NOT EXISTS change_log (
+        change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        entity TEXT NOT NULL,
+        entity_id INTEGER NOT NULL,
+        shipment_id INTEGER NOT NULL
+    );
+    CREATE TRIGGER IF NOT EXISTS trg_change_log_shipment_added AFTER INSERT ON shipments
+    BEGIN
+        INSERT INTO change_log (entity, entity_id, shipment_id) VALUES ('shipment', NEW.shipment_id, NEW.shipment_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_change_log_shipment_changed AFTER UPDATE OF status, final_winner, final_price ON shipments
+    BEGIN
+        INSERT INTO change_log (entity, entity_id, shipment_id) VALUES ('shipment', NEW.shipment_id, NEW.shipment_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_change_log_quote_added AFTER INSERT ON quotes
+    BEGIN
+        INSERT INTO change_log (entity, entity_id, shipment_id) VALUES ('quote', NEW.quote_id, NEW.shipment_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_change_log_quote_changed AFTER UPDATE OF price, status ON quotes
+    BEGIN
+        INSERT INTO change_log (entity, entity_id, shipment_id) VALUES ('quote', NEW.quote_id, NEW.shipment_id);
+    END;
+    """),
+    ("Remember how far the inbox has been read, by IMAP UID", """
+    -- The worker only fetches messages above last_uid. UIDs are only
+    -- comparable while the folder's UIDVALIDITY stays the same; when it
+    -- changes the worker falls back to one scan of the unread messages.
+    CREATE TABLE IF NOT EXISTS imap_sync_state (
+        account TEXT NOT NULL,
+        folder TEXT NOT NULL,
+        uid_validity INTEGER NOT NULL,
+        last_uid INTEGER NOT NULL,
+        synced_at TEXT NOT NULL,
+        PRIMARY KEY (account, folder)
+    );
+    """),
+    ("Give outgoing emails a Message-ID and remember what replies to them are about", """
+    ALTER TABLE outbox ADD COLUMN message_id TEXT;
+    -- Carriers' replies name our Message-ID in In-Reply-To/References, which
+    -- routes them straight to the shipment, carrier and round they answer.
+    CREATE TABLE IF NOT EXISTS email_threads (
+        message_id TEXT PRIMARY KEY,
+        shipment_id INTEGER NOT NULL,
+        carrier_name TEXT NOT NULL,
+        quote_type TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    );
+    """),
+    ("Schedule timeouts as deadlines per shipment, phase and carrier", """
+    -- A row per deadline the worker must act on: the shipment's own deadline
+    -- for the phase (carrier_name '') and one per carrier with a reply timeout.
+    CREATE TABLE IF NOT EXISTS deadlines (
+        shipment_id INTEGER NOT NULL,
+        phase TEXT NOT NULL,
+        carrier_name TEXT NOT NULL DEFAULT '',
+        deadline_at TEXT NOT NULL,
+        PRIMARY KEY (shipment_id, phase, carrier_name)
+    );
+    -- The worker only ever asks for the deadlines that have passed, and the next one.
+    CREATE INDEX IF NOT EXISTS idx_deadlines_due ON deadlines (deadline_at);
+    -- Leaving a phase, by whatever path, drops the deadlines that belonged to it.
+    CREATE TRIGGER IF NOT EXISTS trg_deadlines_phase_left AFTER UPDATE OF status ON shipments
+        WHEN NEW.status <> OLD.status
+    BEGIN
+        DELETE FROM deadlines WHERE shipment_id = NEW.shipment_id AND phase <> NEW.status;
+    END;
+    """),
+    ("Add worker leases so several workers can share the database", """
+    -- Which worker is working on a shipment outside a transaction, and until when.
+    ALTER TABLE shipments ADD COLUMN lease_owner TEXT;
+    ALTER TABLE shipments ADD COLUMN lease_expires_at TEXT;
+    -- Only leased shipments are indexed: heartbeats renew them, and expired ones are taken over.
+    CREATE INDEX IF NOT EXISTS idx_shipments_leased ON shipments (lease_owner, lease_expires_at)
+        WHERE lease_owner IS NOT NULL;
+    -- Leases on things other than shipments, e.g. the inbox a worker is reading.
+    CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS workers (
+        worker_id TEXT PRIMARY KEY,
+        started_at TEXT NOT NULL,
+        heartbeat_at TEXT NOT NULL
+    );
+    """),
+]
+
+
+def get_schema_version(conn):
+    """Returns the migration version the database is currently at."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate_database(conn):
+    """Applies every pending migration, each in its own transaction."""
+    current_version = get_schema_version(conn)
+
+    for version, (description, sql) in enumerate(MIGRATIONS, start=1):
+        if version <= current_version:
+            continue
+        print(f"Applying migration {version}: {description}...")
+        # executescript() commits any open transaction first, so wrap the
+        # migration and the version bump together explicitly.
+        conn.executescript(f"BEGIN;\n{sql}\nPRAGMA user_version = {version};\nCOMMIT;")
+
+    return get_schema_version(conn)
+
+
+# Index and trigger definitions in the migrations, by name.
+_CREATE_INDEX_OR_TRIGGER = re.compile(
+    r'CREATE (?:UNIQUE )?(?:INDEX IF NOT EXISTS (\w+).*?;|TRIGGER IF NOT EXISTS (\w+).*?\bEND;)', re.DOTALL
+)
+
+
+def ensure_indexes_and_triggers(conn, version=None):
+    """
+    Recreates any index or trigger the applied migrations define that is
+    missing, e.g. one a bulk import dropped and never got to restore because
+    the process was killed. Costs nothing when they all exist. Returns the
+    names of those it created.
+    """
+    version = get_schema_version(conn) if version is None else version
+    existing = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('index', 'trigger')")}
+    missing = [
+        (match.group(1) or match.group(2), match.group(0))
+        for _, sql in MIGRATIONS[:version]
+        for match in _CREATE_INDEX_OR_TRIGGER.finditer(sql)
+        if (match.group(1) or match.group(2)) not in existing
+    ]
+    if missing:
+        print(f"Restoring missing indexes and triggers: {', '.join(name for name, _ in missing)}...")
+        conn.executescript("BEGIN;\n" + "\n".join(sql for _, sql in missing) + "\nCOMMIT;")
+    return [name for name, _ in missing]
+
+
+def create_database(db_path=DB_PATH):
+    """
+    Creates the database if it doesn't exist, upgrades it to the latest schema
+    and recreates any index or trigger that has gone missing.
+    """
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+    conn = sqlite3.connect(db_path)
+    version = migrate_database(conn)
+    ensure_indexes_and_triggers(conn, version)
     conn.close()
-    print(f"Database setup complete. Path: {DB_PATH}")
+    print(f"Database setup complete (schema version {version}). Path: {db_path}")
 
 if __name__ == '__main__':
     create_database()
@@ -0,0 +1,184 @@
+# src/db.py
+"""
+Shared SQLite connection layer for the app, the worker and the sender.
+
+Every connection runs in WAL mode with the same tuned pragmas, so readers (the
+dashboard) never block the writer (the worker) and vice versa. Connections are
+pooled per database file; closing one hands it back to the pool instead of
+closing it. Writes take the lock up front (BEGIN IMMEDIATE) and wait up to
+DB_BUSY_TIMEOUT_SECONDS for it, and run_with_busy_retry retries a whole
+transaction if the database still reports it is locked. Every statement run
+through these connections is timed into the db_query_seconds histogram.
+"""
+import logging
+import queue
+import random
+import sqlite3
+import threading
+import time
+from src import config
+from src.database_setup import DB_PATH
+from src.metrics import Counter, Histogram
+
+# --- Database settings (override any of these in src/config.py) ---
+# How long a connection waits for a lock before giving up with "database is locked".
+DB_BUSY_TIMEOUT_SECONDS = getattr(config, 'DB_BUSY_TIMEOUT_SECONDS', 10)
+# NORMAL is durable in WAL mode except for the last transactions before a power loss.
+DB_SYNCHRONOUS = getattr(config, 'DB_SYNCHRONOUS', 'NORMAL')
+# Page cache per connection, in KiB.
+DB_CACHE_SIZE_KB = getattr(config, 'DB_CACHE_SIZE_KB', 32 * 1024)
+# How much of the database file is memory-mapped for reads, in bytes.
+DB_MMAP_SIZE = getattr(config, 'DB_MMAP_SIZE', 256 * 1024 * 1024)
+# Idle connections kept open per database file.
+DB_POOL_SIZE = getattr(config, 'DB_POOL_SIZE', 8)
+# How many times run_with_busy_retry re-runs a transaction that hit a locked database.
+DB_BUSY_RETRIES = getattr(config, 'DB_BUSY_RETRIES', 5)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+log = logging.getLogger(__name__)
+
+DB_QUERY_SECONDS = Histogram('db_query_seconds', "Time to execute one SQL statement (excluding fetching its rows), by statement kind.", ['statement'])
+DB_BUSY_RETRIES_TOTAL = Counter('db_busy_retries_total', "Transactions re-run because the database was locked.", ['func'])
+
+
+def _observe(sql, start):
+    DB_QUERY_SECONDS.observe(time.perf_counter() - start, statement=(sql.split(None, 1) or ['?'])[0].upper())
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """A cursor that times every execute() and executemany()."""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _observe(sql, start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _observe(sql, start)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """A connection whose statements, run directly or through its cursors, are timed."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class PooledConnection(InstrumentedConnection):
+    """A connection whose close() returns it to its pool."""
+
+    def close(self):
+        if self._released:
+            return
+        if self.in_transaction:
+            self.rollback()
+        self.row_factory = None
+        self._released = True
+        _release(self)
+
+
+def _configure(conn):
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size = -{int(DB_CACHE_SIZE_KB)}")
+    conn.execute(f"PRAGMA mmap_size = {int(DB_MMAP_SIZE)}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+def connect(db_path=None):
+    """Opens a new, unpooled connection with the shared settings."""
+    conn = sqlite3.connect(
+        db_path or DB_PATH,
+        timeout=DB_BUSY_TIMEOUT_SECONDS,
+        isolation_level='IMMEDIATE',
+        check_same_thread=False,
+        factory=InstrumentedConnection,
+    )
+    return _configure(conn)
+
+
+def _get_pool(db_path):
+    with _pools_lock:
+        if db_path not in _pools:
+            _pools[db_path] = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+        return _pools[db_path]
+
+
+def get_connection(db_path=None):
+    """
+    Returns a connection from the pool for `db_path` (the main database by
+    default), opening a new one if none are idle. Call close() when done.
+    """
+    db_path = db_path or DB_PATH
+    try:
+        conn = _get_pool(db_path).get_nowait()
+    except queue.Empty:
+        conn = _configure(sqlite3.connect(
+            db_path,
+            timeout=DB_BUSY_TIMEOUT_SECONDS,
+            isolation_level='IMMEDIATE',
+            check_same_thread=False,
+            factory=PooledConnection,
+        ))
+        conn.db_path = db_path
+    conn._released = False
+    return conn
+
+
+def _release(conn):
+    try:
+        _get_pool(conn.db_path).put_nowait(conn)
+    except queue.Full:
+        sqlite3.Connection.close(conn)
+
+
+def close_pools():
+    """Closes every idle pooled connection."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        while True:
+            try:
+                sqlite3.Connection.close(pool.get_nowait())
+            except queue.Empty:
+                break
+
+
+def is_busy_error(error):
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+
+def run_with_busy_retry(conn, func, *args, **kwargs):
+    """
+    Calls func(conn, *args, **kwargs), rolling back and retrying with jittered
+    backoff if it fails because the database is locked. `func` must be safe to
+    re-run, i.e. one transaction that commits at the end.
+    """
+    for attempt in range(DB_BUSY_RETRIES + 1):
+        try:
+            return func(conn, *args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if not is_busy_error(e) or attempt == DB_BUSY_RETRIES:
+                raise
+            if conn.in_transaction:
+                conn.rollback()
+            delay = min(0.05 * 2 ** attempt, 1.0) * random.uniform(0.5, 1.5)
+            DB_BUSY_RETRIES_TOTAL.inc(func=func.__name__)
+            log.warning("DB: Database busy in %s, retrying in %.2fs (%d/%d)...", func.__name__, delay, attempt + 1, DB_BUSY_RETRIES)
+            time.sleep(delay)
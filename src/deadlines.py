@@ -0,0 +1,99 @@
+# src/deadlines.py
+"""
+Timeouts for shipments waiting on carriers, kept as rows in the `deadlines`
+table instead of being recomputed from every open shipment on each cycle.
+
+Whenever the worker moves a shipment into a waiting phase it schedules the
+shipment's deadline for that phase, plus one for each carrier it is waiting on
+that has a reply timeout of its own. Leaving the phase drops them (a trigger
+does this, so every path that changes a shipment's status is covered). Expired
+deadlines are found through an index on deadline_at, so handling them costs
+only as much as there are expired ones, and the next deadline tells the worker
+how long it may sleep.
+
+Timeouts are configured in hours, per phase with PHASE_TIMEOUT_HOURS (falling
+back to TIMEOUT_HOURS) and per carrier with a 'reply_timeout_hours' entry in
+CARRIERS, either one number or a dict keyed by phase. A carrier that misses its
+reply timeout is given up on and the shipment carries on without it; a shipment
+that misses its phase deadline is timed out altogether.
+"""
+from datetime import datetime, timedelta
+from src import config
+from src.config import TIMEOUT_HOURS
+
+# The shipment statuses that wait on carriers, each with its own deadline.
+WAITING_PHASES = ('awaiting_initial_quotes', 'awaiting_final_offers')
+
+# --- Deadline settings (override any of these in src/config.py) ---
+# Hours a shipment may spend in each phase before it is timed out, e.g.
+# {'awaiting_final_offers': 24}. Phases left out use TIMEOUT_HOURS.
+PHASE_TIMEOUT_HOURS = getattr(config, 'PHASE_TIMEOUT_HOURS', {})
+
+
+def phase_timeout(phase):
+    """Returns how long a shipment may stay in `phase`."""
+    return timedelta(hours=PHASE_TIMEOUT_HOURS.get(phase, TIMEOUT_HOURS))
+
+
+def carrier_timeout(carrier_info, phase):
+    """Returns how long to wait for a carrier's reply in `phase`, or None to wait as long as the phase does."""
+    hours = carrier_info.get('reply_timeout_hours')
+    if isinstance(hours, dict):
+        hours = hours.get(phase)
+    return None if hours is None else timedelta(hours=hours)
+
+
+def schedule_deadlines(cursor, phase, shipment_ids, carrier_waits=(), carriers_config=None):
+    """
+    Schedules the phase deadline of every shipment in shipment_ids, and a reply
+    deadline for each (shipment_id, carrier_name) in carrier_waits whose carrier
+    has a reply timeout for this phase. Does not commit.
+    """
+    now = datetime.now()
+    rows = [(shipment_id, phase, '', (now + phase_timeout(phase)).isoformat()) for shipment_id in shipment_ids]
+    for shipment_id, carrier_name in carrier_waits:
+        timeout = carrier_timeout(carriers_config[carrier_name], phase)
+        if timeout is not None:
+            rows.append((shipment_id, phase, carrier_name, (now + timeout).isoformat()))
+    cursor.executemany(
+        "INSERT OR REPLACE INTO deadlines (shipment_id, phase, carrier_name, deadline_at) VALUES (?, ?, ?, ?)",
+        rows
+    )
+
+
+def schedule_missing_deadlines(conn):
+    """
+    Gives waiting shipments that have no deadline for their phase (those from
+    before deadlines were scheduled) one counted from their request date.
+    """
+    placeholders = ','.join('?' * len(WAITING_PHASES))
+    missing = conn.execute(f"""
+        SELECT s.shipment_id, s.status, s.request_date FROM shipments s
+        WHERE s.status IN ({placeholders}) AND NOT EXISTS (
+            SELECT 1 FROM deadlines d WHERE d.shipment_id = s.shipment_id AND d.phase = s.status AND d.carrier_name = ''
+        )
+    """, WAITING_PHASES).fetchall()
+    conn.executemany(
+        "INSERT OR IGNORE INTO deadlines (shipment_id, phase, carrier_name, deadline_at) VALUES (?, ?, '', ?)",
+        [(shipment_id, phase, (datetime.fromisoformat(request_date) + phase_timeout(phase)).isoformat())
+         for shipment_id, phase, request_date in missing]
+    )
+    conn.commit()
+    return len(missing)
+
+
+def pop_expired_deadlines(cursor, now=None):
+    """
+    Removes and returns every (shipment_id, phase, carrier_name) deadline that
+    has passed; carrier_name is '' for a shipment's own deadline. Does not commit.
+    """
+    now = (now or datetime.now()).isoformat()
+    return cursor.execute(
+        "DELETE FROM deadlines WHERE deadline_at <= ? RETURNING shipment_id, phase, carrier_name", (now,)
+    ).fetchall()
+
+
+def next_deadline(conn):
+    """Returns when the next deadline is due, or None if nothing is waiting."""
+    deadline_at = conn.execute("SELECT MIN(deadline_at) FROM deadlines").fetchone()[0]
+    return datetime.fromisoformat(deadline_at) if deadline_at else None
@@ -1,60 +1,336 @@
-import re
+import atexit
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED, FIRST_COMPLETED
 from datetime import datetime
-from imap_tools import MailBox, A
-from src.ai_parser import parse_quote_with_ai
+from imap_tools import MailBox, MailBoxUnencrypted, A
+from src import config
+from src.metrics import Counter, Histogram
+from src.price_extractor import parse_quotes
+from src.routing import get_routing_index, route_reply
 from src.config import SENDER_EMAIL, SENDER_PASSWORD, IMAP_SERVER
 
-def parse_incoming_quotes(conn, carriers_config):
+# --- IMAP connection settings (override any of these in src/config.py) ---
+IMAP_PORT = getattr(config, 'IMAP_PORT', 993)
+# Set to False to talk plain IMAP, e.g. to a local stand-in server while testing.
+IMAP_USE_SSL = getattr(config, 'IMAP_USE_SSL', True)
+
+# --- Pipeline tuning (override any of these in src/config.py) ---
+# How many messages are downloaded per IMAP FETCH command.
+EMAIL_FETCH_BATCH_SIZE = getattr(config, 'EMAIL_FETCH_BATCH_SIZE', 50)
+# How many replies are handed to the parser together (and share batched AI requests).
+EMAIL_PARSE_BATCH_SIZE = getattr(config, 'EMAIL_PARSE_BATCH_SIZE', 10)
+# How many parse batches run at the same time.
+EMAIL_PARSE_WORKERS = getattr(config, 'EMAIL_PARSE_WORKERS', 8)
+# Backpressure: the fetcher stops pulling messages while this many parse batches are queued or running.
+EMAIL_MAX_IN_FLIGHT = getattr(config, 'EMAIL_MAX_IN_FLIGHT', 16)
+# How many parsed replies are written to the DB (and flagged as read) per transaction.
+EMAIL_WRITE_BATCH_SIZE = getattr(config, 'EMAIL_WRITE_BATCH_SIZE', 25)
+
+# --- Inbox sync settings (override any of these in src/config.py) ---
+IMAP_FOLDER = getattr(config, 'IMAP_FOLDER', 'INBOX')
+# Watch the inbox with IMAP IDLE on a second connection, so the worker wakes
+# up as soon as a reply lands instead of at its next polling interval.
+IMAP_IDLE = getattr(config, 'IMAP_IDLE', True)
+# Servers drop connections that stay in IDLE for 30 minutes, so it is renewed sooner.
+IMAP_IDLE_RENEW_SECONDS = getattr(config, 'IMAP_IDLE_RENEW_SECONDS', 25 * 60)
+# How long the IDLE watcher waits before reconnecting after losing its connection.
+IMAP_RECONNECT_SECONDS = getattr(config, 'IMAP_RECONNECT_SECONDS', 30)
+
+# The worker's logged-in session, kept open between checks, and the UIDVALIDITY
+# of IMAP_FOLDER it saw at login.
+_session = None
+_session_uid_validity = None
+
+log = logging.getLogger(__name__)
+
+IMAP_LOGIN_SECONDS = Histogram('imap_login_seconds', "Time to connect and log in to the IMAP server.")
+IMAP_FETCH_SECONDS = Histogram('imap_fetch_seconds', "Time spent waiting on the IMAP server for each fetched message.")
+IMAP_FLAG_SECONDS = Histogram('imap_flag_seconds', "Time to mark one written batch of messages as read.")
+EMAIL_PARSE_SECONDS = Histogram('email_parse_batch_seconds', "Time to parse the prices out of one batch of replies.")
+EMAILS_PROCESSED = Counter('emails_processed_total', "Fetched emails by outcome (parsed, unmatched, duplicate).", ['outcome'])
+QUOTES_PARSED = Counter('quotes_parsed_total', "Parsed carrier replies by quote type and whether a price was found.", ['quote_type', 'result'])
+EMAIL_PARSER_ERRORS = Counter('email_parser_errors_total', "Email checks abandoned because of an IMAP or parsing error.")
+
+
+def open_mailbox():
+    """Connects to the configured IMAP server; call login() on the result."""
+    mailbox_class = MailBox if IMAP_USE_SSL else MailBoxUnencrypted
+    return mailbox_class(IMAP_SERVER, IMAP_PORT)
+
+
+def _login():
+    with IMAP_LOGIN_SECONDS.time():
+        return open_mailbox().login(SENDER_EMAIL, SENDER_PASSWORD, IMAP_FOLDER)
+
+
+def get_session():
+    """
+    Returns the persistent IMAP session and the folder's UIDVALIDITY, logging
+    in only when there is no session yet or the server has dropped it.
+    """
+    global _session, _session_uid_validity
+    if _session is not None:
+        try:
+            _session.client.noop()
+            return _session, _session_uid_validity
+        except Exception:
+            close_session()
+    mailbox = _login()
+    _session_uid_validity = mailbox.folder.status(IMAP_FOLDER, ['UIDVALIDITY'])['UIDVALIDITY']
+    _session = mailbox
+    return _session, _session_uid_validity
+
+
+def close_session():
+    """Logs out of the persistent IMAP session, if there is one."""
+    global _session
+    mailbox, _session = _session, None
+    if mailbox is not None:
+        try:
+            mailbox.logout()
+        except Exception:
+            pass
+
+atexit.register(close_session)
+
+
+def _account():
+    return f"{SENDER_EMAIL}@{IMAP_SERVER}"
+
+
+def inbox_name():
+    """Names the mailbox folder this process reads, e.g. for a lease on it."""
+    return f"{_account()}/{IMAP_FOLDER}"
+
+
+def load_sync_state(conn):
+    """Returns (uid_validity, last_uid) for IMAP_FOLDER, or None before the first sync."""
+    row = conn.execute(
+        "SELECT uid_validity, last_uid FROM imap_sync_state WHERE account = ? AND folder = ?", (_account(), IMAP_FOLDER)
+    ).fetchone()
+    return tuple(row) if row else None
+
+
+def save_sync_state(conn, uid_validity, last_uid):
+    conn.execute("""
+        INSERT INTO imap_sync_state (account, folder, uid_validity, last_uid, synced_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (account, folder) DO UPDATE SET
+            uid_validity = excluded.uid_validity, last_uid = excluded.last_uid, synced_at = excluded.synced_at
+    """, (_account(), IMAP_FOLDER, uid_validity, last_uid, datetime.now().isoformat()))
+    conn.commit()
+
+
+def _timed(iterable, histogram):
+    """Yields from iterable, observing how long each item took to arrive."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        histogram.observe(time.perf_counter() - start)
+        yield item
+
+
+def get_message_key(msg):
+    """A stable identifier for a message, used to make sure it is only processed once."""
+    message_id = msg.headers.get('message-id', ('',))[0].strip()
+    return message_id or f"uid:{msg.uid}"
+
+
+def save_parsed_quote(cursor, shipment_id, carrier_name, quote_type, price):
+    """Records the outcome of a parsed quote email in the quotes table."""
+    QUOTES_PARSED.inc(quote_type=quote_type, result='failed' if price is None else 'found')
+    if price is None:
+        log.info("   - ❌ Could not find a quote in %s reply for #%s. Marking as failed.", quote_type.upper(), shipment_id)
+        status_update_sql = "UPDATE quotes SET status = 'failed' WHERE shipment_id = ? AND carrier_name = ? AND quote_type = ?"
+        if quote_type == 'final':
+            status_update_sql = "INSERT INTO quotes (shipment_id, carrier_name, quote_type, status) VALUES (?, ?, ?, ?)"
+        cursor.execute(status_update_sql, (shipment_id, carrier_name, quote_type, 'failed'))
+    else:
+        log.debug("   - ✅ Found %s quote of $%.2f for #%s. Updating database...", quote_type.upper(), price, shipment_id)
+        if quote_type == 'initial':
+            cursor.execute("UPDATE quotes SET price = ?, received_at = ?, status = 'received' WHERE shipment_id = ? AND carrier_name = ? AND quote_type = ?", (price, datetime.now().isoformat(), shipment_id, carrier_name, quote_type))
+        else: # Final
+            cursor.execute("INSERT INTO quotes (shipment_id, carrier_name, quote_type, price, received_at, status) VALUES (?, ?, ?, ?, ?, ?)", (shipment_id, carrier_name, quote_type, price, datetime.now().isoformat(), 'received'))
+
+
+def write_parsed_batch(conn, mailbox, parsed, skipped_uids):
     """
-    Logs into email, fetches replies, uses AI to parse them, and updates the database.
+    Writer stage: applies a batch of parsed replies in one transaction, then
+    marks them (and any skipped messages) as read in a single IMAP command.
+
+    Messages are only flagged after the commit, so a crash never loses a reply.
+    Each message's key is stored in the same transaction as its quote, so a
+    reply that was committed but not yet flagged is never applied twice.
     """
     cursor = conn.cursor()
-    print("Checking for new quote emails...")
+    for key, uid, carrier_name, shipment_id, quote_type, price in parsed:
+        cursor.execute(
+            "INSERT OR IGNORE INTO processed_emails (message_key, shipment_id, processed_at) VALUES (?, ?, ?)",
+            (key, shipment_id, datetime.now().isoformat())
+        )
+        if cursor.rowcount == 0:
+            continue # Already applied by an earlier run that crashed before flagging
+        save_parsed_quote(cursor, shipment_id, carrier_name, quote_type, price)
+    conn.commit()
+
+    uids = [uid for _, uid, *_ in parsed] + skipped_uids
+    if uids:
+        with IMAP_FLAG_SECONDS.time():
+            mailbox.flag(uids, '\\Seen', True)
+        log.info("   - Database updated and %d email(s) marked as read.", len(uids))
+
+
+def _parse_replies(replies):
+    """Parse stage: runs in the worker pool, so it must not touch the DB or IMAP connection."""
+    with EMAIL_PARSE_SECONDS.time():
+        prices = parse_quotes([body for *_, body in replies])
+    return [(*reply[:-1], price) for reply, price in zip(replies, prices)]
+
+
+def _fetch_new_replies(conn, mailbox, uids, routing_index, max_workers, max_in_flight, batch_size, parse_batch_size):
+    """
+    Runs the fetch/parse/write pipeline over the given message UIDs. Only the
+    headers are fetched at first; bodies are downloaded just for the messages
+    that turn out to be carrier replies we haven't applied yet.
+    """
+    replies, skipped_uids = {}, []
+    for msg in _timed(mailbox.fetch(uid_list=uids, headers_only=True, mark_seen=False, bulk=EMAIL_FETCH_BATCH_SIZE), IMAP_FETCH_SECONDS):
+        log.debug("Found potential quote email from %s with subject '%s'", msg.from_, msg.subject)
+
+        key = get_message_key(msg)
+        match = route_reply(conn, msg, routing_index)
+        already_processed = conn.execute("SELECT 1 FROM processed_emails WHERE message_key = ?", (key,)).fetchone()
+        if not match or already_processed:
+            EMAILS_PROCESSED.inc(outcome='duplicate' if already_processed else 'unmatched')
+            skipped_uids.append(msg.uid) # Mark non-carrier, malformed and duplicate emails as read
+            continue
+
+        EMAILS_PROCESSED.inc(outcome='parsed')
+        replies[msg.uid] = (key, match)
+
+    if not replies:
+        write_parsed_batch(conn, mailbox, [], skipped_uids)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        in_flight = set()
+        parsed, to_parse = [], []
+
+        def collect(return_when=FIRST_COMPLETED, timeout=None):
+            nonlocal in_flight
+            done, in_flight = wait(in_flight, timeout=timeout, return_when=return_when)
+            for future in done:
+                parsed.extend(future.result())
+
+        def submit():
+            nonlocal to_parse
+            if len(in_flight) >= max_in_flight:
+                collect()
+            in_flight.add(pool.submit(_parse_replies, to_parse))
+            to_parse = []
+
+        # Messages are only marked as read by the writer, once their quote is committed.
+        for msg in _timed(mailbox.fetch(uid_list=list(replies), mark_seen=False, bulk=EMAIL_FETCH_BATCH_SIZE), IMAP_FETCH_SECONDS):
+            collect(timeout=0) # Pick up whatever has finished parsing so far
+            if len(parsed) + len(skipped_uids) >= batch_size:
+                write_parsed_batch(conn, mailbox, parsed, skipped_uids)
+                parsed, skipped_uids = [], []
+
+            key, match = replies[msg.uid]
+            to_parse.append((key, msg.uid, *match, msg.text))
+            if len(to_parse) >= parse_batch_size:
+                submit()
+
+        if to_parse:
+            submit()
+        collect(return_when=ALL_COMPLETED)
+        write_parsed_batch(conn, mailbox, parsed, skipped_uids)
+
+
+def parse_incoming_quotes(conn, carriers_config, max_workers=None, max_in_flight=None, batch_size=None, parse_batch_size=None):
+    """
+    Fetches new replies over the persistent IMAP session, parses their prices,
+    and updates the database.
+
+    Only messages with a UID above the last one synced are looked at (all
+    unread ones after a UIDVALIDITY change). They run through a three-stage
+    pipeline: headers are fetched in bulk to pick out carrier replies, their
+    bodies are fetched and price-parsed (local extractor, then batched AI
+    requests if needed) concurrently in a bounded thread pool, and this thread
+    writes the results back in batches. Pass max_workers=1 and
+    parse_batch_size=1 to parse one email at a time.
+    """
+    max_workers = max_workers or EMAIL_PARSE_WORKERS
+    max_in_flight = max(max_in_flight or EMAIL_MAX_IN_FLIGHT, max_workers)
+    batch_size = batch_size or EMAIL_WRITE_BATCH_SIZE
+    parse_batch_size = parse_batch_size or EMAIL_PARSE_BATCH_SIZE
+
+    log.debug("Checking for new quote emails...")
     try:
-        with MailBox(IMAP_SERVER).login(SENDER_EMAIL, SENDER_PASSWORD, 'INBOX') as mailbox:
-            for msg in mailbox.fetch(A(seen=False)):
-                print(f"Found potential quote email from {msg.from_} with subject '{msg.subject}'")
-
-                sender_email = msg.from_
-                carrier_name = next((name for name, info in carriers_config.items() if info.get('contact') == sender_email), None)
-
-                if not carrier_name:
-                    print(f"   - Could not find a matching carrier for email: {sender_email}. Skipping.")
-                    mailbox.flag(msg.uid, '\\Seen', True) # Mark non-carrier emails as read
-                    continue
-
-                shipment_id_match = re.search(r'#(\d+)', msg.subject)
-                if not shipment_id_match:
-                    print(f"   - Could not find shipment ID in subject. Skipping.")
-                    mailbox.flag(msg.uid, '\\Seen', True) # Mark malformed subjects as read
-                    continue
-
-                shipment_id = int(shipment_id_match.group(1))
-                print(f"   - Matched to Shipment ID: {shipment_id}, Carrier: {carrier_name}")
-
-                # Use AI to parse the price from the full email text
-                price = parse_quote_with_ai(msg.text)
-
-                quote_type = 'final' if 'Final Offer Request' in msg.subject else 'initial'
-
-                if price is None:
-                    print(f"   - ❌ AI could not find a quote in {quote_type.upper()} reply. Marking as failed.")
-                    status_update_sql = "UPDATE quotes SET status = 'failed' WHERE shipment_id = ? AND carrier_name = ? AND quote_type = ?"
-                    if quote_type == 'final':
-                        status_update_sql = "INSERT INTO quotes (shipment_id, carrier_name, quote_type, status) VALUES (?, ?, ?, ?)"
-                    cursor.execute(status_update_sql, (shipment_id, carrier_name, quote_type, 'failed'))
-                else:
-                    print(f"   - ✅ AI found {quote_type.upper()} quote of ${price:.2f}. Updating database...")
-                    if quote_type == 'initial':
-                        cursor.execute("UPDATE quotes SET price = ?, received_at = ?, status = 'received' WHERE shipment_id = ? AND carrier_name = ? AND quote_type = ?", (price, datetime.now().isoformat(), shipment_id, carrier_name, quote_type))
-                    else: # Final
-                        cursor.execute("INSERT INTO quotes (shipment_id, carrier_name, quote_type, price, received_at, status) VALUES (?, ?, ?, ?, ?, ?)", (shipment_id, carrier_name, quote_type, price, datetime.now().isoformat(), 'received'))
-
-                # --- BUG FIX: Only commit and mark as read if the DB operation was successful ---
-                conn.commit()
-                print(f"   - Database updated for Shipment ID: {shipment_id}.")
-                mailbox.flag(msg.uid, '\\Seen', True)
-                print(f"   - Marked email as read.")
+        mailbox, uid_validity = get_session()
+        state = load_sync_state(conn)
+        if state and state[0] == uid_validity:
+            last_uid = state[1]
+            # 'n:*' always matches the newest message, even when its UID is below n.
+            uids = [uid for uid in mailbox.uids(f"UID {last_uid + 1}:*") if int(uid) > last_uid]
+        else:
+            if state:
+                log.warning("IMAP: UIDVALIDITY of %s changed; rescanning its unread messages.", IMAP_FOLDER)
+            last_uid = mailbox.folder.status(IMAP_FOLDER, ['UIDNEXT'])['UIDNEXT'] - 1
+            uids = mailbox.uids(A(seen=False))
+
+        if uids:
+            _fetch_new_replies(conn, mailbox, uids, get_routing_index(carriers_config),
+                               max_workers, max_in_flight, batch_size, parse_batch_size)
+        # Saved last, so replies from a check that fails part-way are fetched
+        # again (and recognised by their message key) next time.
+        synced_uid = max([last_uid, *map(int, uids)])
+        if state != (uid_validity, synced_uid):
+            save_sync_state(conn, uid_validity, synced_uid)
 
     except Exception as e:
-        print(f"EMAIL PARSER ERROR: Could not connect or process emails. Error: {e}")
+        close_session() # Start the next check from a fresh connection
+        EMAIL_PARSER_ERRORS.inc()
+        log.error("EMAIL PARSER ERROR: Could not connect or process emails. Error: %s", e)
+
+
+def _idle(mailbox, on_new_mail, stop):
+    """One IDLE command, renewed after IMAP_IDLE_RENEW_SECONDS as servers expect."""
+    renew_at = time.monotonic() + IMAP_IDLE_RENEW_SECONDS
+    with mailbox.idle as idle:
+        while not stop.is_set() and time.monotonic() < renew_at:
+            started = time.monotonic()
+            responses = idle.poll(timeout=1)
+            if any(b'EXISTS' in response for response in responses):
+                on_new_mail()
+            elif not responses and time.monotonic() - started < 0.5:
+                # poll() returns early with nothing when the server has hung up.
+                raise ConnectionError("connection closed by the server")
+
+
+def watch_inbox(on_new_mail, stop):
+    """
+    Keeps a second IMAP connection in IDLE and calls on_new_mail() as soon as
+    the server reports new messages, until `stop` (a threading.Event) is set.
+    Returns straight away if IMAP_IDLE is off or the server can't IDLE,
+    leaving the worker to its polling interval. Each (re)connection reports
+    new mail once up front, for anything that arrived while it was down.
+    """
+    while IMAP_IDLE and not stop.is_set():
+        try:
+            with _login() as mailbox:
+                if 'IDLE' not in mailbox.client.capabilities:
+                    log.info("IMAP: Server does not support IDLE; new replies are picked up every polling interval.")
+                    return
+                on_new_mail()
+                while not stop.is_set():
+                    _idle(mailbox, on_new_mail, stop)
+        except Exception as e:
+            if stop.is_set():
+                return
+            log.warning("IMAP: Lost the IDLE connection (%s); reconnecting in %ss.", e, IMAP_RECONNECT_SECONDS)
+            stop.wait(IMAP_RECONNECT_SECONDS)
@@ -1,7 +1,33 @@
+import atexit
+import logging
+import queue
 import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
+from src import config
+from src.metrics import Counter, Histogram
 from src.config import COMPANY_NAME, SENDER_EMAIL, SENDER_PASSWORD, SMTP_SERVER
 
+# --- SMTP connection settings (override any of these in src/config.py) ---
+SMTP_PORT = getattr(config, 'SMTP_PORT', 465)
+# Set to False to talk plain SMTP, e.g. to a local stand-in server while testing.
+SMTP_USE_SSL = getattr(config, 'SMTP_USE_SSL', True)
+# How many authenticated sessions are kept open and used in parallel.
+SMTP_POOL_SIZE = getattr(config, 'SMTP_POOL_SIZE', 4)
+SMTP_TIMEOUT_SECONDS = getattr(config, 'SMTP_TIMEOUT_SECONDS', 30)
+
+# Logged-in sessions waiting to be reused, and a cap on how many exist at once.
+_idle_connections = queue.LifoQueue()
+_pool_slots = threading.BoundedSemaphore(SMTP_POOL_SIZE)
+
+log = logging.getLogger(__name__)
+
+SMTP_SEND_SECONDS = Histogram('smtp_send_seconds', "Time to send one email, including any reconnect.", ['result'])
+SMTP_CONNECTIONS = Counter('smtp_connections_opened_total', "New SMTP sessions opened (each a TLS handshake and login).")
+SMTP_RECONNECTS = Counter('smtp_stale_sessions_total', "Pooled SMTP sessions found dropped by the server and replaced.")
+
 def generate_quote_request_content(shipment_details):
     """Generates the subject and body for an initial quote request."""
     subject = f"Quote Request - Shipment #{shipment_details['shipment_id']}"
@@ -38,21 +64,117 @@ Thank you,
     return {'subject': subject, 'body': body}
 
 
-def send_email(recipient_email, subject, body):
-    """A centralized function to send any email."""
+def _open_connection():
+    """Opens and authenticates a new SMTP session."""
+    smtp_class = smtplib.SMTP_SSL if SMTP_USE_SSL else smtplib.SMTP
+    SMTP_CONNECTIONS.inc()
+    server = smtp_class(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT_SECONDS)
+    try:
+        server.login(SENDER_EMAIL, SENDER_PASSWORD)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+def _close_connection(server):
+    try:
+        server.quit()
+    except Exception:
+        server.close()
+
+
+def close_smtp_pool():
+    """Logs out of every idle pooled SMTP session."""
+    while True:
+        try:
+            _close_connection(_idle_connections.get_nowait())
+        except queue.Empty:
+            return
+
+atexit.register(close_smtp_pool)
+
+
+def _discard_idle_connections():
+    """Closes every idle pooled session without logging out, for when they have likely gone stale."""
+    while True:
+        try:
+            _idle_connections.get_nowait().close()
+        except queue.Empty:
+            return
+
+
+def send_email(recipient_email, subject, body, message_id=None):
+    """
+    A centralized function to send any email, with the given Message-ID if there is one.
+
+    Sessions are taken from a pool and returned after sending, so consecutive
+    emails skip the TLS handshake and login. A session the server has dropped
+    is replaced with a freshly opened one (the other idle sessions are
+    dropped too) and the send retried once; a message the
+    server refuses fails straight away and leaves the session in the pool.
+    """
     msg = EmailMessage()
     msg.set_content(body)
     msg['Subject'] = subject
     msg['From'] = SENDER_EMAIL
     msg['To'] = recipient_email
+    if message_id:
+        msg['Message-ID'] = message_id
 
-    try:
-        server = smtplib.SMTP_SSL(SMTP_SERVER, 465)
-        server.login(SENDER_EMAIL, SENDER_PASSWORD)
-        server.send_message(msg)
-        server.quit()
-        print(f"✅ Email sent successfully to {recipient_email}.")
-        return True
-    except Exception as e:
-        print(f"❌ FAILED to send email to {recipient_email}: {e}")
-        return False
+    start = time.perf_counter()
+    with _pool_slots:
+        for attempt in range(2):
+            server = None
+            try:
+                if attempt == 0:
+                    try:
+                        server = _idle_connections.get_nowait()
+                    except queue.Empty:
+                        server = _open_connection()
+                else:
+                    server = _open_connection()
+                server.send_message(msg)
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused, smtplib.SMTPNotSupportedError) as e:
+                # The server refused this message; resending won't help, and the session itself is fine.
+                if server is not None:
+                    _idle_connections.put(server)
+                SMTP_SEND_SECONDS.observe(time.perf_counter() - start, result='failed')
+                log.error("SMTP ERROR: ❌ Server rejected email to %s: %s", recipient_email, e)
+                return False
+            except (smtplib.SMTPServerDisconnected, OSError) as e:
+                # SMTP exceptions are OSErrors too, but every other one is caught
+                # above, so only a dropped session or a socket error gets here.
+                if server is not None:
+                    server.close()
+                if attempt == 0:
+                    # Sessions that sat idle as long as this one are likely just as
+                    # stale, so they are dropped too and the retry starts afresh.
+                    _discard_idle_connections()
+                    SMTP_RECONNECTS.inc()
+                    continue
+                SMTP_SEND_SECONDS.observe(time.perf_counter() - start, result='failed')
+                log.error("SMTP ERROR: ❌ FAILED to send email to %s: %s", recipient_email, e)
+                return False
+            except Exception as e:
+                if server is not None:
+                    _idle_connections.put(server) # The session itself is still fine
+                SMTP_SEND_SECONDS.observe(time.perf_counter() - start, result='failed')
+                log.error("SMTP ERROR: ❌ FAILED to send email to %s: %s", recipient_email, e)
+                return False
+
+            _idle_connections.put(server)
+            SMTP_SEND_SECONDS.observe(time.perf_counter() - start, result='sent')
+            log.debug("✅ Email sent successfully to %s.", recipient_email)
+            return True
+
+
+def send_emails(messages):
+    """
+    Sends a batch of (recipient_email, subject, body[, message_id]) messages in parallel over
+    the SMTP pool. Returns one success flag per message, in order.
+    """
+    if not messages:
+        return []
+    with ThreadPoolExecutor(max_workers=SMTP_POOL_SIZE) as executor:
+        return list(executor.map(lambda message: send_email(*message), messages))
@@ -0,0 +1,205 @@
+# src/events.py
+"""
+Change feed for the dashboard event stream. Triggers record every shipment and
+quote change in `change_log` (see the migrations in database_setup). One
+background thread per app process notices new changes by polling SQLite's
+`data_version`, reads them once, and hands the current version of every
+changed row to each subscribed dashboard, so open dashboards cost nothing
+while nothing changes.
+"""
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from src import config
+from src.database_setup import DB_PATH
+from src.db import connect
+from src.stats import get_dashboard_stats
+
+# --- Event stream settings (override any of these in src/config.py) ---
+# How often the feed thread checks the database for new changes.
+EVENT_POLL_SECONDS = getattr(config, 'EVENT_POLL_SECONDS', 0.5)
+# Batches touching more rows than this are sent as a 'reset' instead, telling
+# dashboards to re-fetch the page they are showing.
+EVENT_MAX_ROWS = getattr(config, 'EVENT_MAX_ROWS', 500)
+# Idle streams get a comment this often, so dropped connections are noticed.
+EVENT_HEARTBEAT_SECONDS = getattr(config, 'EVENT_HEARTBEAT_SECONDS', 15)
+# The worker keeps this many of the newest change_log entries.
+CHANGE_LOG_MAX_ROWS = getattr(config, 'CHANGE_LOG_MAX_ROWS', 100_000)
+# Events buffered per dashboard before it is told to reset instead.
+EVENT_QUEUE_SIZE = getattr(config, 'EVENT_QUEUE_SIZE', 100)
+
+_subscribers = set()
+_subscribers_lock = threading.Lock()
+_feed_thread = None
+_feed_lock = threading.Lock()
+
+log = logging.getLogger(__name__)
+
+
+def _rows_as_dicts(cursor):
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def _fetch_rows(conn, table, key, ids):
+    if not ids:
+        return []
+    placeholders = ','.join('?' * len(ids))
+    return _rows_as_dicts(conn.execute(f"SELECT * FROM {table} WHERE {key} IN ({placeholders})", tuple(ids)))
+
+
+def read_changes(conn, after_id):
+    """
+    Returns (last_change_id, event) for everything logged after `after_id`, or
+    (after_id, None) when nothing has changed.
+
+    The event is ('changes', {...}) with the current shipment and quote rows
+    plus fresh dashboard stats, or ('reset', {...}) when too much changed to
+    be worth sending row by row, or a bulk write logged a reset.
+    """
+    # One row more than a batch may touch is enough to know it is a reset, so
+    # a bulk write never has to be read into memory.
+    changes = conn.execute(
+        "SELECT change_id, entity, entity_id FROM change_log WHERE change_id > ? ORDER BY change_id LIMIT ?",
+        (after_id, EVENT_MAX_ROWS + 1)
+    ).fetchall()
+    if not changes:
+        return after_id, None
+    if len(changes) > EVENT_MAX_ROWS:
+        return latest_change_id(conn), ('reset', {'stats': get_dashboard_stats(conn)})
+
+    last_id = changes[-1][0]
+    shipment_ids = sorted({entity_id for _, entity, entity_id in changes if entity == 'shipment'})
+    quote_ids = sorted({entity_id for _, entity, entity_id in changes if entity == 'quote'})
+    stats = get_dashboard_stats(conn)
+
+    # A 'reset' entry is logged by bulk writes that skip the per-row log.
+    if len(shipment_ids) + len(quote_ids) > EVENT_MAX_ROWS or any(entity == 'reset' for _, entity, _ in changes):
+        return last_id, ('reset', {'stats': stats})
+    return last_id, ('changes', {
+        'shipments': _fetch_rows(conn, 'shipments', 'shipment_id', shipment_ids),
+        'quotes': _fetch_rows(conn, 'quotes', 'quote_id', quote_ids),
+        'stats': stats,
+    })
+
+
+def oldest_change_id(conn):
+    return conn.execute("SELECT MIN(change_id) FROM change_log").fetchone()[0]
+
+
+def latest_change_id(conn):
+    return conn.execute("SELECT COALESCE(MAX(change_id), 0) FROM change_log").fetchone()[0]
+
+
+def prune_change_log(conn):
+    """Deletes all but the newest CHANGE_LOG_MAX_ROWS change_log entries."""
+    pruned = conn.execute(
+        "DELETE FROM change_log WHERE change_id <= (SELECT MAX(change_id) FROM change_log) - ?",
+        (CHANGE_LOG_MAX_ROWS,)
+    ).rowcount
+    conn.commit()
+    return pruned
+
+
+def format_event(event_id, event):
+    """Encodes an (event name, payload) pair as a Server-Sent Events message."""
+    name, payload = event
+    return f"id: {event_id}\nevent: {name}\ndata: {json.dumps(payload)}\n\n"
+
+
+def _publish(event_id, event):
+    with _subscribers_lock:
+        subscribers = list(_subscribers)
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait((event_id, event))
+        except queue.Full:
+            # The dashboard has fallen behind; drop what it hasn't read and
+            # have it re-fetch instead.
+            with subscriber.mutex:
+                subscriber.queue.clear()
+            subscriber.put_nowait((event_id, ('reset', {})))
+
+
+def _feed_loop(db_path):
+    conn = connect(db_path)
+    last_id = latest_change_id(conn)
+    data_version = None
+    while True:
+        try:
+            # data_version only moves when another connection commits, so an
+            # idle database costs one pragma per poll however many dashboards are open.
+            current_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if current_version != data_version:
+                data_version = current_version
+                last_id, event = read_changes(conn, last_id)
+                if event:
+                    _publish(last_id, event)
+        except sqlite3.Error as e:
+            log.error("EVENTS ERROR: Could not read changes: %s", e)
+        time.sleep(EVENT_POLL_SECONDS)
+
+
+def start_change_feed(db_path=DB_PATH):
+    """Starts the shared feed thread for this process, if it isn't running yet."""
+    global _feed_thread
+    with _feed_lock:
+        if _feed_thread is None or not _feed_thread.is_alive():
+            _feed_thread = threading.Thread(target=_feed_loop, args=(db_path,), name="change-feed", daemon=True)
+            _feed_thread.start()
+
+
+def subscribe():
+    """Returns a queue that receives (change_id, event) pairs from the feed."""
+    subscriber = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+    with _subscribers_lock:
+        _subscribers.add(subscriber)
+    return subscriber
+
+
+def unsubscribe(subscriber):
+    with _subscribers_lock:
+        _subscribers.discard(subscriber)
+
+
+def stream_events(subscriber, conn, last_event_id=None):
+    """
+    Yields Server-Sent Events for one dashboard until it disconnects.
+
+    A reconnecting EventSource sends the id of the last event it saw; whatever
+    it missed is replayed from change_log first, or it is told to reset if
+    those entries have already been pruned. `conn` is only used for that
+    catch-up and is closed before streaming starts.
+    """
+    sent_up_to = 0
+    try:
+        try:
+            if last_event_id is not None:
+                oldest = oldest_change_id(conn)
+                if oldest is not None and last_event_id < oldest - 1:
+                    sent_up_to = latest_change_id(conn)
+                    yield format_event(sent_up_to, ('reset', {}))
+                else:
+                    sent_up_to, event = read_changes(conn, last_event_id)
+                    if event:
+                        yield format_event(sent_up_to, event)
+        finally:
+            conn.close()
+
+        yield "retry: 2000\n\n"
+        while True:
+            try:
+                event_id, event = subscriber.get(timeout=EVENT_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ": heartbeat\n\n"
+                continue
+            # Rows are sent whole, so replaying part of a batch is harmless;
+            # only batches already covered by the catch-up are skipped.
+            if event_id <= sent_up_to and event[0] == 'changes':
+                continue
+            yield format_event(event_id, event)
+    finally:
+        unsubscribe(subscriber)
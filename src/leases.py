@@ -0,0 +1,151 @@
+# src/leases.py
+"""
+Leases that let several worker processes on one host share the database
+without doing the same work twice. They must all be on the host that has the
+database file: in WAL mode SQLite coordinates through shared memory, which a
+network filesystem can't provide, so workers on several hosts would need a
+client/server database instead.
+
+A worker claims shipments with an atomic UPDATE ... RETURNING that stamps them
+with its id and an expiry, and only shipments without a lease, or whose lease
+has expired, can be claimed. A claim finished within the same transaction
+never outlives it. Leases matter for work done after the claim commits, such
+as asking API carriers for quotes, and for named resources like the inbox,
+which one worker reads at a time.
+
+Every worker heartbeats, which extends all of its leases. A worker that dies
+stops heartbeating; once its leases expire, the others take its work over.
+"""
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+from src import config
+from src.db import get_connection, run_with_busy_retry
+
+# --- Lease settings (override any of these in src/config.py) ---
+# How long a lease lasts without a heartbeat, i.e. how soon a dead worker's work is taken over.
+WORKER_LEASE_SECONDS = getattr(config, 'WORKER_LEASE_SECONDS', 60)
+# How often a worker renews its leases; well under WORKER_LEASE_SECONDS.
+WORKER_HEARTBEAT_SECONDS = getattr(config, 'WORKER_HEARTBEAT_SECONDS', 15)
+
+log = logging.getLogger(__name__)
+
+_worker_id = None
+
+
+def worker_id():
+    """This process's id as a lease owner: host, pid and a random suffix."""
+    global _worker_id
+    if _worker_id is None or _worker_id[1] != os.getpid():
+        _worker_id = (f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}", os.getpid())
+    return _worker_id[0]
+
+
+def lease_expiry():
+    """When a lease taken or renewed now runs out."""
+    return (datetime.now() + timedelta(seconds=WORKER_LEASE_SECONDS)).isoformat()
+
+
+def acquire_lease(conn, name):
+    """
+    Takes or renews the named lease for this worker and commits. Returns False
+    if another worker holds it and it hasn't expired.
+    """
+    now = datetime.now().isoformat()
+    row = conn.execute("""
+        INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+        RETURNING owner
+    """, (name, worker_id(), lease_expiry(), now)).fetchone()
+    conn.commit()
+    return row is not None
+
+
+def release_shipments(conn, shipment_ids):
+    """Ends this worker's leases on the given shipments. Commits."""
+    conn.executemany(
+        "UPDATE shipments SET lease_owner = NULL, lease_expires_at = NULL WHERE shipment_id = ? AND lease_owner = ?",
+        [(shipment_id, worker_id()) for shipment_id in shipment_ids]
+    )
+    conn.commit()
+
+
+def expire_shipments(conn, shipment_ids):
+    """
+    Ends this worker's leases on the given shipments by expiring them rather
+    than releasing them, so whichever worker next runs
+    resume_abandoned_shipments finishes their work. For work that failed
+    part-way. Commits.
+    """
+    if conn.in_transaction:
+        conn.rollback()
+    now = datetime.now().isoformat()
+    conn.executemany(
+        "UPDATE shipments SET lease_expires_at = ? WHERE shipment_id = ? AND lease_owner = ?",
+        [(now, shipment_id, worker_id()) for shipment_id in shipment_ids]
+    )
+    conn.commit()
+
+
+def register_worker(conn):
+    """Records this worker as alive, and forgets workers that stopped long ago."""
+    now = datetime.now()
+    conn.execute(
+        "INSERT OR REPLACE INTO workers (worker_id, started_at, heartbeat_at) VALUES (?, ?, ?)",
+        (worker_id(), now.isoformat(), now.isoformat())
+    )
+    conn.execute(
+        "DELETE FROM workers WHERE heartbeat_at < ?",
+        ((now - timedelta(seconds=10 * WORKER_LEASE_SECONDS)).isoformat(),)
+    )
+    conn.commit()
+
+
+def renew_leases(conn):
+    """
+    Heartbeat: extends every lease this worker holds that hasn't expired;
+    expired ones are left for another worker to take over. Commits.
+    """
+    owner, expires_at, now = worker_id(), lease_expiry(), datetime.now().isoformat()
+    conn.execute("UPDATE workers SET heartbeat_at = ? WHERE worker_id = ?", (now, owner))
+    conn.execute(
+        "UPDATE shipments SET lease_expires_at = ? WHERE lease_owner = ? AND lease_expires_at >= ?",
+        (expires_at, owner, now)
+    )
+    conn.execute("UPDATE leases SET expires_at = ? WHERE owner = ?", (expires_at, owner))
+    conn.commit()
+
+
+def release_leases(conn):
+    """Gives up every lease this worker holds, so others needn't wait for them to expire. Commits."""
+    owner = worker_id()
+    conn.execute("UPDATE shipments SET lease_owner = NULL, lease_expires_at = NULL WHERE lease_owner = ?", (owner,))
+    conn.execute("DELETE FROM leases WHERE owner = ?", (owner,))
+    conn.execute("DELETE FROM workers WHERE worker_id = ?", (owner,))
+    conn.commit()
+
+
+def _heartbeat(db_path, stop):
+    while not stop.wait(WORKER_HEARTBEAT_SECONDS):
+        try:
+            conn = get_connection(db_path)
+            try:
+                run_with_busy_retry(conn, renew_leases)
+            finally:
+                conn.close()
+        except Exception as e:
+            log.error("LEASES ERROR: Heartbeat failed: %s", e)
+
+
+def start_heartbeat(db_path, stop):
+    """Registers this worker and renews its leases from a daemon thread until `stop` is set."""
+    conn = get_connection(db_path)
+    try:
+        run_with_busy_retry(conn, register_worker)
+    finally:
+        conn.close()
+    threading.Thread(target=_heartbeat, args=(db_path, stop), name="lease-heartbeat", daemon=True).start()
@@ -0,0 +1,42 @@
+# src/logging_setup.py
+"""
+Log configuration for the app, worker and sender. Modules log through
+logging.getLogger(__name__) with %-style arguments, so a message below the
+configured level is dropped before it is ever formatted: the per-shipment and
+per-email detail logged at DEBUG costs next to nothing unless it is turned on.
+"""
+import logging
+import sys
+from src import config
+
+# --- Logging settings (override any of these in src/config.py) ---
+LOG_LEVEL = getattr(config, 'LOG_LEVEL', 'INFO')
+# Per-logger levels on top of LOG_LEVEL, e.g. {'src.email_parser': 'DEBUG'}.
+LOG_LEVELS = getattr(config, 'LOG_LEVELS', {})
+# The default keeps the console output the same as it has always been.
+LOG_FORMAT = getattr(config, 'LOG_FORMAT', '%(message)s')
+# Log to this file instead of stdout.
+LOG_FILE = getattr(config, 'LOG_FILE', None)
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """Writes to whatever sys.stdout is at the time, like print() does."""
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+def configure_logging():
+    """Sets up the root logger from the settings above. Safe to call more than once."""
+    handler = logging.FileHandler(LOG_FILE) if LOG_FILE else _StdoutHandler()
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT, handlers=[handler], force=True)
+    for name, level in LOG_LEVELS.items():
+        logging.getLogger(name).setLevel(level)
@@ -0,0 +1,198 @@
+# src/metrics.py
+"""
+Lightweight in-process metrics, exposed in the Prometheus text format.
+
+Modules declare the counters, gauges and histograms they need at import time
+and update them on their hot paths; each update is a dict lookup under a lock,
+and nothing at all when METRICS_ENABLED is off. The app serves everything at
+/metrics; the worker and sender, which have no web server, call
+start_exporter() to serve their own on a small HTTP thread.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src import config
+
+# --- Metrics settings (override any of these in src/config.py) ---
+METRICS_ENABLED = getattr(config, 'METRICS_ENABLED', True)
+# Latency buckets in seconds, from a fast DB query up to a slow AI batch.
+METRICS_BUCKETS = getattr(config, 'METRICS_BUCKETS', (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+
+log = logging.getLogger(__name__)
+
+_registry = []
+_registry_lock = threading.Lock()
+_collectors = []
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines += self._render_value(key, value)
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{self._label_text(key)} {value:g}"]
+
+
+class Counter(_Metric):
+    """A count that only goes up, e.g. emails sent or cache hits."""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """The current count for the given labels, e.g. for a benchmark's report."""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """A value that is set to whatever it currently is, e.g. a queue depth."""
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def replace(self, values):
+        """Replaces every labelled value at once, from {label tuple: value}, so stale labels disappear."""
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values = {tuple(map(str, key)): value for key, value in values.items()}
+
+
+class Histogram(_Metric):
+    """Counts observations (usually durations in seconds) into cumulative buckets."""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets or METRICS_BUCKETS)
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the with-block took, whether or not it raised."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, key, state):
+        bucket_counts, total, count = state
+        lines, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{self._label_text(key, [('le', f'{bound:g}')])} {cumulative}")
+        lines.append(f"{self.name}_bucket{self._label_text(key, [('le', '+Inf')])} {count}")
+        lines.append(f"{self.name}_sum{self._label_text(key)} {total:g}")
+        lines.append(f"{self.name}_count{self._label_text(key)} {count}")
+        return lines
+
+
+def register_collector(func):
+    """Registers func() to be called before every render, to refresh gauges that are read on demand."""
+    _collectors.append(func)
+    return func
+
+
+def render():
+    """Returns every metric in the Prometheus text exposition format."""
+    for collector in list(_collectors):
+        try:
+            collector()
+        except Exception as e:
+            log.error("METRICS ERROR: Collector %s failed: %s", collector.__name__, e)
+    with _registry_lock:
+        metrics = list(_registry)
+    return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _ExporterHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_exporter(port, host='0.0.0.0'):
+    """
+    Serves /metrics for this process on `port` from a daemon thread, for
+    processes without a web server of their own. Returns the server, or None
+    if metrics are off, no port is configured, or the port is taken (e.g. by
+    another worker on the same host), in which case the process runs on
+    without an exporter.
+    """
+    if not METRICS_ENABLED or not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _ExporterHandler)
+    except OSError as e:
+        log.warning("METRICS: Could not serve /metrics on port %s (%s); this process's exporter is disabled.", port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-exporter", daemon=True).start()
+    return server
@@ -1,107 +1,405 @@
 # src/ml_model.py
+import numpy as np
 import pandas as pd
 import sqlite3
 from sklearn.ensemble import HistGradientBoostingRegressor
 import joblib
+import logging
 import os
+import shutil
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from src import config
+from src.database_setup import BASE_PATH, DB_PATH
+from src.db import get_connection
+from src.logging_setup import configure_logging
 
-def prepare_training_data(carrier_to_model):
-    """Queries the DB and prepares data for training a specific carrier's model."""
-    conn = sqlite3.connect("data/shipping_quotes.db")
+MODELS_DIR = os.path.join(BASE_PATH, "models")
 
-    # This SQL query is the heart of the data preparation.
-    # It finds all completed shipments and gathers the initial bid from every carrier,
-    # the final offer from the carrier we are modeling, and identifies the lowest
-    # competing initial bid.
-    sql_query = f"""
+log = logging.getLogger(__name__)
+
+# The model's inputs, in order. Training and prediction both go through build_features.
+FEATURES = ['spots', 'weight', 'dest_zone', 'carrier_initial_bid', 'lowest_competing_bid']
+
+# Loaded models by path, with the file mtime they were loaded at.
+_model_cache = {}
+_model_cache_lock = threading.Lock()
+
+
+def build_features(df):
+    """
+    Turns raw shipment/bid columns (spots, weight, destination_zip,
+    carrier_initial_bid, lowest_competing_bid) into the model's feature matrix.
+    """
+    features = df[['spots', 'weight', 'carrier_initial_bid', 'lowest_competing_bid']].copy()
+    # The model can't use a raw ZIP code. Create a 'zone' feature.
+    # This is a simplified example. You could make this more detailed.
+    features['dest_zone'] = df['destination_zip'].astype(str).str.zfill(5).str[0].astype(int)
+    return features[FEATURES]
+
+
+def get_model_path(carrier_name, version=None):
+    """The carrier's active model file, or the file of one registered version."""
+    suffix = f"_v{version}" if version is not None else ""
+    return os.path.join(MODELS_DIR, f"{carrier_name.replace(' ', '_')}_model{suffix}.joblib")
+
+
+def load_model(carrier_name):
+    """
+    Returns the trained model for a carrier, or None if there isn't one.
+    Models stay in memory and are only reloaded when their file changes, so a
+    newly published version is picked up without restarting the process.
+    """
+    model_path = get_model_path(carrier_name)
+    try:
+        mtime = os.path.getmtime(model_path)
+    except FileNotFoundError:
+        return None
+
+    with _model_cache_lock:
+        cached = _model_cache.get(model_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        model = joblib.load(model_path)
+        _model_cache[model_path] = (mtime, model)
+        return model
+
+# --- Training settings (override any of these in src/config.py) ---
+# Carriers need at least this many completed shipments before a model is trained.
+MIN_TRAINING_ROWS = getattr(config, 'MIN_TRAINING_ROWS', 50)
+# A carrier's model is only retrained once this many new training rows have
+# arrived since its active version was trained.
+RETRAIN_MIN_NEW_ROWS = getattr(config, 'RETRAIN_MIN_NEW_ROWS', 200)
+# The newest share of a carrier's rows is held out to measure validation error.
+MODEL_VALIDATION_FRACTION = getattr(config, 'MODEL_VALIDATION_FRACTION', 0.2)
+
+# Materializes training rows for the shipments in feature_queue. Bids are
+# ranked per shipment in one window pass. A carrier's lowest competing bid is
+# the shipment's lowest bid, unless it *is* the lowest bidder, in which case
+# it's the second lowest. CROSS JOIN makes SQLite start from the (small) queue
+# rather than the quotes table.
+_MATERIALIZE_FEATURES_SQL = """
+    INSERT OR REPLACE INTO training_features (
+        shipment_id, carrier_name, spots, weight, destination_zip,
+        carrier_initial_bid, lowest_competing_bid, final_offer, materialized_at
+    )
     WITH InitialBids AS (
-        -- Get all successful initial bids
-        SELECT shipment_id, carrier_name, price
-        FROM quotes
-        WHERE quote_type = 'initial' AND status = 'received'
+        SELECT q.shipment_id, q.carrier_name, q.price,
+               ROW_NUMBER() OVER bids AS bid_rank,
+               MIN(q.price) OVER bids AS lowest_bid,
+               NTH_VALUE(q.price, 2) OVER (bids ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) AS second_lowest_bid
+        FROM feature_queue fq
+        CROSS JOIN quotes q ON q.shipment_id = fq.shipment_id
+        WHERE q.quote_type = 'initial' AND q.status = 'received'
+        WINDOW bids AS (PARTITION BY q.shipment_id ORDER BY q.price, q.quote_id)
     ),
     FinalOffers AS (
-        -- Get all successful final offers for the carrier we're modeling
-        SELECT shipment_id, price AS final_offer
-        FROM quotes
-        WHERE quote_type = 'final' AND status = 'received' AND carrier_name = '{carrier_to_model}'
+        SELECT q.shipment_id, q.carrier_name, MIN(q.price) AS final_offer
+        FROM feature_queue fq
+        CROSS JOIN quotes q ON q.shipment_id = fq.shipment_id
+        WHERE q.quote_type = 'final' AND q.status = 'received'
+        GROUP BY q.shipment_id, q.carrier_name
+    ),
+    Rows AS (
+        SELECT
+            s.shipment_id,
+            ib.carrier_name,
+            s.spots,
+            s.weight,
+            s.destination_zip,
+            ib.price AS carrier_initial_bid,
+            CASE WHEN ib.bid_rank = 1 THEN ib.second_lowest_bid ELSE ib.lowest_bid END AS lowest_competing_bid,
+            -- No final offer means they didn't beat the price, so their final
+            -- offer is the same as their initial bid.
+            COALESCE(fo.final_offer, ib.price) AS final_offer
+        FROM InitialBids ib
+        JOIN shipments s ON s.shipment_id = ib.shipment_id
+        LEFT JOIN FinalOffers fo ON fo.shipment_id = ib.shipment_id AND fo.carrier_name = ib.carrier_name
+        WHERE s.status = 'complete'
     )
-    -- Main query to assemble the training data
-    SELECT
-        s.shipment_id,
-        s.spots,
-        s.weight,
-        s.destination_zip,
-        ib.price AS carrier_initial_bid,
-        -- Find the lowest initial bid from a *competitor*
-        (SELECT MIN(price) FROM InitialBids WHERE shipment_id = s.shipment_id AND carrier_name != '{carrier_to_model}') AS lowest_competing_bid,
-        -- Get the final offer, if one exists
-        fo.final_offer
-    FROM shipments s
-    JOIN InitialBids ib ON s.shipment_id = ib.shipment_id AND ib.carrier_name = '{carrier_to_model}'
-    LEFT JOIN FinalOffers fo ON s.shipment_id = fo.shipment_id
-    WHERE s.status = 'complete';
-    """
-
-    df = pd.read_sql_query(sql_query, conn)
-    conn.close()
+    -- Rows where there was no competitor are dropped.
+    SELECT *, ? FROM Rows WHERE lowest_competing_bid IS NOT NULL
+"""
 
-    # --- Feature Engineering & Cleaning ---
-    # If there was no final offer, it means they didn't beat the price,
-    # so their final offer is the same as their initial bid.
-    df['final_offer'].fillna(df['carrier_initial_bid'], inplace=True)
 
-    # The model can't use a raw ZIP code. Create a 'zone' feature.
-    # This is a simplified example. You could make this more detailed.
-    df['dest_zone'] = df['destination_zip'].str[0].astype(int)
+def refresh_feature_store(conn):
+    """
+    Materializes training rows for shipments that have completed since the
+    last refresh, so the work done is proportional to the new shipments only.
+    Returns how many rows were added.
+    """
+    added = conn.execute(_MATERIALIZE_FEATURES_SQL, (datetime.now().isoformat(),)).rowcount
+    conn.execute("DELETE FROM feature_queue")
+    conn.commit()
+    if added:
+        log.info("Feature store: materialized %d new training row(s).", added)
+    return added
 
-    # Drop rows where there was no competitor
-    df.dropna(subset=['lowest_competing_bid'], inplace=True)
 
-    # Define your features (X) and the value you want to predict (y)
-    features = ['spots', 'weight', 'dest_zone', 'carrier_initial_bid', 'lowest_competing_bid']
-    target = 'final_offer'
+def load_training_frame(conn=None, carrier_names=None):
+    """
+    Returns the training data for every carrier (or just `carrier_names`) from
+    the feature store, refreshing it first.
 
-    X = df[features]
-    y = df[target]
+    One row per (completed shipment, carrier with a received initial bid): the
+    shipment details, the carrier's initial bid, the lowest bid from any
+    *other* carrier, and the carrier's final offer.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = get_connection(DB_PATH)
 
-    return X, y
+    refresh_feature_store(conn)
 
+    sql_query = """
+        SELECT shipment_id, spots, weight, destination_zip, carrier_name,
+               carrier_initial_bid, lowest_competing_bid, final_offer
+        FROM training_features
+    """
+    params = ()
+    if carrier_names:
+        sql_query += f" WHERE carrier_name IN ({','.join('?' * len(carrier_names))})"
+        params = tuple(carrier_names)
+    # Rows stay in completion order so the newest ones can be held out for validation.
+    df = pd.read_sql_query(sql_query + " ORDER BY carrier_name, shipment_id", conn, params=params)
 
-def train_and_save_model(carrier_name):
-    """Trains a model for a specific carrier and saves it to a file."""
-    print(f"Training model for {carrier_name}...")
-    X, y = prepare_training_data(carrier_name)
+    if own_conn:
+        conn.close()
+    return df
 
-    # Handle cases with not enough data
-    if len(X) < 50:
-        print(f"Not enough data to train a model for {carrier_name}. Need at least 50 data points.")
-        return
 
+def prepare_training_data(carrier_to_model, training_frame=None):
+    """
+    Returns the features (X) and final offers (y) for one carrier's model.
+    Pass a frame from load_training_frame to avoid querying the DB again.
+    """
+    if training_frame is None:
+        training_frame = load_training_frame(carrier_names=[carrier_to_model])
+
+    df = training_frame[training_frame['carrier_name'] == carrier_to_model]
+    return build_features(df), df['final_offer']
+
+
+def _fit_model(X, y):
     model = HistGradientBoostingRegressor()
     model.fit(X, y)
+    return model
+
+
+def _fit_and_validate(X, y):
+    """
+    Scores a model fitted on the older rows against the newest
+    MODEL_VALIDATION_FRACTION of them, then fits the final model on everything.
+    Returns (model, validation_rows, validation_mae).
+    """
+    holdout = int(len(X) * MODEL_VALIDATION_FRACTION)
+    validation_mae = None
+    if holdout:
+        candidate = _fit_model(X.iloc[:-holdout], y.iloc[:-holdout])
+        validation_mae = float(np.mean(np.abs(candidate.predict(X.iloc[-holdout:]) - y.iloc[-holdout:])))
+    return _fit_model(X, y), holdout, validation_mae
+
 
-    model_path = os.path.join("models", f"{carrier_name.replace(' ', '_')}_model.joblib")
-    joblib.dump(model, model_path)
-    print(f"Model for {carrier_name} trained and saved to {model_path}")
+def _register_model(conn, carrier_name, model, training_rows, validation_rows, validation_mae):
+    """
+    Saves a new model version, records it in the registry as the carrier's
+    active model, and publishes it to the carrier's model file. The file is
+    replaced atomically, so running processes pick it up on their next
+    load_model call.
 
-def predict_final_offer(carrier_name, shipment_details, lowest_bid):
-    """Loads a trained model and predicts a final offer."""
-    model_path = os.path.join("models", f"{carrier_name.replace(' ', '_')}_model.joblib")
+    The version number is allocated by inserting its (inactive) registry row
+    in a single write transaction before anything is written to disk, so two
+    processes registering at once get different versions and never overwrite
+    each other's files. The row becomes active as the file is published.
+    """
+    os.makedirs(MODELS_DIR, exist_ok=True)
+    version = conn.execute("""
+        INSERT INTO model_registry (carrier_name, version, model_file, training_rows, validation_rows, validation_mae, trained_at, is_active)
+        SELECT ?1, COALESCE(MAX(version), 0) + 1, '', ?2, ?3, ?4, ?5, 0 FROM model_registry WHERE carrier_name = ?1
+        RETURNING version
+    """, (carrier_name, training_rows, validation_rows, validation_mae, datetime.now().isoformat())).fetchone()[0]
+    version_path = get_model_path(carrier_name, version)
+    conn.execute("UPDATE model_registry SET model_file = ? WHERE carrier_name = ? AND version = ?",
+                 (os.path.basename(version_path), carrier_name, version))
+    conn.commit()
 
     try:
-        model = joblib.load(model_path)
-    except FileNotFoundError:
-        print(f"No model found for {carrier_name}. Cannot predict.")
+        joblib.dump(model, version_path)
+        model_path = get_model_path(carrier_name)
+        temp_path = f"{model_path}.v{version}.tmp"
+        shutil.copyfile(version_path, temp_path)
+        # The write lock taken by the first UPDATE is held while the file is
+        # replaced, so the published file and the active row change together.
+        conn.execute("UPDATE model_registry SET is_active = 0 WHERE carrier_name = ? AND is_active = 1", (carrier_name,))
+        conn.execute("UPDATE model_registry SET is_active = 1 WHERE carrier_name = ? AND version = ?", (carrier_name, version))
+        os.replace(temp_path, model_path)
+        conn.commit()
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute("DELETE FROM model_registry WHERE carrier_name = ? AND version = ?", (carrier_name, version))
+        conn.commit()
+        for path in (version_path, f"{get_model_path(carrier_name)}.v{version}.tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    mae = f"{validation_mae:.2f}" if validation_mae is not None else "n/a"
+    log.info("Model v%s for %s trained on %d rows (validation MAE %s) and saved to %s", version, carrier_name, training_rows, mae, model_path)
+    return version
+
+
+def get_model_registry(conn=None, carrier_name=None):
+    """Returns registry entries (newest first) as dicts, for all carriers or one."""
+    own_conn = conn is None
+    if own_conn:
+        conn = get_connection(DB_PATH)
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+
+    sql_query = "SELECT * FROM model_registry"
+    params = ()
+    if carrier_name:
+        sql_query += " WHERE carrier_name = ?"
+        params = (carrier_name,)
+    entries = [dict(row) for row in cursor.execute(sql_query + " ORDER BY carrier_name, version DESC", params)]
+
+    if own_conn:
+        conn.close()
+    return entries
+
+
+def carriers_due_for_training(conn, min_new_rows=RETRAIN_MIN_NEW_ROWS):
+    """
+    Returns {carrier_name: training row count} for carriers with enough data
+    for a model and at least `min_new_rows` rows their active model hasn't seen.
+    Only looks at the feature store, so call refresh_feature_store first.
+    """
+    rows = conn.execute("""
+        SELECT f.carrier_name, f.row_count, COALESCE(r.training_rows, 0)
+        FROM (SELECT carrier_name, COUNT(*) AS row_count FROM training_features GROUP BY carrier_name) f
+        LEFT JOIN model_registry r ON r.carrier_name = f.carrier_name AND r.is_active = 1
+    """).fetchall()
+    return {
+        carrier_name: row_count
+        for carrier_name, row_count, trained_rows in rows
+        if row_count >= MIN_TRAINING_ROWS and row_count - trained_rows >= min_new_rows
+    }
+
+
+def train_and_save_model(carrier_name, training_frame=None):
+    """Trains a new model version for a specific carrier and registers it."""
+    log.info("Training model for %s...", carrier_name)
+    X, y = prepare_training_data(carrier_name, training_frame)
+
+    # Handle cases with not enough data
+    if len(X) < MIN_TRAINING_ROWS:
+        log.info("Not enough data to train a model for %s. Need at least %d data points.", carrier_name, MIN_TRAINING_ROWS)
+        return
+
+    model, validation_rows, validation_mae = _fit_and_validate(X, y)
+    conn = get_connection(DB_PATH)
+    _register_model(conn, carrier_name, model, len(X), validation_rows, validation_mae)
+    conn.close()
+
+
+def train_all_models(carrier_names=None, processes=None, min_new_rows=0):
+    """
+    Trains a new model version for every carrier with enough data.
+
+    The feature store is refreshed first, and only the carriers with at least
+    `min_new_rows` rows their active model hasn't seen are loaded and trained.
+    With processes > 1 the models are fitted in parallel in a process pool.
+    Returns the names of the carriers that got a new model.
+    """
+    conn = get_connection(DB_PATH)
+    refresh_feature_store(conn)
+
+    due = carriers_due_for_training(conn, min_new_rows)
+    if carrier_names:
+        if not min_new_rows:
+            for carrier_name in sorted(set(carrier_names) - set(due)):
+                log.info("Not enough data to train a model for %s. Need at least %d data points.", carrier_name, MIN_TRAINING_ROWS)
+        due = {name: row_count for name, row_count in due.items() if name in carrier_names}
+    carrier_names = sorted(due)
+    if not carrier_names:
+        log.debug("No models need retraining.")
+        conn.close()
+        return []
+
+    training_frame = load_training_frame(conn, carrier_names)
+    jobs = {
+        carrier_name: (build_features(df), df['final_offer'])
+        for carrier_name, df in training_frame.groupby('carrier_name')
+    }
+
+    log.info("Training %d model(s) from %d rows...", len(jobs), len(training_frame))
+    if processes and processes > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {name: executor.submit(_fit_and_validate, X, y) for name, (X, y) in jobs.items()}
+            results = {name: future.result() for name, future in futures.items()}
+    else:
+        results = {name: _fit_and_validate(X, y) for name, (X, y) in jobs.items()}
+
+    for carrier_name, (model, validation_rows, validation_mae) in results.items():
+        _register_model(conn, carrier_name, model, len(jobs[carrier_name][0]), validation_rows, validation_mae)
+    conn.close()
+    return list(results)
+
+
+def retrain_if_needed(processes=None):
+    """Retrains only the carriers that have gained RETRAIN_MIN_NEW_ROWS rows since their last model."""
+    return train_all_models(processes=processes, min_new_rows=RETRAIN_MIN_NEW_ROWS)
+
+
+def predict_final_offer(carrier_name, shipment_details, carrier_initial_bid, lowest_competing_bid):
+    """Predicts a carrier's final offer for one shipment using its trained model."""
+    model = load_model(carrier_name)
+    if model is None:
+        log.warning("No model found for %s. Cannot predict.", carrier_name)
         return None
 
     # Create a pandas DataFrame from the input, matching the training format
     input_data = pd.DataFrame([{
         'spots': shipment_details['spots'],
         'weight': shipment_details['weight'],
-        'destination_zip_encoded': shipment_details['dest_zip_encoded'], # You'll need to create this feature
-        'lowest_initial_bid': lowest_bid
+        'destination_zip': shipment_details['destination_zip'],
+        'carrier_initial_bid': carrier_initial_bid,
+        'lowest_competing_bid': lowest_competing_bid,
     }])
 
-    prediction = model.predict(input_data)
+    prediction = model.predict(build_features(input_data))
     return prediction[0]
+
+
+def predict_final_offers_batch(requests_df):
+    """
+    Predicts final offers for many (shipment, carrier) pairs at once.
+
+    `requests_df` needs a carrier_name column plus the raw feature columns
+    (spots, weight, destination_zip, carrier_initial_bid, lowest_competing_bid).
+    Each carrier's rows are scored with a single vectorized model.predict call.
+    Returns a Series aligned with requests_df; carriers without a model get NaN.
+    """
+    predictions = pd.Series(np.nan, index=requests_df.index, dtype=float)
+    features = build_features(requests_df)
+
+    for carrier_name, rows in requests_df.groupby('carrier_name').groups.items():
+        model = load_model(carrier_name)
+        if model is None:
+            log.warning("No model found for %s. Cannot predict.", carrier_name)
+            continue
+        predictions.loc[rows] = model.predict(features.loc[rows])
+
+    return predictions
+
+
+if __name__ == '__main__':
+    configure_logging()
+    # Retrains only what has enough new data; pass --force to retrain every carrier.
+    if '--force' in sys.argv:
+        train_all_models(processes=os.cpu_count())
+    else:
+        retrain_if_needed(processes=os.cpu_count())
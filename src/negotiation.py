@@ -1,7 +1,28 @@
+import logging
 from src.email_utils import send_email, generate_negotiation_content
+from src.outbox import enqueue_emails
+from src.routing import record_threads
+
+log = logging.getLogger(__name__)
 
 def send_negotiation_request(carrier_email, shipment_id, lowest_bid):
     """Builds and sends the negotiation email."""
-    print(f"Sending negotiation email to {carrier_email} for shipment {shipment_id}...")
+    log.debug("Sending negotiation email to %s for shipment %s...", carrier_email, shipment_id)
     content = generate_negotiation_content(shipment_id, lowest_bid)
     send_email(carrier_email, content['subject'], content['body'])
+
+def queue_negotiation_requests(cursor, requests):
+    """
+    Queues negotiation emails for many (carrier_name, carrier_email, shipment_id,
+    lowest_bid) tuples in the outbox, and records which carrier and shipment
+    replies to each will be about. They are sent once the caller commits.
+    """
+    messages = []
+    for _, carrier_email, shipment_id, lowest_bid in requests:
+        content = generate_negotiation_content(shipment_id, lowest_bid)
+        messages.append((carrier_email, content['subject'], content['body'], shipment_id))
+    message_ids = enqueue_emails(cursor, messages)
+    record_threads(cursor, [
+        (message_id, shipment_id, carrier_name, 'final')
+        for message_id, (carrier_name, _, shipment_id, _) in zip(message_ids, requests)
+    ])
@@ -0,0 +1,149 @@
+# src/outbox.py
+"""
+Transactional outbox for outbound email. The worker only inserts rows into the
+`outbox` table, in the same transaction as the state change that calls for the
+email; sender.py drains the table separately with batching, retries with
+exponential backoff, and per-domain rate limiting.
+"""
+import logging
+import time
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from src import config
+from src.email_utils import send_emails
+from src.metrics import Counter
+from src.routing import new_message_id
+
+# --- Outbox settings (override any of these in src/config.py) ---
+# How many emails the sender claims and sends per round.
+OUTBOX_BATCH_SIZE = getattr(config, 'OUTBOX_BATCH_SIZE', 50)
+# A message is given up on (status 'failed') after this many attempts.
+OUTBOX_MAX_ATTEMPTS = getattr(config, 'OUTBOX_MAX_ATTEMPTS', 6)
+# Retry delays double from the base up to the cap.
+OUTBOX_RETRY_BASE_SECONDS = getattr(config, 'OUTBOX_RETRY_BASE_SECONDS', 30)
+OUTBOX_RETRY_MAX_SECONDS = getattr(config, 'OUTBOX_RETRY_MAX_SECONDS', 3600)
+# At most this many emails per minute go to any one recipient domain.
+OUTBOX_DOMAIN_RATE_PER_MINUTE = getattr(config, 'OUTBOX_DOMAIN_RATE_PER_MINUTE', 60)
+# Rows left in 'sending' this long (e.g. by a crashed sender) are retried.
+OUTBOX_STALE_SENDING_MINUTES = getattr(config, 'OUTBOX_STALE_SENDING_MINUTES', 10)
+
+log = logging.getLogger(__name__)
+
+OUTBOX_RESULTS = Counter('outbox_messages_total', "Outbox send attempts by outcome (sent, retry, failed).", ['result'])
+OUTBOX_RELEASED = Counter('outbox_released_total', "Messages a crashed sender left in 'sending' that were re-queued.")
+
+# Send times per recipient domain over the last minute, for rate limiting.
+_domain_send_times = defaultdict(deque)
+
+
+def enqueue_emails(cursor, messages):
+    """
+    Queues (recipient_email, subject, body, shipment_id) messages for sending.
+    Does not commit: the rows become visible together with the caller's transaction.
+
+    Each message is given its Message-ID now, so retries reuse it; the IDs
+    are returned in order.
+    """
+    now = datetime.now().isoformat()
+    message_ids = [new_message_id() for _ in messages]
+    cursor.executemany(
+        "INSERT INTO outbox (recipient, subject, body, shipment_id, message_id, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(recipient, subject, body, shipment_id, message_id, now, now)
+         for (recipient, subject, body, shipment_id), message_id in zip(messages, message_ids)]
+    )
+    return message_ids
+
+
+def _domain(recipient):
+    return recipient.rsplit('@', 1)[-1].lower()
+
+
+def _take_rate_limit_slot(domain, now):
+    """Returns True (and records a send) if the domain is under its per-minute limit."""
+    sent = _domain_send_times[domain]
+    while sent and sent[0] <= now - 60:
+        sent.popleft()
+    if len(sent) >= OUTBOX_DOMAIN_RATE_PER_MINUTE:
+        return False
+    sent.append(now)
+    return True
+
+
+def retry_delay(attempts):
+    """Seconds to wait before the next attempt after `attempts` failed ones."""
+    return min(OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), OUTBOX_RETRY_MAX_SECONDS)
+
+
+def release_stale_messages(conn):
+    """Puts messages stuck in 'sending' by a crashed sender back in the queue."""
+    cutoff = (datetime.now() - timedelta(minutes=OUTBOX_STALE_SENDING_MINUTES)).isoformat()
+    released = conn.execute(
+        "UPDATE outbox SET status = 'pending' WHERE status = 'sending' AND claimed_at < ?", (cutoff,)
+    ).rowcount
+    conn.commit()
+    if released:
+        OUTBOX_RELEASED.inc(released)
+        log.warning("OUTBOX: Re-queued %d message(s) left unsent by a previous sender.", released)
+
+
+def drain_outbox(conn, batch_size=None):
+    """
+    Sends one batch of due messages. Returns how many were attempted.
+
+    Messages are claimed (status 'sending') before sending so nothing else
+    picks them up, then marked 'sent', or rescheduled with exponential backoff.
+    """
+    batch_size = batch_size or OUTBOX_BATCH_SIZE
+    now = datetime.now().isoformat()
+
+    # Fetch a few extra candidates so rate-limited domains don't starve the batch.
+    due = conn.execute("""
+        SELECT outbox_id, recipient FROM outbox
+        WHERE status = 'pending' AND next_attempt_at <= ?
+        ORDER BY next_attempt_at
+        LIMIT ?
+    """, (now, batch_size * 4)).fetchall()
+
+    clock = time.monotonic()
+    selected = []
+    for outbox_id, recipient in due:
+        if len(selected) == batch_size:
+            break
+        if _take_rate_limit_slot(_domain(recipient), clock):
+            selected.append(outbox_id)
+    if not selected:
+        return 0
+
+    placeholders = ','.join('?' * len(selected))
+    claimed = conn.execute(
+        f"UPDATE outbox SET status = 'sending', claimed_at = ? WHERE status = 'pending' AND outbox_id IN ({placeholders}) "
+        "RETURNING outbox_id, recipient, subject, body, message_id, attempts",
+        (now, *selected)
+    ).fetchall()
+    conn.commit()
+
+    results = send_emails([(recipient, subject, body, message_id) for _, recipient, subject, body, message_id, _ in claimed])
+
+    sent, retries, failed = [], [], []
+    finished_at = datetime.now()
+    for (outbox_id, recipient, _, _, _, attempts), ok in zip(claimed, results):
+        attempts += 1
+        if ok:
+            sent.append((attempts, finished_at.isoformat(), outbox_id))
+        elif attempts >= OUTBOX_MAX_ATTEMPTS:
+            log.error("OUTBOX ERROR: ❌ Giving up on email #%s to %s after %d attempts.", outbox_id, recipient, attempts)
+            failed.append((attempts, outbox_id))
+        else:
+            next_attempt = finished_at + timedelta(seconds=retry_delay(attempts))
+            retries.append((attempts, next_attempt.isoformat(), outbox_id))
+
+    conn.executemany("UPDATE outbox SET status = 'sent', attempts = ?, sent_at = ? WHERE outbox_id = ?", sent)
+    conn.executemany("UPDATE outbox SET status = 'pending', attempts = ?, next_attempt_at = ? WHERE outbox_id = ?", retries)
+    conn.executemany("UPDATE outbox SET status = 'failed', attempts = ? WHERE outbox_id = ?", failed)
+    conn.commit()
+
+    OUTBOX_RESULTS.inc(len(sent), result='sent')
+    OUTBOX_RESULTS.inc(len(retries), result='retry')
+    OUTBOX_RESULTS.inc(len(failed), result='failed')
+    log.info("OUTBOX: Sent %d, retrying %d, failed %d.", len(sent), len(retries), len(failed))
+    return len(claimed)
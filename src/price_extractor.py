@@ -0,0 +1,133 @@
+# src/price_extractor.py
+"""
+Tiered quote extraction. Most carrier replies state their price plainly, so a
+compiled regex extractor handles those locally; only replies it isn't confident
+about are sent on to the Gemini parser.
+"""
+import re
+import time
+from typing import List, Tuple, Union
+from src import config
+from src.metrics import Counter, Histogram
+from src.ai_parser import normalize_email_body, parse_quote_with_ai, parse_quotes_with_ai_batch
+
+# Replies scoring below this are passed on to the AI parser.
+PRICE_EXTRACTOR_MIN_CONFIDENCE = getattr(config, 'PRICE_EXTRACTOR_MIN_CONFIDENCE', 0.8)
+
+_AMOUNT = r'(\d{1,3}(?:,\d{3})+|\d+)(\.\d{1,2})?'
+
+# Each pattern captures an amount and carries a base confidence for how clearly
+# it marks a price.
+_PRICE_PATTERNS = [
+    (re.compile(r'\$\s?' + _AMOUNT + r'(?![\d,])'), 0.9),
+    (re.compile(_AMOUNT + r'\s?(?:USD|US dollars|dollars)\b', re.IGNORECASE), 0.9),
+    (re.compile(r'\bUSD\s?' + _AMOUNT, re.IGNORECASE), 0.9),
+    (re.compile(r'\b(?:total|price|quote|rate|offer)\b[^\d\n]{0,15}?' + _AMOUNT + r'(?![\d,.]*\s?(?:lbs?|pounds|pallets?|spots?|%))', re.IGNORECASE), 0.6),
+]
+
+# Words that point at the amount being the number we want.
+_PRICE_CONTEXT = re.compile(r'\b(total|all[- ]in|our (?:best |final )?(?:quote|price|rate|offer)|best and final|we can do|quote (?:is|of))\b', re.IGNORECASE)
+
+# Replies that decline, or talk about a price without committing to one, need a human-like read.
+_AMBIGUOUS = re.compile(
+    r"\b(unable|cannot|can't|not able|decline|pass on|per (?:mile|lb|pound|pallet)|plus|surcharge|between)\b"
+    r"|\$[\d,.]+\s*(?:-|to|or)\s*\$?\d",
+    re.IGNORECASE
+)
+
+PRICE_TIER_REPLIES = Counter('price_extraction_replies_total', "Carrier replies parsed, by the tier that answered (regex or ai).", ['tier'])
+PRICE_TIER_SECONDS = Histogram('price_extraction_seconds', "Time until a reply's price was known, by the tier that answered.", ['tier'])
+
+
+def _find_candidates(text):
+    """Returns {amount: best base confidence} for every price-like number in the text."""
+    candidates = {}
+    for pattern, base_confidence in _PRICE_PATTERNS:
+        for match in pattern.finditer(text):
+            amount = float(match.group(1).replace(',', '') + (match.group(2) or ''))
+            if amount <= 0:
+                continue
+
+            # Look a little way back for wording like "total" or "our best rate".
+            context = text[max(0, match.start() - 40):match.end()]
+            confidence = base_confidence + (0.05 if _PRICE_CONTEXT.search(context) else 0)
+            candidates[amount] = max(candidates.get(amount, 0), confidence)
+    return candidates
+
+
+def extract_price(email_body: str) -> Tuple[Union[float, None], float]:
+    """
+    Extracts a price from an email without calling any service.
+
+    Returns (price, confidence). Confidence is high only when the reply names a
+    single amount in an unmistakable form; anything with several competing
+    amounts, hedging language or no amount at all scores low.
+    """
+    # Without the quoted thread, whose amounts (e.g. a competing quote we
+    # passed on) would otherwise compete with the carrier's own.
+    text = normalize_email_body(email_body)
+    candidates = _find_candidates(text)
+
+    if not candidates:
+        return None, 0.0
+
+    ranked = sorted(candidates.items(), key=lambda item: item[1], reverse=True)
+    price, confidence = ranked[0]
+
+    if len(ranked) > 1:
+        # Several amounts are only acceptable when one of them is clearly marked as the total.
+        runner_up_confidence = ranked[1][1]
+        confidence = confidence - 0.1 if confidence > runner_up_confidence else 0.3
+
+    if _AMBIGUOUS.search(text):
+        confidence = min(confidence, 0.5)
+
+    return round(price, 2), round(min(confidence, 1.0), 2)
+
+
+def _record(tier, seconds, count=1):
+    PRICE_TIER_REPLIES.inc(count, tier=tier)
+    for _ in range(count):
+        PRICE_TIER_SECONDS.observe(seconds, tier=tier)
+
+
+def parse_quote(email_body: str) -> Union[float, None]:
+    """
+    Parses the quoted price from a carrier reply, trying the local extractor
+    first and only falling back to the AI parser for low-confidence replies.
+    """
+    started = time.perf_counter()
+    price, confidence = extract_price(email_body)
+    if confidence >= PRICE_EXTRACTOR_MIN_CONFIDENCE:
+        _record('regex', time.perf_counter() - started)
+        return price
+
+    price = parse_quote_with_ai(email_body)
+    _record('ai', time.perf_counter() - started)
+    return price
+
+
+def parse_quotes(email_bodies: List[str]) -> List[Union[float, None]]:
+    """
+    Batch version of parse_quote: every reply goes through the local extractor,
+    and all the low-confidence ones share batched AI requests.
+    """
+    results, needs_ai = [], []
+    for index, email_body in enumerate(email_bodies):
+        started = time.perf_counter()
+        price, confidence = extract_price(email_body)
+        if confidence >= PRICE_EXTRACTOR_MIN_CONFIDENCE:
+            _record('regex', time.perf_counter() - started)
+        else:
+            needs_ai.append(index)
+        results.append(price)
+
+    if needs_ai:
+        ai_started = time.perf_counter()
+        for index, price in zip(needs_ai, parse_quotes_with_ai_batch([email_bodies[i] for i in needs_ai])):
+            results[index] = price
+        # Every email in the batch waited for the whole request.
+        _record('ai', time.perf_counter() - ai_started, count=len(needs_ai))
+
+    return results
+
@@ -1,26 +1,172 @@
 # src/quoting.py
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src import config
 from src.email_utils import send_email, generate_quote_request_content
+from src.metrics import Histogram
+from src.outbox import enqueue_emails
+from src.routing import record_threads
+
+# --- API quoting settings (override any of these in src/config.py) ---
+# How many API quote requests are in flight at once, across all carriers.
+API_QUOTE_WORKERS = getattr(config, 'API_QUOTE_WORKERS', 16)
+# Used for carriers that don't set their own 'timeout' in CARRIERS.
+API_QUOTE_TIMEOUT_SECONDS = getattr(config, 'API_QUOTE_TIMEOUT_SECONDS', 10)
+# How many recent request latencies are kept per carrier for the p50/p99 figures.
+API_LATENCY_WINDOW = getattr(config, 'API_LATENCY_WINDOW', 1000)
+
+log = logging.getLogger(__name__)
+
+API_QUOTE_SECONDS = Histogram('api_quote_seconds', "Time for one carrier API quote request, by carrier and result.", ['carrier', 'result'])
+
+# --- Carrier API adapters ---
+# An adapter turns shipment details into a price using one carrier's API. It is
+# called with a keep-alive requests.Session, the carrier's CARRIERS entry, the
+# shipment details and a timeout, and returns the price (or None for no quote).
+# Carriers pick one with an 'adapter' key in their CARRIERS entry.
+API_ADAPTERS = {}
+
+
+def register_adapter(name):
+    """Decorator that makes an adapter available under `name`."""
+    def decorator(func):
+        API_ADAPTERS[name] = func
+        return func
+    return decorator
+
+
+@register_adapter('json')
+def json_quote_adapter(session, carrier_info, shipment_details, timeout):
+    """POSTs the shipment as JSON to the carrier's 'url' and reads {"price": ...} back."""
+    headers = {}
+    if carrier_info.get('api_key'):
+        headers['Authorization'] = f"Bearer {carrier_info['api_key']}"
+    payload = {
+        'spots': shipment_details['spots'],
+        'weight': shipment_details['weight'],
+        'destination_zip': shipment_details['destination_zip'],
+    }
+    response = session.post(carrier_info['url'], json=payload, headers=headers, timeout=timeout)
+    response.raise_for_status() # Raise an error for bad responses
+    price = response.json().get('price')
+    return float(price) if price is not None else None
+
+
+# One pooled session per carrier, so connections to its API are kept alive
+# and reused across shipments.
+_sessions = {}
+_sessions_lock = threading.Lock()
+_latencies = defaultdict(lambda: deque(maxlen=API_LATENCY_WINDOW))
+_latencies_lock = threading.Lock()
+
 
-# --- Placeholder for API Logic ---
-def get_api_quote(carrier_name, shipment_details):
-    """Gets a quote from a carrier's API."""
-    print(f"Requesting API quote from {carrier_name}...")
-    # This is where you'd put the specific code for each carrier's API
-    # Example:
-    # try:
-    #     api_url = "https://api.carrier.com/v1/quote"
-    #     response = requests.post(api_url, json=shipment_details, auth=("user", "pass"))
-    #     response.raise_for_status() # Raise an error for bad responses
-    #     price = response.json().get('price')
-    #     return price
-    # except requests.exceptions.RequestException as e:
-    #     print(f"Error getting quote from {carrier_name}: {e}")
-    #     return None
-    return 1234.56 # Dummy data for now
+def _get_session(carrier_name):
+    with _sessions_lock:
+        if carrier_name not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_QUOTE_WORKERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[carrier_name] = session
+        return _sessions[carrier_name]
+
+
+def get_api_quote(carrier_name, shipment_details, carrier_info=None):
+    """Gets a quote from a carrier's API. Returns None if the carrier didn't quote."""
+    carrier_info = carrier_info or config.CARRIERS[carrier_name]
+    adapter = API_ADAPTERS[carrier_info.get('adapter', 'json')]
+    timeout = carrier_info.get('timeout', API_QUOTE_TIMEOUT_SECONDS)
+
+    start = time.perf_counter()
+    result = 'error'
+    try:
+        price = adapter(_get_session(carrier_name), carrier_info, shipment_details, timeout)
+        result = 'quoted' if price is not None else 'declined'
+        return price
+    except Exception as e:
+        log.error("QUOTING ERROR: Error getting quote from %s for shipment #%s: %s", carrier_name, shipment_details['shipment_id'], e)
+        return None
+    finally:
+        elapsed = time.perf_counter() - start
+        API_QUOTE_SECONDS.observe(elapsed, carrier=carrier_name, result=result)
+        with _latencies_lock:
+            _latencies[carrier_name].append(elapsed)
+
+
+def get_api_quotes(shipments, carriers):
+    """
+    Requests quotes for every (shipment, API carrier) pair concurrently.
+
+    `shipments` is a list of shipment detail dicts and `carriers` maps carrier
+    names to their CARRIERS entries. Returns (shipment_id, carrier_name, price)
+    tuples, with price None where the carrier failed or declined.
+    """
+    jobs = [(name, shipment, info) for shipment in shipments for name, info in carriers.items()]
+    if not jobs:
+        return []
+
+    log.info("Requesting %d API quote(s) from %d carrier(s)...", len(jobs), len(carriers))
+    with ThreadPoolExecutor(max_workers=API_QUOTE_WORKERS) as executor:
+        prices = list(executor.map(lambda job: get_api_quote(*job), jobs))
+    return [(shipment['shipment_id'], name, price) for (name, shipment, _), price in zip(jobs, prices)]
+
+
+def request_api_quotes(conn, shipments, carriers):
+    """Fetches API quotes for a batch of shipments and records them all in one transaction."""
+    results = get_api_quotes(shipments, carriers)
+    if not results:
+        return
+
+    now = datetime.now().isoformat()
+    conn.executemany(
+        "UPDATE quotes SET price = ?, received_at = ?, status = ? WHERE shipment_id = ? AND carrier_name = ? AND quote_type = 'initial' AND status = 'pending'",
+        [(price, now, 'received' if price is not None else 'failed', shipment_id, name) for shipment_id, name, price in results]
+    )
+    conn.commit()
+    received = sum(price is not None for *_, price in results)
+    log.info("Recorded %d API quote(s), %d failed.", received, len(results) - received)
+
+
+def get_api_latency_stats():
+    """Returns {carrier_name: {'count', 'p50_ms', 'p99_ms'}} over recent API requests."""
+    with _latencies_lock:
+        snapshot = {name: sorted(values) for name, values in _latencies.items() if values}
+    return {
+        name: {
+            'count': len(values),
+            'p50_ms': 1000 * values[int(0.50 * (len(values) - 1))],
+            'p99_ms': 1000 * values[int(0.99 * (len(values) - 1))],
+        }
+        for name, values in snapshot.items()
+    }
 
 # --- Logic for Sending Email Requests ---
 def send_email_quote_request(carrier_email, shipment_details):
     """Builds and sends the initial quote request email."""
-    print(f"Sending email quote request to {carrier_email}...")
+    log.debug("Sending email quote request to %s...", carrier_email)
     content = generate_quote_request_content(shipment_details)
     send_email(carrier_email, content['subject'], content['body'])
+
+def queue_email_quote_requests(cursor, email_requests):
+    """
+    Queues initial quote request emails for many (carrier_name, carrier_email,
+    shipment_details) tuples in the outbox, and records which carrier and
+    shipment replies to each will be about. They are sent once the caller commits.
+    """
+    messages = []
+    for _, carrier_email, shipment_details in email_requests:
+        content = generate_quote_request_content(shipment_details)
+        messages.append((carrier_email, content['subject'], content['body'], shipment_details['shipment_id']))
+    message_ids = enqueue_emails(cursor, messages)
+    record_threads(cursor, [
+        (message_id, shipment_details['shipment_id'], carrier_name, 'initial')
+        for message_id, (carrier_name, _, shipment_details) in zip(message_ids, email_requests)
+    ])
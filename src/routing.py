@@ -0,0 +1,167 @@
+# src/routing.py
+"""
+Works out which carrier and shipment an inbound email is about.
+
+Every outgoing quote or negotiation email gets its own Message-ID, recorded
+in `email_threads` with the shipment, carrier and round it belongs to in the
+same transaction that queues it. A reply names that ID in its In-Reply-To or
+References header, so it is routed with one primary-key lookup, whoever at the
+carrier sent it and whatever the subject says. Replies without those headers
+fall back to the sender (via an index of carrier addresses and domains built
+from CARRIERS) and the shipment number in the subject.
+
+Besides 'contact', a carrier in CARRIERS may list other addresses it replies
+from under 'aliases', and whole domains under 'domains'. The domain of each
+contact and alias is routed to the carrier automatically, unless another
+carrier uses it too or it is a public mail domain.
+"""
+import logging
+import re
+import threading
+from datetime import datetime
+from email.utils import getaddresses, make_msgid
+from src import config
+from src.config import SENDER_EMAIL
+
+# Mail domains shared by unrelated senders, never routed to a carrier by domain alone.
+PUBLIC_EMAIL_DOMAINS = getattr(config, 'PUBLIC_EMAIL_DOMAINS', {
+    'gmail.com', 'googlemail.com', 'outlook.com', 'hotmail.com', 'live.com',
+    'yahoo.com', 'icloud.com', 'me.com', 'aol.com', 'proton.me', 'protonmail.com',
+})
+
+log = logging.getLogger(__name__)
+
+# Bounces quote our email back to us, so they carry its Message-ID too.
+_AUTOMATED_SENDERS = ('mailer-daemon', 'postmaster')
+
+_SHIPMENT_ID = re.compile(r'#(\d+)')
+_MESSAGE_ID = re.compile(r'<[^<>\s]+>')
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def normalize_address(address):
+    """Lower-cases an address and drops any display name, angle brackets and +tag."""
+    address = getaddresses([address or ''])[0][1].strip().lower()
+    local, at, domain = address.rpartition('@')
+    if not at:
+        return address
+    return f"{local.split('+', 1)[0]}@{domain}"
+
+
+def _signature(carriers_config):
+    return tuple(
+        (name, info.get('contact'), tuple(info.get('aliases', ())), tuple(info.get('domains', ())))
+        for name, info in carriers_config.items()
+    )
+
+
+class CarrierRoutingIndex:
+    """Sender address and domain lookups for a CARRIERS dict, built once."""
+
+    def __init__(self, carriers_config):
+        self.signature = _signature(carriers_config)
+        self.by_address = {}
+        self.by_domain = {}
+
+        implied_domains = {}
+        for name, info in carriers_config.items():
+            addresses = [info['contact']] if info.get('contact') else []
+            addresses += info.get('aliases', [])
+            for address in map(normalize_address, addresses):
+                self.by_address[address] = name
+                implied_domains.setdefault(address.rpartition('@')[2], set()).add(name)
+            for domain in info.get('domains', []):
+                self.by_domain[domain.lower()] = name
+
+        for domain, names in implied_domains.items():
+            if len(names) == 1 and domain not in PUBLIC_EMAIL_DOMAINS:
+                self.by_domain.setdefault(domain, next(iter(names)))
+
+    def carrier_for(self, sender):
+        """Returns the carrier an address belongs to, or None."""
+        address = normalize_address(sender)
+        return self.by_address.get(address) or self.by_domain.get(address.rpartition('@')[2])
+
+
+def get_routing_index(carriers_config):
+    """
+    Returns the routing index for carriers_config. It is only rebuilt when the
+    carriers, their addresses or their domains have changed since the last call.
+    """
+    global _index
+    signature = _signature(carriers_config)
+    with _index_lock:
+        if _index is None or _index.signature != signature:
+            _index = CarrierRoutingIndex(carriers_config)
+        return _index
+
+
+def new_message_id():
+    return make_msgid(domain=SENDER_EMAIL.rpartition('@')[2] or None)
+
+
+def record_threads(cursor, threads):
+    """
+    Remembers what replies to each outgoing email are about, from
+    (message_id, shipment_id, carrier_name, quote_type) tuples. Does not commit.
+    """
+    now = datetime.now().isoformat()
+    cursor.executemany(
+        "INSERT INTO email_threads (message_id, shipment_id, carrier_name, quote_type, created_at) VALUES (?, ?, ?, ?, ?)",
+        [(*thread, now) for thread in threads]
+    )
+
+
+def find_thread(conn, msg):
+    """
+    Returns (carrier_name, shipment_id, quote_type) for a reply to one of our
+    emails, or None. A reply's References list the whole thread oldest first,
+    so In-Reply-To is tried first and then References from newest to oldest,
+    and a reply to a final offer request never matches the initial request.
+    """
+    references = []
+    for value in msg.headers.get('in-reply-to', ()):
+        references += _MESSAGE_ID.findall(value)
+    for value in reversed(msg.headers.get('references', ())):
+        references += reversed(_MESSAGE_ID.findall(value))
+    references = list(dict.fromkeys(references)) # Newest first, without repeats
+    if not references:
+        return None
+    placeholders = ','.join('?' * len(references))
+    threads = {
+        message_id: thread for message_id, *thread in conn.execute(
+            f"SELECT message_id, carrier_name, shipment_id, quote_type FROM email_threads WHERE message_id IN ({placeholders})",
+            references
+        )
+    }
+    return next((tuple(threads[message_id]) for message_id in references if message_id in threads), None)
+
+
+def route_reply(conn, msg, routing_index):
+    """
+    Works out which carrier and shipment an email is a reply about. Returns
+    (carrier_name, shipment_id, quote_type), or None if it isn't a carrier reply.
+    """
+    carrier_name = routing_index.carrier_for(msg.from_)
+    sender_name = normalize_address(msg.from_).rpartition('@')[0]
+    thread = find_thread(conn, msg) if sender_name not in _AUTOMATED_SENDERS else None
+    # Anyone at the carrier may answer, but not a different carrier.
+    if thread and carrier_name in (None, thread[0]):
+        log.debug("   - Matched by thread to Shipment ID: %s, Carrier: %s", thread[1], thread[0])
+        return tuple(thread)
+
+    if not carrier_name:
+        log.debug("   - Could not find a matching carrier for email: %s. Skipping.", msg.from_)
+        return None
+
+    shipment_id_match = _SHIPMENT_ID.search(msg.subject)
+    if not shipment_id_match:
+        log.debug("   - Could not find shipment ID in subject. Skipping.")
+        return None
+
+    shipment_id = int(shipment_id_match.group(1))
+    quote_type = 'final' if 'Final Offer Request' in msg.subject else 'initial'
+    log.debug("   - Matched to Shipment ID: %s, Carrier: %s", shipment_id, carrier_name)
+    return carrier_name, shipment_id, quote_type
@@ -0,0 +1,104 @@
+# src/stats.py
+"""
+Dashboard statistics. The totals, per-carrier and per-month rollup tables are
+kept up to date by triggers on `shipments` (see the migrations in
+database_setup), so reading them costs the same however many shipments there
+are. rebuild_stats recomputes them from scratch, for backfills and bulk loads.
+
+    python -m src.stats    # rebuild the rollups
+"""
+from src import config
+from src.database_setup import DB_PATH
+from src.db import connect
+
+# How many recent months of savings /api/stats returns (override in src/config.py).
+STATS_SAVINGS_MONTHS = getattr(config, 'STATS_SAVINGS_MONTHS', 12)
+
+_REBUILD_STATEMENTS = [
+    "DELETE FROM shipment_stats",
+    "DELETE FROM carrier_stats",
+    "DELETE FROM savings_by_month",
+    """
+    INSERT INTO shipment_stats (stats_id, total_shipments, in_progress, completed_shipments, total_savings)
+    SELECT 1,
+           (SELECT COUNT(*) FROM shipments),
+           (SELECT COUNT(*) FROM shipments WHERE status NOT IN ('complete', 'failed')),
+           COUNT(*), COALESCE(SUM(savings), 0)
+    FROM completed_shipment_savings
+    """,
+    """
+    INSERT INTO carrier_stats (carrier_name, shipments_bid, shipments_won, total_savings)
+    SELECT q.carrier_name, COUNT(*), SUM(q.carrier_name = c.final_winner),
+           SUM(CASE WHEN q.carrier_name = c.final_winner THEN c.savings ELSE 0 END)
+    FROM completed_shipment_savings c
+    JOIN quotes q ON q.shipment_id = c.shipment_id AND q.quote_type = 'initial' AND q.status = 'received'
+    GROUP BY q.carrier_name
+    """,
+    """
+    INSERT INTO savings_by_month (period, completed_shipments, total_savings)
+    SELECT substr(request_date, 1, 7), COUNT(*), SUM(savings)
+    FROM completed_shipment_savings
+    GROUP BY substr(request_date, 1, 7)
+    """,
+]
+
+
+def rebuild_stats(conn):
+    """
+    Recomputes every rollup from the shipments and quotes in one transaction.
+
+    Needed after loading shipments that are already complete (their quotes are
+    inserted after them, so the triggers can't see the bids yet) or deleting
+    shipments.
+    """
+    for statement in _REBUILD_STATEMENTS:
+        conn.execute(statement)
+    conn.commit()
+
+
+def get_dashboard_stats(conn):
+    """Returns the dashboard totals, per-carrier win rates and recent monthly savings."""
+    totals = conn.execute(
+        "SELECT total_shipments, in_progress, completed_shipments, total_savings FROM shipment_stats WHERE stats_id = 1"
+    ).fetchone() or (0, 0, 0, 0.0)
+    total_shipments, in_progress, completed_shipments, total_savings = totals
+
+    carriers = [
+        {
+            "carrier_name": carrier_name,
+            "shipments_bid": shipments_bid,
+            "shipments_won": shipments_won,
+            "win_rate": shipments_won / shipments_bid if shipments_bid else 0.0,
+            "total_savings": carrier_savings,
+        }
+        for carrier_name, shipments_bid, shipments_won, carrier_savings in conn.execute(
+            "SELECT carrier_name, shipments_bid, shipments_won, total_savings FROM carrier_stats ORDER BY carrier_name"
+        )
+    ]
+
+    savings_by_month = [
+        {"period": period, "completed_shipments": completed, "total_savings": savings}
+        for period, completed, savings in conn.execute(
+            "SELECT period, completed_shipments, total_savings FROM savings_by_month ORDER BY period DESC LIMIT ?",
+            (STATS_SAVINGS_MONTHS,)
+        )
+    ]
+
+    return {
+        "total_shipments": total_shipments,
+        "in_progress": in_progress,
+        "completed_shipments": completed_shipments,
+        "total_savings": total_savings,
+        "carriers": carriers,
+        "savings_by_month": savings_by_month,
+    }
+
+
+if __name__ == '__main__':
+    conn = connect(DB_PATH)
+    print("Rebuilding dashboard stats...")
+    rebuild_stats(conn)
+    stats = get_dashboard_stats(conn)
+    conn.close()
+    print(f"✅ Stats rebuilt: {stats['total_shipments']} shipments, {stats['completed_shipments']} complete, "
+          f"${stats['total_savings']:.2f} saved.")
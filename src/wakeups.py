@@ -0,0 +1,97 @@
+# src/wakeups.py
+"""
+Lets one process tell another there is work for it: the app tells the worker
+about new shipments, and the worker tells the sender about queued emails. The
+receiver reacts within milliseconds instead of on its next polling interval,
+and doesn't need to poll the database while it's idle.
+
+A notice is a single UDP datagram naming a topic, e.g. 'new_shipments', sent to
+a port on WAKEUP_HOST. Sending one never blocks and never fails the caller.
+If nobody is listening, the notice is lost, and the receiver's periodic sweep
+picks up the work later, so notices only ever make things faster. Listeners
+share their port (SO_REUSEPORT where available), so several workers on one
+host can all listen; each notice wakes one of them.
+"""
+import logging
+import socket
+import threading
+from src import config
+
+# --- Wakeup settings (override any of these in src/config.py) ---
+# Where the worker and sender listen; every process on the host must agree.
+WAKEUP_HOST = getattr(config, 'WAKEUP_HOST', '127.0.0.1')
+# Set a port to 0 to turn notices to that process off; it then polls as before.
+WORKER_WAKEUP_PORT = getattr(config, 'WORKER_WAKEUP_PORT', 9111)
+SENDER_WAKEUP_PORT = getattr(config, 'SENDER_WAKEUP_PORT', 9112)
+
+log = logging.getLogger(__name__)
+
+_send_socket = None
+_send_lock = threading.Lock()
+
+
+def notify(port, topic):
+    """Sends `topic` to whoever listens on `port`, if anyone does."""
+    global _send_socket
+    if not port:
+        return
+    try:
+        with _send_lock:
+            if _send_socket is None:
+                _send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                _send_socket.setblocking(False)
+            _send_socket.sendto(topic.encode(), (WAKEUP_HOST, port))
+    except OSError as e:
+        log.debug("WAKEUP: Could not notify port %s of %s: %s", port, topic, e)
+
+
+def notify_worker(topic):
+    """Wakes the worker to handle `topic` (one of the worker's wakeup kinds)."""
+    notify(WORKER_WAKEUP_PORT, topic)
+
+
+def notify_sender():
+    """Wakes the sender to deliver newly queued emails."""
+    notify(SENDER_WAKEUP_PORT, 'outbox')
+
+
+def set_when(event, other):
+    """Sets `other` once `event` is set, so a single wait() can watch for both."""
+    event.wait()
+    other.set()
+
+
+def _listen(sock, on_notice, stop):
+    with sock:
+        while not stop.is_set():
+            try:
+                data, _ = sock.recvfrom(256)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                log.error("WAKEUP ERROR: Listener stopped: %s", e)
+                return
+            on_notice(data.decode(errors='replace'))
+
+
+def start_listener(port, on_notice, stop, name="wakeup-listener"):
+    """
+    Calls on_notice(topic) from a daemon thread for every notice sent to
+    `port`, until `stop` (a threading.Event) is set. The port is bound before
+    this returns, so no notice sent afterwards is missed. Returns False, and
+    leaves the caller to poll, if the port is 0 or can't be bound.
+    """
+    if not port:
+        return False
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((WAKEUP_HOST, port))
+    except OSError as e:
+        sock.close()
+        log.warning("WAKEUP: Could not listen on port %s (%s); falling back to polling.", port, e)
+        return False
+    sock.settimeout(1)
+    threading.Thread(target=_listen, args=(sock, on_notice, stop), name=name, daemon=True).start()
+    return True
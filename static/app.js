@@ -16,9 +16,16 @@ document.addEventListener("DOMContentLoaded", () => {
   const pageSpan = document.getElementById("page-number");
 
   // State
-  let allShipments = [];
-  let currentPage = 1;
+  // Only the visible page is held. Pages are fetched by keyset cursor:
+  // `pageCursor` is the cursor the current page was fetched with (null for the
+  // newest page) and `cursorStack` holds the cursors of the pages before it.
+  let pageShipments = [];
+  let pageCursor = null;
+  let nextCursor = null;
+  let cursorStack = [];
+  let searchOrigin = null; // Set while paging from a searched-for shipment
   let selectedShipmentId = null;
+  let selectedQuotes = [];
   const DEFAULT_ROWS_PER_PAGE = 5;
   let rowsPerPage = DEFAULT_ROWS_PER_PAGE;
 
@@ -42,23 +49,30 @@ document.addEventListener("DOMContentLoaded", () => {
       if (!response.ok)
         throw new Error(`HTTP error! status: ${response.status}`);
       const stats = await response.json();
-
-      totalShipmentsStat.textContent = stats.total_shipments;
-      inProgressStat.textContent = stats.in_progress;
-      totalSavingsStat.textContent = `$${stats.total_savings.toFixed(2)}`;
+      renderStats(stats);
       console.log("Stats loaded:", stats);
     } catch (error) {
       console.error("Failed to fetch stats:", error);
     }
   }
 
+  function renderStats(stats) {
+    totalShipmentsStat.textContent = stats.total_shipments;
+    inProgressStat.textContent = stats.in_progress;
+    totalSavingsStat.textContent = `$${stats.total_savings.toFixed(2)}`;
+  }
+
   async function fetchShipments() {
     try {
-      const response = await fetch("/api/shipments");
+      const params = new URLSearchParams({ limit: rowsPerPage });
+      if (pageCursor !== null) params.set("cursor", pageCursor);
+      const response = await fetch(`/api/shipments?${params}`);
       if (!response.ok)
         throw new Error(`HTTP error! status: ${response.status}`);
-      allShipments = await response.json();
-      console.log(`Loaded ${allShipments.length} total shipments.`);
+      const page = await response.json();
+      pageShipments = page.shipments;
+      nextCursor = page.next_cursor;
+      console.log(`Loaded ${pageShipments.length} shipments.`);
 
       // Crucially, always render the page after fetching.
       renderShipmentsPage();
@@ -69,11 +83,8 @@ document.addEventListener("DOMContentLoaded", () => {
 
   function renderShipmentsPage() {
     shipmentsTableBody.innerHTML = "";
-    const start = (currentPage - 1) * rowsPerPage;
-    const end = start + rowsPerPage;
-    const paginatedShipments = allShipments.slice(start, end);
 
-    paginatedShipments.forEach((s) => {
+    pageShipments.forEach((s) => {
       const row = document.createElement("tr");
       row.id = `shipment-row-${s.shipment_id}`;
       if (s.shipment_id === selectedShipmentId) {
@@ -106,16 +117,28 @@ document.addEventListener("DOMContentLoaded", () => {
   }
 
   function updatePaginationControls() {
-    const totalPages = Math.ceil(allShipments.length / rowsPerPage);
-    pageSpan.textContent = `Page ${currentPage} of ${totalPages || 1}`;
-    prevButton.disabled = currentPage === 1;
-    nextButton.disabled = currentPage === totalPages || totalPages === 0;
+    const pageNumber = `Page ${cursorStack.length + 1}`;
+    pageSpan.textContent = searchOrigin
+      ? `${pageNumber} from #${searchOrigin}`
+      : pageNumber;
+    prevButton.disabled = pageCursor === null;
+    nextButton.disabled = nextCursor === null;
+  }
+
+  async function goToPage(cursor) {
+    pageCursor = cursor;
+    await fetchShipments();
   }
 
   async function fetchAndRenderQuotes(shipmentId) {
     detailsIdSpan.textContent = shipmentId;
     const response = await fetch(`/api/quotes/${shipmentId}`);
-    const quotes = await response.json();
+    selectedQuotes = await response.json();
+    renderQuotes();
+  }
+
+  function renderQuotes() {
+    const quotes = selectedQuotes;
     quotesTableBody.innerHTML = "";
 
     if (quotes.length === 0) {
@@ -156,45 +179,108 @@ document.addEventListener("DOMContentLoaded", () => {
       body: JSON.stringify(shipmentData),
     });
     form.reset();
+    // Go back to the newest page, where the new shipment is.
+    cursorStack = [];
+    pageCursor = null;
+    searchOrigin = null;
     await refreshDashboard();
-    currentPage = 1;
-    renderShipmentsPage();
   });
 
   searchForm.addEventListener("submit", async (event) => {
     event.preventDefault();
     const searchId = parseInt(searchInput.value, 10);
     if (isNaN(searchId)) return;
-    const shipmentIndex = allShipments.findIndex(
-      (s) => s.shipment_id === searchId,
-    );
-    if (shipmentIndex === -1) {
+    const response = await fetch(`/api/shipments?id=${searchId}`);
+    const result = await response.json();
+    if (result.shipments.length === 0) {
       alert(`Shipment ID #${searchId} not found.`);
       return;
     }
-    const targetPage = Math.floor(shipmentIndex / rowsPerPage) + 1;
-    currentPage = targetPage;
-    renderShipmentsPage();
+    // Show the page that starts at the shipment; Previous from there goes back
+    // to the newest page.
+    cursorStack = [];
+    searchOrigin = searchId;
+    selectedShipmentId = searchId;
+    await goToPage(searchId + 1);
     await fetchAndRenderQuotes(searchId);
     searchInput.value = "";
   });
 
   prevButton.addEventListener("click", () => {
-    if (currentPage > 1) {
-      currentPage--;
-      renderShipmentsPage();
-    }
+    if (pageCursor === null) return;
+    if (cursorStack.length === 0) searchOrigin = null;
+    goToPage(cursorStack.length ? cursorStack.pop() : null);
   });
 
   nextButton.addEventListener("click", () => {
-    const totalPages = Math.ceil(allShipments.length / rowsPerPage);
-    if (currentPage < totalPages) {
-      currentPage++;
+    if (nextCursor === null) return;
+    cursorStack.push(pageCursor);
+    goToPage(nextCursor);
+  });
+
+  // --- Live Updates ---
+  // The server pushes every shipment and quote change as it happens; only the
+  // rows that changed are applied to what's on screen.
+
+  function applyChanges(changes) {
+    renderStats(changes.stats);
+
+    let pageChanged = false;
+    changes.shipments.forEach((s) => {
+      const index = pageShipments.findIndex(
+        (p) => p.shipment_id === s.shipment_id,
+      );
+      if (index !== -1) {
+        pageShipments[index] = s;
+        pageChanged = true;
+      } else if (
+        pageCursor === null &&
+        (pageShipments.length === 0 ||
+          s.shipment_id > pageShipments[0].shipment_id)
+      ) {
+        // A new shipment goes at the top of the newest page.
+        pageShipments.unshift(s);
+        pageChanged = true;
+      }
+    });
+    if (pageChanged) {
+      pageShipments.sort((a, b) => b.shipment_id - a.shipment_id);
+      if (pageShipments.length > rowsPerPage) {
+        pageShipments = pageShipments.slice(0, rowsPerPage);
+        nextCursor = pageShipments[pageShipments.length - 1].shipment_id;
+      }
       renderShipmentsPage();
     }
-  });
 
-  // --- Initial Load and Auto-Refresh ---
+    const quoteChanges = changes.quotes.filter(
+      (q) => q.shipment_id === selectedShipmentId,
+    );
+    if (quoteChanges.length) {
+      quoteChanges.forEach((q) => {
+        const index = selectedQuotes.findIndex((o) => o.quote_id === q.quote_id);
+        if (index !== -1) selectedQuotes[index] = q;
+        else selectedQuotes.push(q);
+      });
+      selectedQuotes.sort((a, b) => a.quote_id - b.quote_id);
+      renderQuotes();
+    }
+  }
+
+  function connectEvents() {
+    if (!window.EventSource) {
+      setInterval(refreshDashboard, 5000);
+      return;
+    }
+    // EventSource reconnects by itself and resumes from the last event it saw.
+    const events = new EventSource("/api/events");
+    events.addEventListener("changes", (event) =>
+      applyChanges(JSON.parse(event.data)),
+    );
+    // Sent when too much changed at once, or we fell too far behind.
+    events.addEventListener("reset", () => refreshDashboard());
+  }
+
+  // --- Initial Load ---
   refreshDashboard();
-  setInterval(refreshDashboard, 5000);
+  connectEvents();
 });
@@ -1,90 +1,249 @@
-import sqlite3
+import json
+import logging
+import signal
+import threading
 import time
-# from datetime import datetime
+from datetime import datetime
 
 # Import all the necessary functions from your utility files
-from src.database_setup import DB_PATH
-from src.quoting import send_email_quote_request
-from src.email_parser import parse_incoming_quotes
-from src.negotiation import send_negotiation_request
-from src.config import CARRIERS, POLLING_INTERVAL_SECONDS, TIMEOUT_HOURS
+from src.database_setup import DB_PATH, create_database
+from src.db import get_connection, run_with_busy_retry
+from src.quoting import queue_email_quote_requests, request_api_quotes
+from src.email_parser import close_session, inbox_name, parse_incoming_quotes, watch_inbox
+from src.negotiation import queue_negotiation_requests
+from src.ml_model import retrain_if_needed
+from src.events import prune_change_log
+from src.deadlines import next_deadline, pop_expired_deadlines, schedule_deadlines, schedule_missing_deadlines
+from src.leases import acquire_lease, expire_shipments, lease_expiry, release_leases, release_shipments, start_heartbeat, worker_id
+from src.logging_setup import configure_logging
+from src.wakeups import WORKER_WAKEUP_PORT, notify_sender, set_when, start_listener
+from src.metrics import Counter, Histogram, start_exporter
+from src import config
+from src.config import CARRIERS, POLLING_INTERVAL_SECONDS
+
+# How often the worker checks whether any carrier's model has enough new data
+# to be retrained, in minutes (override in src/config.py; 0 turns it off).
+RETRAIN_CHECK_MINUTES = getattr(config, 'RETRAIN_CHECK_MINUTES', 60)
+# Port the worker serves its /metrics on (override in src/config.py; 0 turns it off).
+WORKER_METRICS_PORT = getattr(config, 'WORKER_METRICS_PORT', 9101)
+# How often the worker runs every phase regardless, in case a wakeup notice was
+# lost (e.g. a shipment added while the worker was down), in seconds.
+WORKER_SWEEP_SECONDS = getattr(config, 'WORKER_SWEEP_SECONDS', 300)
+# New shipments a worker claims at a time, so several workers can share a burst.
+WORKER_CLAIM_BATCH = getattr(config, 'WORKER_CLAIM_BATCH', 100)
+
+log = logging.getLogger('worker')
+
+PHASE_SECONDS = Histogram('worker_phase_seconds', "Time spent in each phase of a worker cycle.", ['phase'])
+CYCLE_SECONDS = Histogram('worker_cycle_seconds', "Time a whole worker cycle took, excluding the wait between cycles.")
+CYCLE_ERRORS = Counter('worker_cycle_errors_total', "Worker cycles cut short by an error.")
+TRANSITIONS = Counter('worker_shipment_transitions_total', "Shipments the worker moved into each status.", ['status'])
+WAKEUPS = Counter('worker_wakeups_total', "Reasons the worker woke up to run phases.", ['kind'])
+DEADLINES_EXPIRED = Counter('worker_deadlines_expired_total', "Deadlines that passed, by phase and whether a shipment or a single carrier timed out.", ['phase', 'scope'])
+
+_retrain_thread = None
 
 def get_db_connection():
-    """Establishes a connection to the database."""
-    return sqlite3.connect(DB_PATH)
+    """Borrows a pooled connection to the database; close() hands it back."""
+    return get_connection(DB_PATH)
 
 def start_new_shipments(conn):
-    """Finds shipments with status 'quoting' and starts the process."""
-    cursor = conn.cursor()
-    cursor.execute("SELECT shipment_id, spots, weight, destination_zip FROM shipments WHERE status = 'quoting'")
-    new_shipments = cursor.fetchall()
-
-    for shipment in new_shipments:
-        shipment_id, spots, weight, destination_zip = shipment
-        print(f"WORKER: Found new shipment #{shipment_id}. Locking and starting quote process...")
+    """Finds shipments with status 'quoting' and starts the process, a batch at a time."""
+    while _start_shipment_batch(conn) == WORKER_CLAIM_BATCH:
+        pass
 
-        # --- BUG FIX: Immediately lock the shipment to prevent reprocessing ---
-        cursor.execute("UPDATE shipments SET status = 'processing_initial' WHERE shipment_id = ?", (shipment_id,))
+def _start_shipment_batch(conn):
+    cursor = conn.cursor()
+    api_carriers = {name: info for name, info in CARRIERS.items() if info.get('type') == 'api'}
+
+    # Claim a batch of new shipments, create their quote rows and queue their
+    # emails in one transaction; the outbox sender delivers the emails after
+    # the commit. API carriers are asked after the commit, so until they have
+    # answered the batch stays leased to this worker, and is taken over by
+    # another if this one dies (see resume_abandoned_shipments).
+    lease = (worker_id(), lease_expiry()) if api_carriers else (None, None)
+    new_shipments = cursor.execute("""
+        UPDATE shipments SET status = 'awaiting_initial_quotes', lease_owner = ?, lease_expires_at = ?
+        WHERE shipment_id IN (SELECT shipment_id FROM shipments WHERE status = 'quoting' ORDER BY shipment_id LIMIT ?)
+        RETURNING shipment_id, spots, weight, destination_zip
+    """, (*lease, WORKER_CLAIM_BATCH)).fetchall()
+
+    if not new_shipments:
         conn.commit()
+        return 0
+
+    log.info("WORKER: Found %d new shipment(s). Starting quote process...", len(new_shipments))
 
+    quote_rows, email_requests, api_shipments, carrier_waits = [], [], [], []
+    for shipment_id, spots, weight, destination_zip in new_shipments:
         shipment_details = {'shipment_id': shipment_id, 'spots': spots, 'weight': weight, 'destination_zip': destination_zip}
+        api_shipments.append(shipment_details)
 
         for name, info in CARRIERS.items():
-            cursor.execute("INSERT INTO quotes (shipment_id, carrier_name, quote_type) VALUES (?, ?, ?)", (shipment_id, name, 'initial'))
+            quote_rows.append((shipment_id, name, 'initial'))
             if info.get('type') == 'email':
-                send_email_quote_request(info['contact'], shipment_details)
+                email_requests.append((name, info['contact'], shipment_details))
+                carrier_waits.append((shipment_id, name))
+
+    cursor.executemany("INSERT INTO quotes (shipment_id, carrier_name, quote_type) VALUES (?, ?, ?)", quote_rows)
+    queue_email_quote_requests(cursor, email_requests)
+    schedule_deadlines(cursor, 'awaiting_initial_quotes', [shipment_id for shipment_id, *_ in new_shipments],
+                       carrier_waits, CARRIERS)
+    conn.commit()
+    if email_requests:
+        notify_sender()
+    TRANSITIONS.inc(len(new_shipments), status='awaiting_initial_quotes')
+    log.info("WORKER: Initial quote requests queued for %d shipment(s).", len(new_shipments))
+
+    # API carriers answer straight away, so fan out to all of them for the whole batch.
+    if api_carriers:
+        _request_api_quotes_leased(conn, [(api_shipments, api_carriers)], [shipment_id for shipment_id, *_ in new_shipments])
+    return len(new_shipments)
+
+
+def _request_api_quotes_leased(conn, requests, shipment_ids):
+    """
+    Makes each (shipments, api_carriers) quote request for the leased
+    shipment_ids, then releases them. If a request fails the leases are
+    expired instead, so the shipments are resumed (by any worker) rather than
+    left waiting for their deadline.
+    """
+    try:
+        for shipments, api_carriers in requests:
+            request_api_quotes(conn, shipments, api_carriers)
+    except Exception:
+        try:
+            run_with_busy_retry(conn, expire_shipments, shipment_ids)
+        except Exception as e:
+            log.error("WORKER ERROR: Could not expire leases after a failed API request: %s", e)
+        raise
+    release_shipments(conn, shipment_ids)
 
-        cursor.execute("UPDATE shipments SET status = 'awaiting_initial_quotes' WHERE shipment_id = ?", (shipment_id,))
-        conn.commit()
-        print(f"WORKER: Initial quote requests sent for shipment #{shipment_id}.")
+
+def resume_abandoned_shipments(conn):
+    """
+    Takes over shipments whose lease has expired, i.e. whose worker died after
+    claiming them or couldn't finish asking the API carriers, and asks the API
+    carriers that haven't answered yet.
+    """
+    abandoned = conn.execute("""
+        UPDATE shipments SET lease_owner = ?, lease_expires_at = ?
+        WHERE lease_owner IS NOT NULL AND lease_expires_at < ?
+        RETURNING shipment_id, spots, weight, destination_zip, status
+    """, (worker_id(), lease_expiry(), datetime.now().isoformat())).fetchall()
+    conn.commit()
+    if not abandoned:
+        return
+
+    log.warning("WORKER: ⚠️ Taking over %d shipment(s) whose lease ran out.", len(abandoned))
+    waiting = {
+        shipment_id: {'shipment_id': shipment_id, 'spots': spots, 'weight': weight, 'destination_zip': destination_zip}
+        for shipment_id, spots, weight, destination_zip, status in abandoned if status == 'awaiting_initial_quotes'
+    }
+    api_carriers = {name: info for name, info in CARRIERS.items() if info.get('type') == 'api'}
+    requests = []
+    if waiting and api_carriers:
+        unanswered = conn.execute("""
+            SELECT shipment_id, carrier_name FROM quotes
+            WHERE shipment_id IN (SELECT value FROM json_each(?)) AND quote_type = 'initial' AND status = 'pending'
+        """, (json.dumps(list(waiting)),)).fetchall()
+        for name, info in api_carriers.items():
+            shipments = [waiting[shipment_id] for shipment_id, carrier_name in unanswered if carrier_name == name]
+            if shipments:
+                requests.append((shipments, {name: info}))
+    _request_api_quotes_leased(conn, requests, [shipment_id for shipment_id, *_ in abandoned])
 
 
 def advance_to_negotiation(conn):
     """
-    Finds shipments ready for negotiation and sends counter-offer emails to all non-winners.
+    Finds shipments ready for negotiation and queues counter-offer emails to all non-winners.
     """
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT s.shipment_id, s.spots, s.weight, s.destination_zip
-        FROM shipments s
-        WHERE s.status = 'awaiting_initial_quotes' AND
-              (SELECT COUNT(*) FROM quotes q WHERE q.shipment_id = s.shipment_id AND q.quote_type = 'initial' AND q.status IN ('received', 'failed')) = ?
-    """, (len(CARRIERS),))
-    ready_shipments = cursor.fetchall()
-
-    for shipment in ready_shipments:
-        shipment_id, spots, weight, destination_zip = shipment
 
-        cursor.execute("SELECT carrier_name, price FROM quotes WHERE shipment_id = ? AND quote_type = 'initial' AND status = 'received' ORDER BY price ASC LIMIT 1", (shipment_id,))
-        result = cursor.fetchone()
+    # Claim every shipment whose initial round is finished. The claim takes
+    # the write lock before anything is read, so no other worker can queue
+    # negotiation emails for the same shipment, and shipments another worker
+    # holds a lease on are left alone.
+    owner = worker_id()
+    claimed = cursor.execute("""
+        UPDATE shipments SET lease_owner = ?, lease_expires_at = ?
+        WHERE shipment_id IN (
+            SELECT s.shipment_id
+            FROM shipments s
+            JOIN quotes q ON q.shipment_id = s.shipment_id
+            WHERE s.status = 'awaiting_initial_quotes' AND
+                  (s.lease_owner IS NULL OR s.lease_owner = ? OR s.lease_expires_at < ?) AND
+                  q.quote_type = 'initial' AND q.status IN ('received', 'failed')
+            GROUP BY s.shipment_id
+            HAVING COUNT(*) = ?
+        )
+        RETURNING shipment_id
+    """, (owner, lease_expiry(), owner, datetime.now().isoformat(), len(CARRIERS))).fetchall()
+    if not claimed:
+        conn.commit()
+        return
 
-        if not result:
-            print(f"WORKER: No successful initial bids for #{shipment_id}. Marking as complete.")
-            cursor.execute("UPDATE shipments SET status = 'complete', final_winner = 'No Bids' WHERE shipment_id = ?", (shipment_id,))
-            conn.commit()
+    # One pass over the quotes: rank the received bids of every claimed
+    # shipment, cheapest first. Shipments without a single received bid come
+    # back as one row with a NULL carrier.
+    cursor.execute("""
+        SELECT r.value, q.carrier_name, q.price,
+               ROW_NUMBER() OVER (PARTITION BY r.value ORDER BY q.price, q.quote_id) AS bid_rank
+        FROM json_each(?) r
+        LEFT JOIN quotes q ON q.shipment_id = r.value AND q.quote_type = 'initial' AND q.status = 'received'
+        ORDER BY r.value, bid_rank
+    """, (json.dumps([shipment_id for shipment_id, in claimed]),))
+
+    bids_by_shipment = {}
+    for shipment_id, carrier_name, price, _ in cursor.fetchall():
+        bids = bids_by_shipment.setdefault(shipment_id, [])
+        if carrier_name is not None:
+            bids.append((carrier_name, price))
+
+    no_bids, finalized, negotiating, negotiation_requests, fixed_offers = [], [], [], [], []
+    for shipment_id, bids in bids_by_shipment.items():
+        if not bids:
+            log.debug("WORKER: No successful initial bids for #%s. Marking as complete.", shipment_id)
+            no_bids.append((shipment_id,))
             continue
 
-        leader_carrier, lowest_bid = result
-        print(f"WORKER: Initial leader for #{shipment_id} is {leader_carrier} at ${lowest_bid:.2f}.")
-
-        cursor.execute("SELECT carrier_name FROM quotes WHERE shipment_id = ? AND quote_type = 'initial' AND status = 'received' AND carrier_name != ?", (shipment_id, leader_carrier))
-        carriers_to_negotiate_with = cursor.fetchall()
+        (leader_carrier, lowest_bid), carriers_to_negotiate_with = bids[0], bids[1:]
+        log.debug("WORKER: Initial leader for #%s is %s at $%.2f.", shipment_id, leader_carrier, lowest_bid)
 
         if not carriers_to_negotiate_with:
-            print(f"WORKER: No negotiation candidates for shipment #{shipment_id}. Finalizing.")
-            cursor.execute(
-                "UPDATE shipments SET status = 'complete', final_winner = ?, final_price = ? WHERE shipment_id = ?",
-                (leader_carrier, lowest_bid, shipment_id)
-            )
+            log.debug("WORKER: No negotiation candidates for shipment #%s. Finalizing.", shipment_id)
+            finalized.append((leader_carrier, lowest_bid, shipment_id))
         else:
-            print(f"WORKER: Starting negotiation with {len(carriers_to_negotiate_with)} carrier(s).")
-            for (carrier_name,) in carriers_to_negotiate_with:
+            log.debug("WORKER: Starting negotiation with %d carrier(s).", len(carriers_to_negotiate_with))
+            for carrier_name, price in carriers_to_negotiate_with:
+                if CARRIERS[carrier_name].get('type') == 'api':
+                    # API rates aren't negotiable: their quote stands as their final offer.
+                    fixed_offers.append((shipment_id, carrier_name, 'final', price, datetime.now().isoformat(), 'received'))
+                    continue
                 contact_email = CARRIERS[carrier_name]['contact']
-                send_negotiation_request(contact_email, shipment_id, lowest_bid)
-
-            cursor.execute("UPDATE shipments SET status = 'awaiting_final_offers' WHERE shipment_id = ?", (shipment_id,))
-
-        conn.commit()
+                negotiation_requests.append((carrier_name, contact_email, shipment_id, lowest_bid))
+            negotiating.append(shipment_id)
+
+    # Moving a shipment on also ends its lease.
+    release = "lease_owner = NULL, lease_expires_at = NULL"
+    cursor.executemany(f"UPDATE shipments SET status = 'complete', final_winner = 'No Bids', {release} WHERE shipment_id = ?", no_bids)
+    cursor.executemany(f"UPDATE shipments SET status = 'complete', final_winner = ?, final_price = ?, {release} WHERE shipment_id = ?", finalized)
+    cursor.executemany(f"UPDATE shipments SET status = 'awaiting_final_offers', {release} WHERE shipment_id = ?", [(shipment_id,) for shipment_id in negotiating])
+    cursor.executemany(
+        "INSERT INTO quotes (shipment_id, carrier_name, quote_type, price, received_at, status) VALUES (?, ?, ?, ?, ?, ?)",
+        fixed_offers
+    )
+    queue_negotiation_requests(cursor, negotiation_requests)
+    schedule_deadlines(cursor, 'awaiting_final_offers', negotiating,
+                       [(shipment_id, carrier_name) for carrier_name, _, shipment_id, _ in negotiation_requests], CARRIERS)
+    conn.commit()
+    if negotiation_requests:
+        notify_sender()
+    TRANSITIONS.inc(len(no_bids) + len(finalized), status='complete')
+    TRANSITIONS.inc(len(negotiating), status='awaiting_final_offers')
+    if bids_by_shipment:
+        log.info("WORKER: %d shipment(s) finished initial quoting: %d negotiating, %d complete.",
+                 len(bids_by_shipment), len(negotiating), len(no_bids) + len(finalized))
 
 
 def complete_shipments(conn):
@@ -93,82 +252,271 @@ def complete_shipments(conn):
     and marks them as complete.
     """
     cursor = conn.cursor()
-    cursor.execute("SELECT shipment_id FROM shipments WHERE status = 'awaiting_final_offers'")
-    shipments_to_check = cursor.fetchall()
-
-    for (shipment_id,) in shipments_to_check:
-        cursor.execute("""
-            SELECT COUNT(*) FROM quotes
-            WHERE shipment_id = ? AND quote_type = 'initial' AND status = 'received' AND
-                  price > (SELECT MIN(price) FROM quotes WHERE shipment_id = ? AND quote_type = 'initial' AND status = 'received')
-        """, (shipment_id, shipment_id))
-        expected_final_offers = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM quotes WHERE shipment_id = ? AND quote_type = 'final' AND status IN ('received', 'failed')", (shipment_id,))
-        received_final_offers = cursor.fetchone()[0]
-
-        if received_final_offers >= expected_final_offers:
-            print(f"WORKER: All final offers received for shipment #{shipment_id}. Determining winner...")
-
-            cursor.execute("SELECT carrier_name, price FROM quotes WHERE shipment_id = ? AND quote_type = 'initial' AND status = 'received' ORDER BY price ASC LIMIT 1", (shipment_id,))
-            initial_winner, initial_price = cursor.fetchone()
-
-            cursor.execute("SELECT carrier_name, price FROM quotes WHERE shipment_id = ? AND quote_type = 'final' AND status = 'received' ORDER BY price ASC LIMIT 1", (shipment_id,))
-            best_final_offer = cursor.fetchone()
-
-            final_winner = initial_winner
-            final_price = initial_price
-
-            if best_final_offer and best_final_offer[1] < initial_price:
-                final_winner = best_final_offer[0]
-                final_price = best_final_offer[1]
-                print(f"WORKER: ✅ Negotiation successful! New winner is {final_winner} at ${final_price:.2f}.")
-            else:
-                print(f"WORKER: Negotiation did not produce a better offer. Initial winner {initial_winner} stands.")
-
-            cursor.execute(
-                "UPDATE shipments SET status = 'complete', final_winner = ?, final_price = ? WHERE shipment_id = ?",
-                (final_winner, final_price, shipment_id)
+
+    # A shipment is done once every carrier that bid above the initial leader
+    # has answered (or failed to answer) the final offer request. Both rounds
+    # are ranked in one window pass and folded into a row per shipment, so no
+    # intermediate results have to be joined back together.
+    cursor.execute("""
+        WITH bids AS (
+            SELECT q.shipment_id, q.carrier_name, q.price, q.quote_type, q.status,
+                   ROW_NUMBER() OVER (PARTITION BY q.shipment_id, q.quote_type ORDER BY q.status != 'received', q.price, q.quote_id) AS bid_rank,
+                   MIN(CASE WHEN q.quote_type = 'initial' THEN q.price END) OVER (PARTITION BY q.shipment_id) AS lowest_bid
+            FROM shipments s
+            JOIN quotes q ON q.shipment_id = s.shipment_id
+            WHERE s.status = 'awaiting_final_offers' AND (
+                (q.quote_type = 'initial' AND q.status = 'received') OR
+                (q.quote_type = 'final' AND q.status IN ('received', 'failed'))
             )
-            conn.commit()
+        )
+        SELECT shipment_id,
+               MAX(CASE WHEN quote_type = 'initial' AND bid_rank = 1 THEN carrier_name END),
+               MAX(CASE WHEN quote_type = 'initial' AND bid_rank = 1 THEN price END),
+               MAX(CASE WHEN quote_type = 'final' AND bid_rank = 1 AND status = 'received' THEN carrier_name END),
+               MAX(CASE WHEN quote_type = 'final' AND bid_rank = 1 AND status = 'received' THEN price END)
+        FROM bids
+        GROUP BY shipment_id
+        HAVING SUM(quote_type = 'initial') > 0 AND
+               SUM(quote_type = 'final') >= SUM(quote_type = 'initial' AND price > lowest_bid)
+    """)
+    ready_shipments = cursor.fetchall()
+
+    completed = []
+    for shipment_id, initial_winner, initial_price, final_carrier, final_offer in ready_shipments:
+        log.debug("WORKER: All final offers received for shipment #%s. Determining winner...", shipment_id)
+
+        final_winner = initial_winner
+        final_price = initial_price
+
+        if final_offer is not None and final_offer < initial_price:
+            final_winner = final_carrier
+            final_price = final_offer
+            log.debug("WORKER: ✅ Negotiation successful! New winner is %s at $%.2f.", final_winner, final_price)
+        else:
+            log.debug("WORKER: Negotiation did not produce a better offer. Initial winner %s stands.", initial_winner)
+
+        completed.append((final_winner, final_price, shipment_id))
+
+    # Another worker may have completed the same shipments since they were read.
+    cursor.executemany(
+        "UPDATE shipments SET status = 'complete', final_winner = ?, final_price = ? WHERE shipment_id = ? AND status = 'awaiting_final_offers'",
+        completed
+    )
+    newly_completed = cursor.rowcount if completed else 0
+    conn.commit()
+    TRANSITIONS.inc(newly_completed, status='complete')
+    if newly_completed:
+        log.info("WORKER: Completed %d shipment(s) after negotiation.", newly_completed)
 
 
 def timeout_stale_shipments(conn):
-    """Finds shipments that are stuck and marks them as complete."""
+    """
+    Acts on every deadline that has passed. A shipment that ran out of time in
+    its phase is marked as complete; a carrier that ran out of time has its
+    reply marked as failed, so the shipment carries on with the bids it has.
+    """
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT shipment_id FROM shipments
-        WHERE status LIKE 'awaiting%' AND
-              request_date < datetime('now', '-' || ? || ' hours')
-    """, (TIMEOUT_HOURS,))
-
-    stale_shipments = cursor.fetchall()
-
-    for (shipment_id,) in stale_shipments:
-        print(f"WORKER: ⚠️ Shipment #{shipment_id} has timed out. Marking as complete.")
-        cursor.execute(
-            "UPDATE shipments SET status = 'complete', final_winner = 'Timed Out' WHERE shipment_id = ?",
-            (shipment_id,)
-        )
+    stale_shipments, late_initial, late_final = [], [], []
+    for shipment_id, phase, carrier_name in pop_expired_deadlines(cursor):
+        DEADLINES_EXPIRED.inc(phase=phase, scope='carrier' if carrier_name else 'shipment')
+        if not carrier_name:
+            stale_shipments.append((shipment_id, phase))
+        elif phase == 'awaiting_initial_quotes':
+            late_initial.append((shipment_id, carrier_name))
+        else:
+            late_final.append((shipment_id, carrier_name, phase))
+
+    if not (stale_shipments or late_initial or late_final):
         conn.commit()
+        return
+
+    cursor.executemany(
+        "UPDATE shipments SET status = 'complete', final_winner = 'Timed Out' WHERE shipment_id = ? AND status = ?",
+        stale_shipments
+    )
+    cursor.executemany(
+        "UPDATE quotes SET status = 'failed' WHERE shipment_id = ? AND carrier_name = ? AND quote_type = 'initial' AND status = 'pending'",
+        late_initial
+    )
+    # Final offers only get a row once the carrier answers.
+    cursor.executemany("""
+        INSERT INTO quotes (shipment_id, carrier_name, quote_type, status)
+        SELECT s.shipment_id, ?2, 'final', 'failed' FROM shipments s
+        WHERE s.shipment_id = ?1 AND s.status = ?3 AND NOT EXISTS (
+            SELECT 1 FROM quotes q WHERE q.shipment_id = s.shipment_id AND q.carrier_name = ?2 AND q.quote_type = 'final'
+        )
+    """, late_final)
+    conn.commit()
+    TRANSITIONS.inc(len(stale_shipments), status='complete')
+
+    for shipment_id, _ in stale_shipments:
+        log.warning("WORKER: ⚠️ Shipment #%s has timed out. Marking as complete.", shipment_id)
+    for shipment_id, carrier_name, *_ in late_initial + late_final:
+        log.warning("WORKER: ⚠️ %s did not reply in time for shipment #%s. Carrying on without them.", carrier_name, shipment_id)
+
+def seconds_until_next_deadline(conn):
+    """Returns how long until the next deadline is due, or None if there isn't one."""
+    due = next_deadline(conn)
+    return None if due is None else max(0.0, (due - datetime.now()).total_seconds())
+
+def _retrain_models():
+    try:
+        # One worker retrains at a time; the others leave it to whoever holds the lease.
+        conn = get_db_connection()
+        try:
+            if not run_with_busy_retry(conn, acquire_lease, 'model-retrain'):
+                log.debug("WORKER: Another worker holds the model-retrain lease; skipping the retrain check.")
+                return
+        finally:
+            conn.close()
+        retrain_if_needed()
+    except Exception as e:
+        log.error("WORKER ERROR: Model retraining failed: %s", e)
 
-def worker_loop():
-    """The main infinite loop for the background worker."""
-    print("🚀 Worker started. Looking for jobs...")
-    while True:
+def start_model_retraining():
+    """
+    Runs the retrain check in a background thread so quoting isn't held up.
+    Only the worker holding the 'model-retrain' lease retrains. New model
+    versions are picked up by load_model without a restart.
+    """
+    global _retrain_thread
+    if _retrain_thread and _retrain_thread.is_alive():
+        return
+    _retrain_thread = threading.Thread(target=_retrain_models, name="model-retrain", daemon=True)
+    _retrain_thread.start()
+
+def check_mail(conn):
+    """
+    Reads new carrier replies, unless another worker holds the lease on the
+    inbox; errors are logged by the parser itself.
+    """
+    if acquire_lease(conn, f"inbox:{inbox_name()}"):
+        parse_incoming_quotes(conn, CARRIERS)
+
+# The phases each kind of wakeup runs, in the order a cycle runs them. Any
+# reply, failed quote or new shipment (e.g. one only API carriers quote) can
+# finish a round, so those are followed by the phases that move shipments on;
+# a sweep runs everything.
+WAKEUP_PHASES = {
+    'mail': (check_mail, advance_to_negotiation, complete_shipments),
+    'new_shipments': (start_new_shipments, advance_to_negotiation, complete_shipments),
+    'deadlines': (timeout_stale_shipments, advance_to_negotiation, complete_shipments),
+    'sweep': (check_mail, resume_abandoned_shipments, start_new_shipments, advance_to_negotiation,
+              complete_shipments, timeout_stale_shipments, prune_change_log),
+}
+_PHASE_ORDER = WAKEUP_PHASES['sweep']
+
+def run_phases(kinds):
+    """Runs every phase the given kinds of wakeup call for, once each, in cycle order."""
+    wanted = {phase for kind in kinds for phase in WAKEUP_PHASES[kind]}
+    with CYCLE_SECONDS.time():
+        conn = get_db_connection()
         try:
-            conn = get_db_connection()
-            parse_incoming_quotes(conn, CARRIERS)
-            start_new_shipments(conn)
-            advance_to_negotiation(conn)
-            complete_shipments(conn)
-            timeout_stale_shipments(conn)
+            # Each phase is one transaction, so it can simply be re-run if the
+            # database stays locked past the busy timeout.
+            for phase in _PHASE_ORDER:
+                if phase in wanted:
+                    with PHASE_SECONDS.time(phase=phase.__name__):
+                        run_with_busy_retry(conn, phase)
+            return seconds_until_next_deadline(conn)
+        finally:
             conn.close()
-        except Exception as e:
-            print(f"WORKER ERROR: An error occurred: {e}")
 
-        print(f"Cycle complete. Waiting for {POLLING_INTERVAL_SECONDS} seconds...")
-        time.sleep(POLLING_INTERVAL_SECONDS)
+def worker_loop(stop=None):
+    """
+    The main loop for the background worker. Runs until `stop` (a
+    threading.Event, for running the worker in-process) is set, or forever.
+
+    The worker sleeps until there is something to do, then runs only the
+    phases that need it: new mail (reported by the IMAP IDLE watcher), new
+    shipments (reported by the app on WORKER_WAKEUP_PORT) and the next
+    deadline. A sweep of every phase runs every WORKER_SWEEP_SECONDS to catch
+    anything whose notice went missing. Without wakeup notices the sweep runs
+    every POLLING_INTERVAL_SECONDS, and without IDLE so does the mail check.
+    """
+    log.info("🚀 Worker started. Looking for jobs...")
+    create_database(DB_PATH) # Brings an existing database up to the latest schema
+    conn = get_db_connection()
+    backfilled = run_with_busy_retry(conn, schedule_missing_deadlines)
+    conn.close()
+    if backfilled:
+        log.info("WORKER: Scheduled deadlines for %d shipment(s) already waiting on carriers.", backfilled)
+    stop = stop or threading.Event()
+    start_heartbeat(DB_PATH, stop)
+    wakeup = threading.Event()
+    pending, pending_lock = set(), threading.Lock()
+
+    def request(kind):
+        if kind not in WAKEUP_PHASES:
+            log.debug("WORKER: Ignoring unknown wakeup %r.", kind)
+            return
+        WAKEUPS.inc(kind=kind)
+        with pending_lock:
+            pending.add(kind)
+        wakeup.set()
+
+    threading.Thread(target=set_when, args=(stop, wakeup), daemon=True).start()
+    idle_watcher = threading.Thread(target=watch_inbox, args=(lambda: request('mail'), stop), name="imap-idle", daemon=True)
+    idle_watcher.start()
+    listening = start_listener(WORKER_WAKEUP_PORT, request, stop, name="worker-wakeups")
+    sweep_seconds = WORKER_SWEEP_SECONDS if listening else POLLING_INTERVAL_SECONDS
+
+    last_retrain_check = None
+    next_sweep = next_mail_check = time.monotonic()
+    next_deadline_at = None
+    while not stop.is_set():
+        now = time.monotonic()
+        if now >= next_sweep:
+            request('sweep')
+            next_sweep = now + sweep_seconds
+        if not idle_watcher.is_alive() and now >= next_mail_check:
+            request('mail')
+            next_mail_check = now + POLLING_INTERVAL_SECONDS
+        if next_deadline_at is not None and now >= next_deadline_at:
+            request('deadlines')
+            next_deadline_at = None
+        if RETRAIN_CHECK_MINUTES and (last_retrain_check is None or now - last_retrain_check >= RETRAIN_CHECK_MINUTES * 60):
+            last_retrain_check = now
+            start_model_retraining()
+
+        with pending_lock:
+            kinds = set(pending)
+            pending.clear()
+            wakeup.clear() # Wakeups from here on trigger another cycle
+
+        if kinds:
+            try:
+                until_deadline = run_phases(kinds)
+                next_deadline_at = None if until_deadline is None else time.monotonic() + until_deadline
+            except Exception as e:
+                CYCLE_ERRORS.inc()
+                log.error("WORKER ERROR: An error occurred: %s", e)
+
+        timers = [next_sweep]
+        if not idle_watcher.is_alive():
+            timers.append(next_mail_check)
+        if next_deadline_at is not None:
+            timers.append(next_deadline_at)
+        wait_seconds = max(0.0, min(timers) - time.monotonic())
+        log.debug("Cycle complete. Waiting up to %.1f seconds...", wait_seconds)
+        wakeup.wait(wait_seconds)
+
+    close_session()
+    conn = get_db_connection()
+    run_with_busy_retry(conn, release_leases)
+    conn.close()
+
+def main():
+    """
+    Runs the worker as its own process. SIGTERM (what honcho and most process
+    managers send) stops it after the current cycle, so it gives its leases
+    back instead of leaving them to expire.
+    """
+    configure_logging()
+    start_exporter(WORKER_METRICS_PORT)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    worker_loop(stop)
 
 if __name__ == '__main__':
-    worker_loop()
+    main()